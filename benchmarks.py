@@ -0,0 +1,738 @@
+import argparse
+import base64
+import itertools
+import json
+import math
+import os
+import multiprocessing
+import random
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+from concurrent.futures import ThreadPoolExecutor
+
+from cryptography.fernet import Fernet
+
+import db_format
+import secure_client_gui
+import secure_server
+import traffic
+
+
+def bench_hash(args):
+    print(f"PBKDF2-SHA256, {args.workers} worker threads, {args.logins} logins per row")
+    print(f"{'iterations':>12} {'ms/hash':>10} {'logins/sec':>12}")
+    for iterations in args.iterations:
+        stored = secure_server.hash_password("correct horse", iterations)
+
+        t0 = time.perf_counter()
+        secure_server.verify_password(stored, "correct horse")
+        single_ms = (time.perf_counter() - t0) * 1000
+
+        with ThreadPoolExecutor(max_workers=args.workers) as pool:
+            t0 = time.perf_counter()
+            list(pool.map(lambda _: secure_server.verify_password(stored, "correct horse"),
+                          range(args.logins)))
+            elapsed = time.perf_counter() - t0
+
+        marker = "  <- PBKDF2_ITERATIONS" if iterations == secure_server.PBKDF2_ITERATIONS else ""
+        print(f"{iterations:>12} {single_ms:>10.1f} {args.logins / elapsed:>12.1f}{marker}")
+
+
+def fake_history(n):
+    words = ["hey", "ok", "see you", "lunch?", "sounds good", "running late", "lol", "on my way"]
+    history = []
+    for i in range(n):
+        outbound = random.random() < 0.5
+        row = {
+            "from": "alice" if outbound else "bob",
+            "to": "bob" if outbound else "alice",
+            "msg": " ".join(random.choices(words, k=random.randint(1, 12))),
+            "timestamp": f"2025-01-{1 + i // 5000:02d}T{(i // 60) % 24:02d}:{i % 60:02d}:00",
+            "kind": "text",
+            "filename": None,
+        }
+        if outbound:
+            row["read"] = True
+        history.append(row)
+    return history
+
+
+def bench_wire(args):
+    print(f"conversation_detail response, {args.messages} messages")
+    print(f"{'shape':<22} {'bytes':>10} {'client parse ms':>16}")
+    history = fake_history(args.messages)
+
+    for columnar in (False, True):
+        body = json.dumps({"ok": True, "history": secure_server.pack_rows(history, columnar)}).encode()
+        for codec in (None,) + tuple(secure_server.CODECS):
+            wire = body if codec is None else secure_server.CODECS[codec][1](body)
+
+            t0 = time.perf_counter()
+            for _ in range(args.repeat):
+                raw = wire if codec is None else secure_client_gui.DECOMPRESSORS[codec][1](wire)
+                resp = json.loads(raw)
+                if columnar:
+                    secure_client_gui.unpack_rows(resp["history"])
+            parse_ms = (time.perf_counter() - t0) * 1000 / args.repeat
+
+            shape = ("columnar" if columnar else "rows") + (f" + {codec}" if codec else "")
+            print(f"{shape:<22} {len(wire):>10} {parse_ms:>16.2f}")
+
+
+def sample_payloads():
+    words = ["hey", "ok", "see you", "lunch?", "sounds good", "running late", "lol", "on my way"]
+    log_lines = "".join(
+        f"2025-01-01T12:{i // 60 % 60:02d}:{i % 60:02d} INFO worker-{i % 4} handled request "
+        f"id={100000 + i} status=200 in {random.randint(1, 900)}ms\n" for i in range(400))
+    csv = "".join(f"{i},user{i % 50},{random.randint(0, 10**6)},ok\n" for i in range(2000))
+    return [
+        ("short text", " ".join(random.choices(words, k=8)).encode()),
+        ("long text", " ".join(random.choices(words, k=400)).encode()),
+        ("pasted log", log_lines.encode()),
+        ("csv file", csv.encode()),
+        ("random bytes", os.urandom(64 * 1024)),
+    ]
+
+
+def bench_store(args):
+    default = secure_server.STORE_COMPRESS_THRESHOLD
+    print(f"stored bytes and encrypt+decrypt ms, without and with compression "
+          f"(STORE_COMPRESS_THRESHOLD = {default})")
+    print(f"{'payload':<14} {'plain':>9} {'stored':>9} {'compressed':>11} {'ms':>8} {'ms zlib':>8}")
+    for name, data in sample_payloads():
+        row = []
+        for threshold in (float("inf"), default):
+            secure_server.STORE_COMPRESS_THRESHOLD = threshold
+            t0 = time.perf_counter()
+            for _ in range(args.repeat):
+                kid, ct, flags = secure_server.encrypt_message(data)
+                msg = db_format.Message("a", 0, 0, "file", kid, ct, "x", flags)
+                secure_server.decrypt_message(msg)
+            row += [len(ct), (time.perf_counter() - t0) * 1000 / args.repeat]
+        print(f"{name:<14} {len(data):>9} {row[0]:>9} {row[2]:>11} {row[1]:>8.3f} {row[3]:>8.3f}")
+    secure_server.STORE_COMPRESS_THRESHOLD = default
+
+
+def fake_db(n_users, n_messages, key=None):
+    f = Fernet(key or Fernet.generate_key())
+    users = [f"user{i}" for i in range(n_users)]
+    words = ["hey", "ok", "see you", "lunch?", "sounds good", "running late", "lol", "on my way"]
+    db = {"users": {u: {"pw": "x", "strikes": 0, "locked_until": None} for u in users},
+          "messages": {u: [] for u in users}, "typing": {}, "delivered": {}, "read_upto": {},
+          "gseq": 0, "cseq": {}, "tombstones": {}}
+    for i in range(n_messages):
+        sender, receiver = random.sample(users, 2)
+        text = " ".join(random.choices(words, k=random.randint(1, 12)))
+        ct = base64.urlsafe_b64decode(f.encrypt(text.encode()))
+        msg = secure_server.new_message(db, sender, receiver, "text", "0", ct)
+        msg.ts = 1_735_689_600_000_000_000 + i * 20_000_000_000
+    return db
+
+
+# the pre-Message layout: one dict per message, as secure_db.json stores it
+def dict_layout(db):
+    return {**db, "messages": {u: [db_format.message_to_dict(m) for m in inbox]
+                               for u, inbox in db["messages"].items()}}
+
+
+def bench_format(args):
+    print(f"DB with {args.users} users, {args.messages} messages")
+    db = fake_db(args.users, args.messages)
+    legacy = dict_layout(db)
+
+    with tempfile.TemporaryDirectory() as tmp:
+        json_path = os.path.join(tmp, "secure_db.json")
+        bin_path = os.path.join(tmp, "secure_db.bin")
+
+        def save_json():
+            with open(json_path, "w") as f:
+                json.dump(legacy, f, indent=2)
+
+        def load_json():
+            with open(json_path) as f:
+                return json.load(f)
+
+        rows = [
+            ("json (indent=2)", save_json, load_json, json_path),
+            ("binary", lambda: db_format.save(db, bin_path), lambda: db_format.load(bin_path), bin_path),
+        ]
+        print(f"{'format':<18} {'bytes':>12} {'save ms':>10} {'load ms':>10}")
+        for name, save, load, path in rows:
+            t0 = time.perf_counter()
+            save()
+            save_ms = (time.perf_counter() - t0) * 1000
+            t0 = time.perf_counter()
+            load()
+            load_ms = (time.perf_counter() - t0) * 1000
+            print(f"{name:<18} {os.path.getsize(path):>12} {save_ms:>10.1f} {load_ms:>10.1f}")
+
+        # the converter run as a script, as the README shows: going through
+        # JSON must give the same file as converting bin -> bin directly
+        converter = os.path.join(os.path.dirname(os.path.abspath(__file__)), "db_format.py")
+        direct = os.path.join(tmp, "direct.bin")
+        json_copy = os.path.join(tmp, "roundtrip.json")
+        bin_copy = os.path.join(tmp, "roundtrip.bin")
+        for src, dst in ((bin_path, direct), (bin_path, json_copy), (json_copy, bin_copy)):
+            subprocess.run([sys.executable, converter, src, dst], check=True, stdout=subprocess.DEVNULL)
+        with open(direct, "rb") as a, open(bin_copy, "rb") as b:
+            same = a.read() == b.read()
+        print(f"bin -> json -> bin: {'identical' if same else 'DIFFERS'}")
+
+
+def measure_alloc(build):
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    obj = build()
+    size = tracemalloc.get_traced_memory()[0] - before
+    tracemalloc.stop()
+    return obj, size
+
+
+def bench_memory(args):
+    print(f"In-memory messages, {args.messages} messages")
+    db = fake_db(args.users, args.messages)
+    encoded = db_format.encode_db(db)
+    del db
+
+    # both layouts are built from the same bytes, the way load_db builds them
+    def build_dicts():
+        return dict_layout(db_format.decode_db(encoded))["messages"]
+
+    def build_messages():
+        return db_format.decode_db(encoded)["messages"]
+
+    print(f"{'layout':<22} {'total MB':>10} {'bytes/msg':>10}")
+    for name, build in (("dict per message", build_dicts), ("Message (__slots__)", build_messages)):
+        _, size = measure_alloc(build)
+        print(f"{name:<22} {size / 1e6:>10.1f} {size / args.messages:>10.0f}")
+
+
+def bench_startup(args):
+    print(f"DB with {args.users} users, {args.messages} messages")
+    db = fake_db(args.users, args.messages)
+    user = next(iter(db["users"]))
+
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, "secure_db.bin")
+        db_format.save(db, path)
+        del db
+
+        print(f"{'load':<8} {'ready ms':>10} {'first inbox ms':>15} {'traced MB':>10}")
+        for name, load in (("full", db_format.load),
+                           ("lazy", lambda p: db_format.load_lazy(p, secure_server.INBOX_MEMORY_BUDGET))):
+            tracemalloc.start()
+            t0 = time.perf_counter()
+            loaded = load(path)
+            ready_ms = (time.perf_counter() - t0) * 1000
+            t0 = time.perf_counter()
+            loaded["messages"].get(user, [])
+            first_ms = (time.perf_counter() - t0) * 1000
+            size = tracemalloc.get_traced_memory()[0]
+            tracemalloc.stop()
+            print(f"{name:<8} {ready_ms:>10.1f} {first_ms:>15.2f} {size / 1e6:>10.1f}")
+            del loaded
+
+
+# a server in its own process and directory; rate limits off, so clients measure capacity
+def start_server(workdir, port, workers):
+    code = ("import secure_server as s; "
+            f"s.PORT = {port}; s.RATE_LIMITS = {{'default': (1e9, 1e9)}}; s.main()")
+    env = {**os.environ, "PYTHONPATH": os.path.dirname(os.path.abspath(__file__))}
+    proc = subprocess.Popen([sys.executable, "-c", code, "--workers", str(workers)],
+                            cwd=workdir, env=env, stdout=subprocess.DEVNULL)
+    deadline = time.monotonic() + 30
+    while time.monotonic() < deadline:
+        try:
+            socket.create_connection(("127.0.0.1", port), timeout=1).close()
+            return proc
+        except OSError:
+            time.sleep(0.1)
+    proc.kill()
+    raise RuntimeError("server did not start")
+
+
+def scale_client(port, user, peers, seconds):
+    conn = secure_client_gui.ServerConnection("127.0.0.1", port)
+    conn.token = conn.request({"action": "login", "data": {"user": user, "pw": "bench-pw"}})["token"]
+    done = 0
+    deadline = time.monotonic() + seconds
+    while time.monotonic() < deadline:
+        resp = conn.request({"action": "conversation_detail", "data": {"peer": random.choice(peers)}})
+        done += resp.get("ok", False)
+    conn.close()
+    return done
+
+
+def bench_scale(args):
+    print(f"conversation_detail throughput, {args.clients} client processes, "
+          f"{args.messages} messages, {os.cpu_count()} CPUs (0 workers = single process)")
+    key = Fernet.generate_key()
+    db = fake_db(args.users, args.messages, key)
+    for rec in db["users"].values():
+        rec["pw"] = "bench-pw"  # plaintext record, upgraded on first login
+    users = list(db["users"])
+
+    print(f"{'workers':>8} {'req/sec':>10}")
+    with tempfile.TemporaryDirectory() as tmp:
+        for workers in args.workers:
+            db_format.save(db, os.path.join(tmp, secure_server.DB_FILE))
+            with open(os.path.join(tmp, os.path.basename(secure_server.KEY_FILE)), "w") as f:
+                f.write(f"0:{key.decode()}\n")
+
+            proc = start_server(tmp, args.port, workers)
+            try:
+                with multiprocessing.Pool(args.clients) as pool:
+                    jobs = [(args.port, users[i % len(users)], users, args.seconds)
+                            for i in range(args.clients)]
+                    total = sum(pool.starmap(scale_client, jobs))
+            finally:
+                proc.terminate()
+                proc.wait()
+            print(f"{workers:>8} {total / args.seconds:>10.1f}")
+
+
+# A DB shaped like real use, for the generate and hot subcommands. Users
+# are unevenly active (a few are in many chats), messages per chat follow
+# a power law (a few huge chats, a long tail of short ones), and a share
+# of the messages are files stored inline, in the pre-attachment layout,
+# so one secure_db.json holds the whole dataset. Tokens are real Fernet
+# tokens under the active key of secret.key, drawn from a pool of
+# pre-encrypted texts and files so that generating 10M messages does not
+# take 10M encryptions.
+def synthetic_db(n_users, n_messages, files=0.05, skew=1.1, pool=2048):
+    words = ["hey", "ok", "see you", "lunch?", "sounds good", "running late", "lol", "on my way",
+             "did you see", "tomorrow", "the meeting", "haha", "thanks!", "can you send it"]
+    texts = [secure_server.encrypt_message(" ".join(random.choices(words, k=random.randint(1, 40))).encode())
+             for _ in range(pool)]
+    blobs = []
+    for i in range(max(pool // 32, 1)):
+        size = int(2 ** random.uniform(10, 16))  # 1 KiB - 64 KiB
+        content = (os.urandom(size) if i % 2 else
+                   "".join(f"{j},{random.choice(words)},{random.randint(0, 10**6)}\n"
+                           for j in range(size // 24)).encode())
+        kid, ct, flags = secure_server.encrypt_message(content)
+        blobs.append((kid, ct, flags | db_format.FLAG_RAW_FILE, f"file{i}.{'bin' if i % 2 else 'csv'}"))
+
+    users = [f"user{i}" for i in range(n_users)]
+    db = {"users": {u: {"pw": "bench-pw", "strikes": 0, "locked_until": None} for u in users},
+          "messages": {u: [] for u in users}, "typing": {}, "delivered": {}, "read_upto": {},
+          "gseq": 0, "cseq": {}, "tombstones": {}}
+
+    # chats: one side drawn towards the busy users, the other uniformly
+    chats = set()
+    target = min(max(n_users * 4, 1), n_users * (n_users - 1) // 2)
+    while len(chats) < target:
+        a = users[int(n_users * random.random() ** 2)]
+        b = random.choice(users)
+        if a != b:
+            chats.add((a, b) if a < b else (b, a))
+    chats = list(chats)
+    random.shuffle(chats)
+    weights = list(itertools.accumulate(1 / (rank + 1) ** skew for rank in range(len(chats))))
+
+    t0 = 1_735_689_600_000_000_000
+    for i, (a, b) in enumerate(random.choices(chats, cum_weights=weights, k=n_messages)):
+        sender, receiver = (a, b) if random.random() < 0.5 else (b, a)
+        if random.random() < files:
+            kid, ct, flags, filename = random.choice(blobs)
+            msg = secure_server.new_message(db, sender, receiver, "file", kid, ct, filename, flags)
+        else:
+            kid, ct, flags = random.choice(texts)
+            msg = secure_server.new_message(db, sender, receiver, "text", kid, ct, None, flags)
+        msg.ts = t0 + i * 1_000_000_000
+
+    # most of each inbox has been read
+    for receiver, senders in db["delivered"].items():
+        db["read_upto"][receiver] = {s: int(n * random.uniform(0.8, 1)) for s, n in senders.items()}
+    secure_server.prepare_meta(db)
+    return db
+
+
+# messages per chat, largest first; db["cseq"] is lo -> hi -> count
+def chat_sizes(db):
+    return sorted((n for counters in db["cseq"].values() for n in counters.values()), reverse=True)
+
+
+def bench_generate(args):
+    os.makedirs(args.out, exist_ok=True)
+    t0 = time.perf_counter()
+    db = synthetic_db(args.users, args.messages, args.files, args.skew)
+    gen_s = time.perf_counter() - t0
+
+    if args.format == "json":
+        path = os.path.join(args.out, secure_server.LEGACY_DB_FILE)
+        with open(path, "w") as f:
+            json.dump(dict_layout(db), f, indent=2)
+    else:
+        path = os.path.join(args.out, secure_server.DB_FILE)
+        db_format.save(db, path)
+    with open(os.path.join(args.out, os.path.basename(secure_server.KEY_FILE)), "w") as f:
+        f.writelines(f"{kid}:{key.decode()}\n" for kid, key in secure_server.read_key_file())
+
+    sizes = chat_sizes(db)
+    n_files = sum(m.kind == "file" for inbox in db["messages"].values() for m in inbox)
+    print(f"{path}: {args.users} users, {args.messages} messages ({n_files} files), "
+          f"{os.path.getsize(path) / 1e6:.1f} MB, generated in {gen_s:.1f} s")
+    print(f"{len(sizes)} chats; messages per chat: largest {sizes[0]}, "
+          f"p99 {sizes[len(sizes) // 100]}, median {sizes[len(sizes) // 2]}, smallest {sizes[-1]}")
+    print(f"passwords are all 'bench-pw'; start the server in {args.out} to use it")
+
+
+def median_ms(fn, repeat):
+    times = []
+    for _ in range(repeat):
+        t0 = time.perf_counter()
+        fn()
+        times.append((time.perf_counter() - t0) * 1000)
+    return sorted(times)[len(times) // 2]
+
+
+# each hot function on its own, without sockets, sessions or locks
+def bench_hot(args):
+    scales = [tuple(int(x) for x in scale.split(":")) for scale in args.scales]
+    columns = ["save", "load", "load lazy", "detail", "conversations", "search"]
+    print(f"median of {args.repeat} runs in ms; detail = the largest chat, conversations and "
+          f"search = the busiest user")
+    print(f"{'users':>8} {'messages':>10} " + " ".join(f"{c:>13}" for c in columns)
+          + f" {'MB loaded':>10} {'largest chat':>13}")
+
+    rows = []
+    default_db_file = secure_server.DB_FILE
+    with tempfile.TemporaryDirectory() as tmp:
+        secure_server.DB_FILE = os.path.join(tmp, "secure_db.bin")
+        try:
+            for n_users, n_messages in scales:
+                db = synthetic_db(n_users, n_messages, args.files, args.skew)
+                largest, a, b = max((n, lo, hi) for lo, counters in db["cseq"].items()
+                                    for hi, n in counters.items())
+                busiest = max(db["messages"], key=lambda u: len(db["messages"][u]))
+
+                def request(action, user, **data):
+                    return lambda: secure_server.handle_request(
+                        db, {"action": action, "username": user, "data": data, "columnar": True})
+
+                times = {"save": median_ms(lambda: secure_server.save_db(db), args.repeat)}
+                times["load"] = median_ms(lambda: secure_server.load_db(), args.repeat)
+                times["load lazy"] = median_ms(lambda: secure_server.load_db(lazy=True), args.repeat)
+                _, size = measure_alloc(secure_server.load_db)
+
+                detail = request("conversation_detail", a, peer=b)
+                detail()  # the first call marks the chat read and saves
+                times["detail"] = median_ms(detail, args.repeat)
+                times["conversations"] = median_ms(request("conversations", busiest), args.repeat)
+                times["search"] = median_ms(request("search", busiest, query="meeting"), args.repeat)
+
+                print(f"{n_users:>8} {n_messages:>10} " + " ".join(f"{times[c]:>13.1f}" for c in columns)
+                      + f" {size / 1e6:>10.1f} {largest:>13}")
+                rows.append((n_messages, times, size))
+                del db
+        finally:
+            secure_server.DB_FILE = default_db_file
+
+    if len(rows) < 2:
+        return
+    # t ~ messages^k between the smallest and the largest scale: 1 is linear
+    (m0, t0, s0), (m1, t1, s1) = rows[0], rows[-1]
+    span = math.log(m1 / m0)
+    print(f"growth from {m0} to {m1} messages, as the exponent k in time ~ messages^k:")
+    for c in columns:
+        k = math.log(max(t1[c], 1e-3) / max(t0[c], 1e-3)) / span
+        print(f"  {c:<14} k = {k:.2f}")
+    print(f"  {'memory':<14} k = {math.log(s1 / s0) / span:.2f}")
+
+
+# actions a replay cannot reproduce faithfully: they need state the capture
+# does not hold (file handles), end the session, or change group membership
+REPLAY_SKIPPED = {"download_file", "logout", "logout_all", "add_group_member", "leave_group",
+                  "metrics", "profile_start", "profile_stop", "trace_memory", "dump_stacks", "other"}
+
+
+# pseudonyms -> test names, with the groups and chats each user touched
+def replay_cast(records):
+    names, groups, peers_of = {}, {}, {}
+    for r in records:
+        if r["user"] and r["user"] not in names:
+            names[r["user"]] = f"user{len(names)}"
+    for r in records:
+        if not r["peer"]:
+            continue
+        user = names.get(r["user"])
+        if r["group"]:
+            group = groups.setdefault(r["peer"], {"gid": f"#{r['peer'] & 0xFFFFFFFF:08x}", "members": []})
+            if user and user not in group["members"]:
+                group["members"].append(user)
+            chat = ("group", group["gid"])
+        else:
+            if r["peer"] not in names:
+                names[r["peer"]] = f"user{len(names)}"
+            chat = ("peer", names[r["peer"]])
+        if user:
+            peers_of.setdefault(user, {})[chat] = None
+    return names, groups, peers_of
+
+
+def replay_db(names, groups, peers_of, per_chat, key):
+    f = Fernet(key)
+    words = ["hey", "ok", "see you", "lunch?", "sounds good", "running late", "lol", "on my way"]
+    db = {"users": {u: {"pw": "bench-pw", "strikes": 0, "locked_until": None}
+                    for u in names.values()},
+          "messages": {}, "typing": {}, "delivered": {}, "read_upto": {},
+          "gseq": 0, "cseq": {}, "tombstones": {}, "groups": {}}
+    for u in db["users"]:
+        db["messages"][u] = []
+    for group in groups.values():
+        members = group["members"] or [next(iter(db["users"]))]
+        db["groups"][group["gid"]] = {"name": "replay", "owner": members[0], "last": 0,
+                                      "members": dict.fromkeys(members, 0)}
+        db["messages"][group["gid"]] = []
+
+    # history where the capture shows traffic, so reads have something to read
+    chats = [(user, chat) for user, seen in peers_of.items() for chat in seen]
+    for i, (user, (kind, peer)) in enumerate(chats * per_chat):
+        text = " ".join(random.choices(words, k=random.randint(1, 12)))
+        ct = base64.urlsafe_b64decode(f.encrypt(text.encode()))
+        if kind == "group":
+            msg = secure_server.new_group_message(db, peer, user, "text", "0", ct)
+        else:
+            sender, receiver = random.sample((user, peer), 2)
+            msg = secure_server.new_message(db, sender, receiver, "text", "0", ct)
+        msg.ts = 1_735_689_600_000_000_000 + i * 20_000_000_000
+    return db
+
+
+# a request shaped like the recorded one: same action, target and size
+def replay_request(r, names, groups, peers_of):
+    action = r["action"]
+    user = names.get(r["user"])
+    if r["group"]:
+        peer = groups[r["peer"]]["gid"]
+    else:
+        peer = names.get(r["peer"])
+    pad = None
+
+    if action == "register":
+        # every captured user is seeded, so a new name keeps the hashing cost
+        data = {"user": f"{user}-{random.randrange(10**9)}", "pw": "bench-pw"}
+    elif action == "login":
+        data = {"user": user, "pw": "bench-pw"}
+    elif action in ("conversation_detail", "typing_status", "delete_conversation"):
+        data = {"peer": peer}
+    elif action == "typing":
+        data = {"peer": peer, "is_typing": True}
+    elif action == "group_detail":
+        data = {"group": peer}
+    elif action == "search":
+        data = {"query": "e" * max(r["items"], 1)}
+    elif action == "poll":
+        chats = list(peers_of.get(user, {}))[:r["items"]]
+        data = {"chats": [{kind: name, "after": 0} for kind, name in chats]}
+    elif action == "sync":
+        data = {"device": "replay"}
+    elif action == "send":
+        data, pad = {"to": peer, "msg": ""}, "msg"
+    elif action == "send_group":
+        data, pad = {"group": peer, "msg": ""}, "msg"
+    elif action == "send_file":
+        data, pad = {"to": peer, "filename": "replay.bin", "content_b64": ""}, "content_b64"
+    elif action == "create_group":
+        members = random.sample(list(names.values()), min(max(r["items"] - 1, 0), len(names)))
+        data = {"name": "replay", "members": members}
+    else:
+        data = {}  # inbox, conversations, groups, presence
+    if r["items"] and action in ("inbox", "sync"):
+        data["limit"] = r["items"]
+
+    req = {"action": action, "data": data}
+    if pad:
+        # a session token is 43 characters
+        missing = r["req_bytes"] - len(json.dumps({**req, "token": "t" * 43}))
+        if pad == "msg":
+            data[pad] = "x" * max(missing, 1)
+        else:
+            data[pad] = base64.b64encode(os.urandom(max(missing, 4) * 3 // 4)).decode()
+    return req
+
+
+# one thread per recorded connection, each request sent at its recorded time / speed
+def replay_connection(port, records, cast, start, speed, results):
+    names, groups, peers_of = cast
+    conn = secure_client_gui.ServerConnection("127.0.0.1", port)
+    user = names.get(records[0]["user"])
+    for r in records:
+        delay = start + r["t"] / speed - time.monotonic()
+        if delay > 0:
+            time.sleep(delay)
+        if r["action"] in REPLAY_SKIPPED:
+            results.append((r, None, False, max(-delay, 0)))
+            continue
+        if conn.token is None and r["action"] not in ("register", "login") and user:
+            # the session was opened on an earlier connection
+            conn.token = conn.request({"action": "login",
+                                       "data": {"user": user, "pw": "bench-pw"}}).get("token")
+        req = replay_request(r, names, groups, peers_of)
+        t0 = time.perf_counter()
+        resp = conn.request(req)
+        elapsed = time.perf_counter() - t0
+        if r["action"] == "login" and resp.get("token"):
+            conn.token = resp["token"]
+        results.append((r, elapsed, resp.get("ok", False), max(-delay, 0)))
+    conn.close()
+
+
+def percentile(values, q):
+    if not values:
+        return float("nan")
+    values = sorted(values)
+    return values[min(int(len(values) * q), len(values) - 1)]
+
+
+def bench_replay(args):
+    started, records = traffic.read(args.capture)
+    if not records:
+        print("capture holds no requests")
+        return
+    cast = replay_cast(records)
+    span = records[-1]["t"]
+    print(f"capture from {time.strftime('%Y-%m-%d %H:%M', time.localtime(started))}: "
+          f"{len(records)} requests, {len(cast[0])} users, {len(cast[1])} groups, "
+          f"{len({r['conn'] for r in records})} connections over {span:.1f} s")
+    print(f"replaying at {args.speed}x on {args.workers} workers (0 = single process), "
+          f"{args.history} seeded messages per chat, rate limits off")
+
+    key = Fernet.generate_key()
+    db = replay_db(*cast, args.history, key)
+    by_conn = {}
+    for r in records:
+        by_conn.setdefault(r["conn"], []).append(r)
+
+    results = []
+    with tempfile.TemporaryDirectory() as tmp:
+        db_format.save(db, os.path.join(tmp, secure_server.DB_FILE))
+        with open(os.path.join(tmp, os.path.basename(secure_server.KEY_FILE)), "w") as f:
+            f.write(f"0:{key.decode()}\n")
+        proc = start_server(tmp, args.port, args.workers)
+        try:
+            start = time.monotonic() + 0.5
+            threads = [threading.Thread(target=replay_connection,
+                                        args=(args.port, recs, cast, start, args.speed, results))
+                       for recs in by_conn.values()]
+            for t in threads:
+                t.start()
+            for t in threads:
+                t.join()
+            wall = time.monotonic() - start
+        finally:
+            proc.terminate()
+            proc.wait()
+
+    print(f"{'action':<20} {'count':>7} {'capture p50':>12} {'p95':>8} {'replay p50':>11} "
+          f"{'p95':>8} {'failed':>7}")
+    by_action = {}
+    for r, elapsed, ok, late in results:
+        by_action.setdefault(r["action"], []).append((r, elapsed, ok))
+    for action, rows in sorted(by_action.items(), key=lambda kv: -len(kv[1])):
+        recorded = [r["duration"] * 1000 for r, _, _ in rows]
+        replayed = [elapsed * 1000 for _, elapsed, _ in rows if elapsed is not None]
+        if not replayed:
+            print(f"{action:<20} {len(rows):>7} {percentile(recorded, 0.5):>12.2f} "
+                  f"{percentile(recorded, 0.95):>8.2f} {'skipped':>11}")
+            continue
+        # failures only count where the original request succeeded
+        failed = sum(1 for r, _, ok in rows if not ok and r["status"] != traffic.STATUS_ERROR)
+        print(f"{action:<20} {len(rows):>7} {percentile(recorded, 0.5):>12.2f} "
+              f"{percentile(recorded, 0.95):>8.2f} {percentile(replayed, 0.5):>11.2f} "
+              f"{percentile(replayed, 0.95):>8.2f} {failed:>7}")
+    sent = sum(1 for _, elapsed, _, _ in results if elapsed is not None)
+    lateness = [late * 1000 for _, elapsed, _, late in results if elapsed is not None]
+    print(f"replayed {sent} requests in {wall:.1f} s ({sent / max(wall, 1e-9):.1f} req/s, "
+          f"capture pace {len(records) / max(span, 1e-9) * args.speed:.1f} req/s); "
+          f"send lag p95 {percentile(lateness, 0.95):.1f} ms (ms columns are per request)")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="PYchat benchmarks")
+    sub = parser.add_subparsers(dest="bench", required=True)
+
+    p = sub.add_parser("hash", help="password hashing cost per work factor")
+    p.add_argument("--iterations", type=int, nargs="+",
+                   default=[50_000, 100_000, secure_server.PBKDF2_ITERATIONS, 400_000, 600_000])
+    p.add_argument("--workers", type=int, default=secure_server.HASH_WORKERS)
+    p.add_argument("--logins", type=int, default=32)
+    p.set_defaults(func=bench_hash)
+
+    p = sub.add_parser("wire", help="response size and parse time with compression/columnar")
+    p.add_argument("--messages", type=int, default=5000)
+    p.add_argument("--repeat", type=int, default=20)
+    p.set_defaults(func=bench_wire)
+
+    p = sub.add_parser("store", help="message/file size and crypto time with compression before encryption")
+    p.add_argument("--repeat", type=int, default=50)
+    p.set_defaults(func=bench_store)
+
+    p = sub.add_parser("format", help="secure_db.json vs secure_db.bin size and load/save time")
+    p.add_argument("--users", type=int, default=200)
+    p.add_argument("--messages", type=int, default=100_000)
+    p.set_defaults(func=bench_format)
+
+    p = sub.add_parser("memory", help="memory per message: dict layout vs Message objects")
+    p.add_argument("--users", type=int, default=200)
+    p.add_argument("--messages", type=int, default=100_000)
+    p.set_defaults(func=bench_memory)
+
+    p = sub.add_parser("startup", help="time to first request and memory: full vs lazy inbox loading")
+    p.add_argument("--users", type=int, default=200)
+    p.add_argument("--messages", type=int, default=100_000)
+    p.set_defaults(func=bench_startup)
+
+    p = sub.add_parser("scale", help="read throughput with --workers N")
+    p.add_argument("--workers", type=int, nargs="+", default=[0, 2, 4])
+    p.add_argument("--clients", type=int, default=8)
+    p.add_argument("--seconds", type=float, default=5)
+    p.add_argument("--users", type=int, default=50)
+    p.add_argument("--messages", type=int, default=20_000)
+    p.add_argument("--port", type=int, default=17790)
+    p.set_defaults(func=bench_scale)
+
+    p = sub.add_parser("generate", help="write a synthetic secure_db.json / secure_db.bin dataset")
+    p.add_argument("out", help="directory for the DB and its secret.key")
+    p.add_argument("--users", type=int, default=10_000)
+    p.add_argument("--messages", type=int, default=1_000_000)
+    p.add_argument("--files", type=float, default=0.05, help="share of messages that are files")
+    p.add_argument("--skew", type=float, default=1.1, help="power-law exponent of messages per chat")
+    p.add_argument("--format", choices=["json", "bin"], default="json")
+    p.set_defaults(func=bench_generate)
+
+    p = sub.add_parser("hot", help="load/save/detail/conversations/search time and memory by DB size")
+    p.add_argument("--scales", nargs="+", default=["100:10000", "1000:100000", "10000:1000000"],
+                   metavar="USERS:MESSAGES")
+    p.add_argument("--files", type=float, default=0.05)
+    p.add_argument("--skew", type=float, default=1.1)
+    p.add_argument("--repeat", type=int, default=5)
+    p.set_defaults(func=bench_hot)
+
+    p = sub.add_parser("replay", help="replay a capture (secure_server.py --capture) against a test server")
+    p.add_argument("capture")
+    p.add_argument("--speed", type=float, default=1.0, help="time compression: 2 sends twice as fast")
+    p.add_argument("--workers", type=int, default=0)
+    p.add_argument("--history", type=int, default=50,
+                   help="messages seeded per captured chat (the capture holds no content)")
+    p.add_argument("--port", type=int, default=17791)
+    p.set_defaults(func=bench_replay)
+
+    args = parser.parse_args()
+    # the server module keeps its key and log in the current directory;
+    # point them at a scratch one so benchmarks leave nothing behind
+    with tempfile.TemporaryDirectory() as scratch:
+        secure_server.KEY_FILE = os.path.join(scratch, secure_server.KEY_FILE)
+        secure_server.LOG_FILE = os.path.join(scratch, secure_server.LOG_FILE)
+        secure_server.keyring = secure_server.load_keyring()
+        args.func(args)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,508 @@
+import argparse
+import base64
+import json
+import mmap
+import os
+import struct
+import sys
+from collections import OrderedDict
+from datetime import datetime
+
+# ---------------------------------------------------------------------- #
+#  Binary at-rest format for the server DB (secure_db.bin)               #
+#                                                                        #
+#    magic "PYCHATDB" | u16 version                                      #
+#    u32 len | meta JSON        (users, read state, ... - everything     #
+#                                except messages and typing state)       #
+#    u32 count | names          (u16 len + utf-8 each; user ids below    #
+#                                are indexes into this table)            #
+#    u32 count | inboxes        (u32 receiver id | u32 message count |   #
+#                                records)                                #
+#                                                                        #
+#  record: u32 sender id | i64 ts (epoch ns) | u32 seq | u32 cseq |      #
+#          u64 gseq | u8 kind | u8 flags | u8 key id len |               #
+#          u16 filename len | u32 token len |                            #
+#          key id | filename | raw Fernet token (not base64)             #
+#                                                                        #
+#    u32 count | index          (u32 receiver id | u64 offset |          #
+#                                u64 byte length | u32 message count)    #
+#    u64 offset of the index    (last 8 bytes of the file)               #
+#                                                                        #
+#  Version 1 records had epoch seconds and no cseq/gseq; they load with  #
+#  cseq = gseq = 0 and the server numbers them. Version 2 had no index.  #
+# ---------------------------------------------------------------------- #
+
+MAGIC = b"PYCHATDB"
+VERSION = 3
+
+HEADER = struct.Struct(">8sH")
+U16 = struct.Struct(">H")
+U32 = struct.Struct(">I")
+INBOX = struct.Struct(">II")
+RECORD = struct.Struct(">IqIIQBBBHI")
+RECORD_V1 = struct.Struct(">IqIBBBHI")
+INDEX_ENTRY = struct.Struct(">IQQI")
+U64 = struct.Struct(">Q")
+
+KINDS = ["text", "file"]
+FLAG_RAW_FILE = 0x01  # file content encrypted as raw bytes, not base64 text
+FLAG_ZLIB = 0x02      # plaintext zlib-compressed before encryption
+FLAG_ATTACHMENT = 0x04  # file content is in an attachment file; the token holds its descriptor
+
+
+# In-memory message. One per stored message, so it is kept small: slots
+# instead of a dict, the sender name interned (shared by all of that
+# user's messages), integer timestamps and the raw token bytes.
+#   ts    epoch nanoseconds
+#   seq   position in the sender -> receiver direction (read watermarks)
+#   cseq  position in the conversation, both directions
+#   gseq  server-wide position; orders everything without comparing times
+class Message:
+    __slots__ = ("sender", "ts", "seq", "cseq", "gseq", "kind", "kid", "filename", "ct", "flags")
+
+    def __init__(self, sender, ts, seq, kind, kid, ct, filename=None, flags=0, cseq=0, gseq=0):
+        self.sender = sys.intern(sender)
+        self.ts = ts
+        self.seq = seq
+        self.cseq = cseq
+        self.gseq = gseq
+        self.kind = kind
+        self.kid = kid
+        self.ct = ct
+        self.filename = filename
+        self.flags = flags
+
+    @property
+    def token(self) -> bytes:
+        return base64.urlsafe_b64encode(self.ct)
+
+
+# the secure_db.json message layout, used for legacy files and the converter
+def message_from_dict(d: dict) -> Message:
+    return Message(
+        d.get("from") or "",
+        d["ts_ns"] if "ts_ns" in d else ts_to_ns(d.get("ts")),
+        d.get("seq", 0),
+        d.get("kind", "text"),
+        d.get("kid", "0"),
+        base64.urlsafe_b64decode(d["msg"]),
+        d.get("filename"),
+        (FLAG_RAW_FILE if d.get("raw") else 0) | (FLAG_ZLIB if d.get("zlib") else 0)
+        | (FLAG_ATTACHMENT if d.get("attachment") else 0),
+        d.get("cseq", 0),
+        d.get("gseq", 0),
+    )
+
+
+def message_to_dict(msg: Message) -> dict:
+    d = {
+        "from": msg.sender,
+        "msg": msg.token.decode(),
+        "kid": msg.kid,
+        "ts": ts_from_ns(msg.ts),
+        "ts_ns": msg.ts,
+        "seq": msg.seq,
+        "cseq": msg.cseq,
+        "gseq": msg.gseq,
+        "kind": msg.kind,
+    }
+    if msg.kind == "file":
+        d["filename"] = msg.filename
+    if msg.flags & FLAG_RAW_FILE:
+        d["raw"] = True
+    if msg.flags & FLAG_ZLIB:
+        d["zlib"] = True
+    if msg.flags & FLAG_ATTACHMENT:
+        d["attachment"] = True
+    return d
+
+
+def ts_to_ns(ts) -> int:
+    try:
+        return int(datetime.fromisoformat(ts).timestamp()) * 1_000_000_000
+    except (TypeError, ValueError):
+        return 0
+
+
+def ts_from_ns(value: int) -> str:
+    return datetime.fromtimestamp(value // 1_000_000_000).isoformat(timespec="seconds")
+
+
+def encode_db(db: dict) -> bytes:
+    return encode_db_indexed(db)[0]
+
+
+# returns the file bytes, receiver -> (offset, byte length, count) and the names table
+def encode_db_indexed(db: dict):
+    # typing state lives for seconds; it is kept in memory only
+    meta = {k: v for k, v in db.items() if k not in ("messages", "typing")}
+    messages = db["messages"]
+    lazy = isinstance(messages, LazyInboxes)
+
+    # a lazy DB keeps its name ids, so cold inboxes are copied byte for byte
+    names = {name: i for i, name in enumerate(messages.names)} if lazy else {}
+    for receiver in messages:
+        names.setdefault(receiver, len(names))
+        if lazy and not messages.loaded(receiver):
+            continue
+        for msg in messages[receiver]:
+            names.setdefault(msg.sender, len(names))
+
+    out = [HEADER.pack(MAGIC, VERSION)]
+    meta_bytes = json.dumps(meta, separators=(",", ":")).encode()
+    out.append(U32.pack(len(meta_bytes)))
+    out.append(meta_bytes)
+
+    out.append(U32.pack(len(names)))
+    for name in names:
+        raw = (name or "").encode()
+        out.append(U16.pack(len(raw)))
+        out.append(raw)
+
+    out.append(U32.pack(len(messages)))
+    pos = sum(map(len, out))
+    index = {}
+    for receiver in messages:
+        if lazy and not messages.loaded(receiver):
+            raw, count = messages.raw(receiver)
+            out.append(INBOX.pack(names[receiver], count))
+            out.append(raw)
+            index[receiver] = (pos + INBOX.size, len(raw), count)
+            pos += INBOX.size + len(raw)
+            continue
+
+        inbox = messages[receiver]
+        out.append(INBOX.pack(names[receiver], len(inbox)))
+        start = len(out)
+        for msg in inbox:
+            kid = msg.kid.encode()
+            filename = (msg.filename or "").encode()
+            out.append(RECORD.pack(
+                names[msg.sender],
+                msg.ts,
+                msg.seq,
+                msg.cseq,
+                msg.gseq,
+                KINDS.index(msg.kind),
+                msg.flags,
+                len(kid),
+                len(filename),
+                len(msg.ct),
+            ))
+            out.append(kid)
+            out.append(filename)
+            out.append(msg.ct)
+        length = sum(map(len, out[start:]))
+        index[receiver] = (pos + INBOX.size, length, len(inbox))
+        pos += INBOX.size + length
+
+    out.append(U32.pack(len(index)))
+    for receiver, (offset, length, count) in index.items():
+        out.append(INDEX_ENTRY.pack(names[receiver], offset, length, count))
+    out.append(U64.pack(pos))
+
+    return b"".join(out), index, list(names)
+
+
+def decode_head(view):
+    magic, version = HEADER.unpack_from(view, 0)
+    if magic != MAGIC:
+        raise ValueError("not a PYchat DB file")
+    if version not in (1, 2, VERSION):
+        raise ValueError(f"unsupported DB format version {version}")
+    pos = HEADER.size
+
+    (n,) = U32.unpack_from(view, pos)
+    pos += 4
+    db = json.loads(bytes(view[pos:pos + n]))
+    pos += n
+
+    (count,) = U32.unpack_from(view, pos)
+    pos += 4
+    names = []
+    for _ in range(count):
+        (n,) = U16.unpack_from(view, pos)
+        pos += 2
+        names.append(bytes(view[pos:pos + n]).decode())
+        pos += n
+
+    return version, db, names, pos
+
+
+def decode_db(data: bytes) -> dict:
+    view = memoryview(data)
+    version, db, names, pos = decode_head(view)
+
+    messages = {}
+    (count,) = U32.unpack_from(view, pos)
+    pos += 4
+    for _ in range(count):
+        receiver_id, n_msgs = INBOX.unpack_from(view, pos)
+        pos += INBOX.size
+        messages[names[receiver_id]], pos = decode_inbox(view, pos, n_msgs, names, version)
+
+    db["messages"] = messages
+    return db
+
+
+def decode_inbox(view, pos, n_msgs, names, version=VERSION):
+    inbox = []
+    for _ in range(n_msgs):
+        if version == 1:
+            sender_id, ts, seq, kind, flags, n_kid, n_name, n_token = RECORD_V1.unpack_from(view, pos)
+            pos += RECORD_V1.size
+            ts *= 1_000_000_000
+            cseq = gseq = 0
+        else:
+            (sender_id, ts, seq, cseq, gseq,
+             kind, flags, n_kid, n_name, n_token) = RECORD.unpack_from(view, pos)
+            pos += RECORD.size
+        kid = str(view[pos:pos + n_kid], "ascii")
+        pos += n_kid
+        filename = str(view[pos:pos + n_name], "utf-8") if n_name else None
+        pos += n_name
+        ct = bytes(view[pos:pos + n_token])
+        pos += n_token
+
+        inbox.append(Message(names[sender_id], ts, seq, KINDS[kind], kid, ct, filename, flags, cseq, gseq))
+    return inbox, pos
+
+
+# Inboxes of a memory-mapped file, decoded on first access. Loaded inboxes
+# are kept in LRU order and the least recently used clean ones are dropped
+# when the estimate passes `budget` bytes; they reload from the file.
+# An inbox is dirty from its first setdefault/assignment/touch() until the
+# next save(), which writes a new file and rebinds to it.
+class LazyInboxes(dict):
+    MESSAGE_OVERHEAD = 250  # Message object + slots, beyond the token bytes
+
+    def __init__(self, path, budget):
+        super().__init__()
+        self.budget = budget
+        self.sizes = OrderedDict()  # loaded receiver -> estimated bytes, LRU first
+        self.used = 0
+        self.dirty = set()
+        self.loads = 0
+        self.evictions = 0
+        self.index = {}
+        self.source = None
+        self.bind(path)
+
+    def bind(self, path, index=None, names=None):
+        with open(path, "rb") as f:
+            source = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        view = memoryview(source)
+        if index is None:
+            _, _, names, _ = decode_head(view)
+            (index_pos,) = U64.unpack_from(view, len(view) - U64.size)
+            (count,) = U32.unpack_from(view, index_pos)
+            index = {}
+            for i in range(count):
+                receiver_id, offset, length, n = INDEX_ENTRY.unpack_from(view, index_pos + 4 + i * INDEX_ENTRY.size)
+                index[names[receiver_id]] = (offset, length, n)
+        view.release()
+        if self.source is not None:
+            self.source.close()
+        self.source = source
+        self.names = names
+        self.index = index
+        self.dirty.clear()
+        # everything in memory now matches the file and may be evicted
+        self.sizes = OrderedDict((r, index[r][1] + index[r][2] * self.MESSAGE_OVERHEAD)
+                                 for r in self.sizes if r in index)
+        for receiver in dict.keys(self):
+            if receiver not in self.sizes:
+                self.sizes[receiver] = index[receiver][1] + index[receiver][2] * self.MESSAGE_OVERHEAD
+        self.used = sum(self.sizes.values())
+
+    def loaded(self, receiver):
+        return dict.__contains__(self, receiver)
+
+    def raw(self, receiver):
+        offset, length, count = self.index[receiver]
+        return self.source[offset:offset + length], count
+
+    def touch(self, receiver):
+        self[receiver]
+        self.dirty.add(receiver)
+
+    def _load(self, receiver):
+        offset, length, count = self.index[receiver]
+        with memoryview(self.source) as view:
+            inbox, _ = decode_inbox(view, offset, count, self.names)
+        dict.__setitem__(self, receiver, inbox)
+        self.sizes[receiver] = length + count * self.MESSAGE_OVERHEAD
+        self.used += self.sizes[receiver]
+        self.loads += 1
+        self.evict(keep=receiver)
+        return inbox
+
+    def evict(self, keep=None):
+        for receiver in list(self.sizes):
+            if self.used <= self.budget:
+                break
+            if receiver == keep or receiver in self.dirty or receiver not in self.index:
+                continue
+            dict.__delitem__(self, receiver)
+            self.used -= self.sizes.pop(receiver)
+            self.evictions += 1
+
+    def __getitem__(self, receiver):
+        if dict.__contains__(self, receiver):
+            if receiver in self.sizes:
+                self.sizes.move_to_end(receiver)
+            return dict.__getitem__(self, receiver)
+        if receiver in self.index:
+            return self._load(receiver)
+        raise KeyError(receiver)
+
+    def __setitem__(self, receiver, inbox):
+        dict.__setitem__(self, receiver, inbox)
+        self.index.pop(receiver, None)
+        self.used -= self.sizes.pop(receiver, 0)
+        self.dirty.add(receiver)
+
+    def __contains__(self, receiver):
+        return dict.__contains__(self, receiver) or receiver in self.index
+
+    def __iter__(self):
+        # a snapshot: loading or evicting while iterating is fine
+        return iter(list(dict.keys(self)) + [r for r in self.index if not dict.__contains__(self, r)])
+
+    def __len__(self):
+        return len(set(dict.keys(self)) | set(self.index))
+
+    def keys(self):
+        return list(self)
+
+    def get(self, receiver, default=None):
+        try:
+            return self[receiver]
+        except KeyError:
+            return default
+
+    def setdefault(self, receiver, default=None):
+        if receiver not in self:
+            self[receiver] = default
+        else:
+            self.touch(receiver)
+        return self[receiver]
+
+    def items(self):
+        return ((r, self[r]) for r in list(self))
+
+    def values(self):
+        return (self[r] for r in list(self))
+
+    def stats(self):
+        return {"inboxes": len(self), "loaded": dict.__len__(self), "estimated_bytes": self.used,
+                "budget": self.budget, "loads": self.loads, "evictions": self.evictions}
+
+
+def load(path: str) -> dict:
+    with open(path, "rb") as f:
+        return decode_db(f.read())
+
+
+# users and read state now, inboxes on first access; None for files
+# older than version 3, which have no index, and for files holding
+# unnumbered records (more messages than gseq has handed out), which
+# only a full load can number
+def load_lazy(path: str, budget: int):
+    with open(path, "rb") as f:
+        head = f.read(HEADER.size)
+        if len(head) < HEADER.size or HEADER.unpack(head)[1] != VERSION:
+            return None
+        (n,) = U32.unpack(f.read(4))
+        db = json.loads(f.read(n))
+    inboxes = LazyInboxes(path, budget)
+    if sum(count for _, _, count in inboxes.index.values()) > db.get("gseq", 0):
+        inboxes.source.close()
+        return None
+    db["messages"] = inboxes
+    return db
+
+
+def save(db: dict, path: str) -> int:
+    data, index, names = encode_db_indexed(db)
+    tmp = path + ".tmp"
+    with open(tmp, "wb") as f:
+        f.write(data)
+    os.replace(tmp, path)
+    if isinstance(db["messages"], LazyInboxes):
+        db["messages"].bind(path, index, names)
+        db["messages"].evict()
+    return len(data)
+
+
+# ---------------------------------------------------------------------- #
+#  Attachment files (attachments/<id>.bin), one per sent file:           #
+#                                                                        #
+#    magic "PYATTACH" | u32 chunk size | u64 plaintext size |            #
+#    u32 chunk count | u32 token length per chunk | raw Fernet tokens    #
+#                                                                        #
+#  Chunk i holds plaintext bytes [i * chunk size, (i + 1) * chunk size), #
+#  so a byte range maps to a run of chunks, and the length table gives   #
+#  their offsets in the file without reading any of them.                #
+# ---------------------------------------------------------------------- #
+
+ATTACH_MAGIC = b"PYATTACH"
+ATTACH_HEADER = struct.Struct(">8sIQI")
+
+
+def write_attachment(path: str, chunk_size: int, size: int, tokens: list) -> int:
+    tmp = path + ".tmp"
+    with open(tmp, "wb") as f:
+        f.write(ATTACH_HEADER.pack(ATTACH_MAGIC, chunk_size, size, len(tokens)))
+        f.write(struct.pack(f">{len(tokens)}I", *map(len, tokens)))
+        for token in tokens:
+            f.write(token)
+        written = f.tell()
+    os.replace(tmp, path)
+    return written
+
+
+# -> (chunk size, plaintext size, [(file offset, token length)] per chunk)
+def read_attachment_index(path: str):
+    with open(path, "rb") as f:
+        magic, chunk_size, size, count = ATTACH_HEADER.unpack(f.read(ATTACH_HEADER.size))
+        if magic != ATTACH_MAGIC:
+            raise ValueError(f"{path} is not an attachment file")
+        lengths = struct.unpack(f">{count}I", f.read(4 * count))
+    pos = ATTACH_HEADER.size + 4 * count
+    chunks = []
+    for n in lengths:
+        chunks.append((pos, n))
+        pos += n
+    return chunk_size, size, chunks
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Convert the PYchat DB between JSON and binary")
+    parser.add_argument("src", help="secure_db.json or secure_db.bin")
+    parser.add_argument("dst", help="output path; the format follows the .json/.bin extension")
+    args = parser.parse_args()
+
+    if args.src.endswith(".json"):
+        with open(args.src) as f:
+            db = json.load(f)
+    else:
+        db = load(args.src)
+    # the upgrade the server runs on load: sequence numbers, read marks
+    import secure_server
+    secure_server.migrate_db(db)
+
+    if args.dst.endswith(".json"):
+        db["messages"] = {u: [message_to_dict(m) for m in inbox]
+                          for u, inbox in db["messages"].items()}
+        with open(args.dst, "w") as f:
+            json.dump(db, f, indent=2)
+    else:
+        save(db, args.dst)
+
+    before, after = os.path.getsize(args.src), os.path.getsize(args.dst)
+    print(f"{args.src} ({before} bytes) -> {args.dst} ({after} bytes, {after / max(before, 1):.0%})")
+
+
+if __name__ == "__main__":
+    main()
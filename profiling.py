@@ -0,0 +1,219 @@
+import cProfile
+import io
+import os
+import pstats
+import sys
+import threading
+import time
+import traceback
+import tracemalloc
+from collections import Counter
+from datetime import datetime
+
+# ---------------------------------------------------------------------- #
+#  On-demand diagnostics for the live server, driven by the admin       #
+#  actions in secure_server.py. Nothing runs until an admin asks:        #
+#                                                                        #
+#    sample    a thread snapshots every thread's stack each              #
+#              SAMPLE_INTERVAL for the window; covers background jobs    #
+#    cprofile  every request handled in the window runs under its own    #
+#              cProfile.Profile; the results are merged at the end       #
+#    memory    tracemalloc on demand; snapshots list the top allocation  #
+#              sites and the growth since the previous snapshot          #
+#    stacks    the current stack of every thread                         #
+#                                                                        #
+#  Reports are text files in REPORT_DIR. When idle, the only cost is     #
+#  the mode check in profiled().                                         #
+# ---------------------------------------------------------------------- #
+
+REPORT_DIR = "profiles"
+SAMPLE_INTERVAL = 0.005   # seconds between stack samples
+MAX_SECONDS = 300         # longest profiling window
+TRACE_FRAMES = 10         # frames kept per allocation while tracing memory
+TOP = 30                  # rows per report section
+
+state = {"mode": None, "report": None, "stop": None, "profiles": [], "last_snapshot": None}
+lock = threading.Lock()
+
+
+def report_path(kind: str) -> str:
+    os.makedirs(REPORT_DIR, exist_ok=True)
+    return os.path.join(REPORT_DIR, f"{datetime.now():%Y%m%d-%H%M%S}-{os.getpid()}-{kind}.txt")
+
+
+def start(mode: str, seconds: float) -> dict:
+    if mode not in ("sample", "cprofile"):
+        return {"ok": False, "error": "bad_mode"}
+    try:
+        seconds = min(max(float(seconds), 0.1), MAX_SECONDS)
+    except (TypeError, ValueError):
+        return {"ok": False, "error": "bad_seconds"}
+
+    with lock:
+        if state["mode"] is not None:
+            return {"ok": False, "error": "already_running", "mode": state["mode"],
+                    "report": state["report"]}
+        state["mode"] = mode
+        state["report"] = report_path(mode)
+        state["stop"] = threading.Event()
+        state["profiles"] = []
+        report, stop = state["report"], state["stop"]
+
+    target = run_sampler if mode == "sample" else run_cprofile
+    threading.Thread(target=target, args=(seconds, stop, report), daemon=True,
+                     name=f"profiler-{mode}").start()
+    return {"ok": True, "mode": mode, "seconds": seconds, "report": report}
+
+
+def stop() -> dict:
+    with lock:
+        if state["mode"] is None:
+            return {"ok": False, "error": "not_running"}
+        state["stop"].set()
+        return {"ok": True, "mode": state["mode"], "report": state["report"]}
+
+
+def finish():
+    with lock:
+        state["mode"] = None
+        state["stop"] = None
+
+
+# request hook: runs fn(*args) under a profiler only inside a cprofile window
+def profiled(fn, *args):
+    if state["mode"] != "cprofile":
+        return fn(*args)
+    prof = cProfile.Profile()
+    try:
+        prof.enable()
+    except ValueError:
+        return fn(*args)  # another profiler owns this thread
+    try:
+        return fn(*args)
+    finally:
+        prof.disable()
+        with lock:
+            if state["mode"] == "cprofile":
+                state["profiles"].append(prof)
+
+
+def run_cprofile(seconds, stop, report):
+    stop.wait(seconds)
+    with lock:
+        profiles = state["profiles"]
+        state["profiles"] = []
+    finish()
+
+    out = io.StringIO()
+    out.write(f"cProfile of {len(profiles)} requests over {seconds:.1f} s or less\n\n")
+    if profiles:
+        stats = pstats.Stats(profiles[0], stream=out)
+        for prof in profiles[1:]:
+            stats.add(prof)
+        stats.sort_stats("cumulative").print_stats(TOP)
+        stats.sort_stats("tottime").print_stats(TOP)
+    with open(report, "w") as f:
+        f.write(out.getvalue())
+
+
+def frame_label(frame) -> str:
+    code = frame.f_code
+    return f"{code.co_name} ({os.path.basename(code.co_filename)}:{frame.f_lineno})"
+
+
+def run_sampler(seconds, stop, report):
+    me = threading.get_ident()
+    names = {}
+    stacks = Counter()       # collapsed stack, outermost first -> samples
+    own = Counter()          # innermost frame -> samples
+    inclusive = Counter()    # any frame on the stack -> samples
+    samples = 0
+    deadline = time.monotonic() + seconds
+
+    while time.monotonic() < deadline and not stop.is_set():
+        names.update((t.ident, t.name) for t in threading.enumerate())
+        for ident, frame in sys._current_frames().items():
+            if ident == me:
+                continue
+            labels = []
+            while frame is not None:
+                labels.append(frame_label(frame))
+                frame = frame.f_back
+            own[labels[0]] += 1
+            inclusive.update(set(labels))
+            labels.reverse()
+            stacks[f"{names.get(ident, ident)};" + ";".join(labels)] += 1
+        samples += 1
+        time.sleep(SAMPLE_INTERVAL)
+    finish()
+
+    with open(report, "w") as f:
+        f.write(f"{samples} samples every {SAMPLE_INTERVAL * 1000:.0f} ms\n\n")
+        f.write("where threads are (innermost frame):\n")
+        for label, n in own.most_common(TOP):
+            f.write(f"{n:>8}  {label}\n")
+        f.write("\non the stack (inclusive):\n")
+        for label, n in inclusive.most_common(TOP):
+            f.write(f"{n:>8}  {label}\n")
+        # "thread;outer;...;inner count" lines, the input of flamegraph tools
+        f.write("\ncollapsed stacks:\n")
+        for stack, n in stacks.most_common():
+            f.write(f"{stack} {n}\n")
+
+
+def memory(op: str, top: int = TOP) -> dict:
+    if op == "start":
+        if not tracemalloc.is_tracing():
+            tracemalloc.start(TRACE_FRAMES)
+        state["last_snapshot"] = None
+        return {"ok": True, "tracing": True}
+    if op == "stop":
+        tracemalloc.stop()
+        state["last_snapshot"] = None
+        return {"ok": True, "tracing": False}
+    if op != "snapshot":
+        return {"ok": False, "error": "bad_op"}
+    if not tracemalloc.is_tracing():
+        return {"ok": False, "error": "not_tracing"}
+
+    snapshot = tracemalloc.take_snapshot().filter_traces(
+        (tracemalloc.Filter(False, tracemalloc.__file__),))
+    previous = state["last_snapshot"]
+    state["last_snapshot"] = snapshot
+    current, peak = tracemalloc.get_traced_memory()
+
+    sites = snapshot.statistics("lineno")[:top]
+    report = report_path("memory")
+    with open(report, "w") as f:
+        f.write(f"traced: {current / 1024:.0f} KiB now, {peak / 1024:.0f} KiB peak\n\n")
+        f.write("top allocation sites:\n")
+        for stat in sites:
+            f.write(f"{stat}\n")
+        if previous is not None:
+            f.write("\ngrowth since the previous snapshot:\n")
+            for stat in snapshot.compare_to(previous, "lineno")[:top]:
+                f.write(f"{stat}\n")
+        f.write("\ntracebacks of the top sites:\n")
+        for stat in snapshot.statistics("traceback")[:min(top, 5)]:
+            f.write(f"\n{stat.size / 1024:.1f} KiB in {stat.count} blocks\n")
+            f.write("\n".join(stat.traceback.format()) + "\n")
+
+    return {
+        "ok": True,
+        "report": report,
+        "traced_kib": round(current / 1024),
+        "peak_kib": round(peak / 1024),
+        "top": [{"site": str(stat.traceback[0]), "kib": round(stat.size / 1024, 1), "count": stat.count}
+                for stat in sites],
+    }
+
+
+def dump_stacks() -> dict:
+    names = {t.ident: t.name for t in threading.enumerate()}
+    frames = sys._current_frames()
+    report = report_path("stacks")
+    with open(report, "w") as f:
+        for ident, frame in frames.items():
+            f.write(f"--- {names.get(ident, '?')} ({ident})\n")
+            f.write("".join(traceback.format_stack(frame)) + "\n")
+    return {"ok": True, "report": report, "threads": len(frames)}
@@ -1,15 +1,205 @@
 import socket
+import base64
 import json
 import os
+import random
+import secrets
+import select
+import struct
+import time
+import zlib
 import tkinter as tk
-from tkinter import messagebox, scrolledtext, filedialog
+from tkinter import messagebox, scrolledtext, filedialog, simpledialog
 from tkinter import ttk
 from datetime import datetime
 
+from cryptography.fernet import Fernet
+
 HOST = "127.0.0.1"
 PORT = 7777
+# read replicas ("--replica-of" servers) as (host, port); reads go to one of
+# them and fall back to HOST:PORT when it is stale, unsynced or down
+READ_REPLICAS: list[tuple[str, int]] = []
+READ_ACTIONS = {"inbox", "conversations", "conversation_detail", "search", "typing_status", "poll",
+                "groups", "group_detail", "presence", "sync"}
+# resent after a dropped connection; a write may already have been applied
+RETRY_ACTIONS = READ_ACTIONS | {"download_file"}
 
 SETTINGS_FILE = "settings.json"
+DEVICE_FILE = "device.id"    # this install's id for the server's per-device sync cursor
+INBOX_PAGE_SIZE = 50
+TYPING_RESEND_SECONDS = 2.0  # "still typing" is re-sent at most this often
+POLL_MIN_MS = 1000           # poll interval right after activity
+POLL_MAX_MS = 10000          # ...backing off to this while nothing happens
+
+
+# codec name -> (marker, decompress); offered to the server in "hello"
+DECOMPRESSORS = {
+    "zlib": (b"Z", zlib.decompress),
+}
+
+
+CHUNK_ZLIB = 0x02  # first byte of a downloaded chunk's plaintext: the rest is compressed
+
+
+# columnar history lists come back as {key: [values...]}
+def unpack_rows(columns: dict) -> list:
+    keys = list(columns)
+    return [dict(zip(keys, values)) for values in zip(*columns.values())]
+
+
+# one persistent socket to the server, reconnected on demand
+class ServerConnection:
+    def __init__(self, host: str, port: int):
+        self.host = host
+        self.port = port
+        self.sock: socket.socket | None = None
+        self.token: str | None = None
+        self.codec: str | None = None
+        # action -> monotonic time before which the server asked us not to retry;
+        # "*" holds off every action after a "busy" answer
+        self.retry_at: dict[str, float] = {}
+
+    def close(self):
+        if self.sock is not None:
+            try:
+                self.sock.close()
+            except OSError:
+                pass
+            self.sock = None
+
+    def _recv_exact(self, n: int) -> bytes:
+        buf = bytearray()
+        while len(buf) < n:
+            chunk = self.sock.recv(n - len(buf))
+            if not chunk:
+                raise ConnectionError("connection closed by server")
+            buf += chunk
+        return bytes(buf)
+
+    def _send_frame(self, body: bytes) -> bytes:
+        # each message is a frame: 4-byte big-endian length + body
+        self.sock.sendall(struct.pack(">I", len(body)) + body)
+        (length,) = struct.unpack(">I", self._recv_exact(4))
+        return self._recv_exact(length)
+
+    def _connect(self):
+        self.sock = socket.create_connection((self.host, self.port))
+        self.codec = None
+        hello = {"action": "hello", "data": {"compression": list(DECOMPRESSORS), "columnar": True}}
+        resp = json.loads(self._send_frame(json.dumps(hello).encode("utf-8")))
+        if resp.get("ok"):
+            self.codec = resp.get("compression")
+
+    def _roundtrip(self, body: bytes) -> bytes:
+        if self.sock is not None and select.select([self.sock], [], [], 0)[0]:
+            # nothing is outstanding, so a readable socket was closed by the
+            # server (restart, idle timeout): reconnect before sending
+            self.close()
+        if self.sock is None:
+            self._connect()
+        resp = self._send_frame(body)
+        if self.codec is None:
+            return resp
+        marker, rest = resp[:1], resp[1:]
+        if marker == b"J":
+            return rest
+        return DECOMPRESSORS[self.codec][1](rest)
+
+    def request(self, payload: dict) -> dict:
+        action = payload.get("action")
+        wait = max(self.retry_at.get(action, 0), self.retry_at.get("*", 0)) - time.monotonic()
+        if wait > 0:
+            # answer locally instead of spending a round trip on a certain refusal
+            return {"ok": False, "error": "rate_limited", "retry_after": wait}
+
+        if self.token:
+            payload["token"] = self.token
+        body = json.dumps(payload).encode("utf-8")
+        try:
+            try:
+                resp_bytes = self._roundtrip(body)
+            except OSError:
+                # lost mid-request: reconnect once, unless resending could
+                # apply a write (send, create_group, ...) a second time
+                self.close()
+                if action not in RETRY_ACTIONS:
+                    raise
+                resp_bytes = self._roundtrip(body)
+            if not resp_bytes:
+                return {"ok": False, "error": "no_response"}
+            resp = json.loads(resp_bytes.decode("utf-8"))
+            for key in ("history", "messages", "results"):
+                if isinstance(resp.get(key), dict):
+                    resp[key] = unpack_rows(resp[key])
+            for chat in resp.get("chats") or []:
+                if isinstance(chat.get("messages"), dict):
+                    chat["messages"] = unpack_rows(chat["messages"])
+            if "retry_after" in resp:
+                scope = "*" if resp.get("error") == "busy" else action
+                self.retry_at[scope] = time.monotonic() + resp["retry_after"]
+            return resp
+        except OSError as e:
+            self.close()
+            return {"ok": False, "error": f"connection_error: {e}"}
+        except (json.JSONDecodeError, zlib.error):
+            return {"ok": False, "error": "invalid_json_response"}
+
+
+    # download_file: the reply is followed by one raw frame per encrypted
+    # chunk, decrypted here with the file's key from the reply
+    def download(self, data: dict, out) -> dict:
+        resp = self.request({"action": "download_file", "data": data})
+        if not resp.get("ok"):
+            return resp
+        if "inline" in resp:
+            out.write(base64.b64decode(resp["inline"]))
+            return resp
+        f = Fernet(resp["key"].encode())
+        skip, remaining = resp["skip"], resp["length"]
+        try:
+            for _ in resp["chunks"]:
+                (n,) = struct.unpack(">I", self._recv_exact(4))
+                plain = f.decrypt(base64.urlsafe_b64encode(self._recv_exact(n)))
+                body = zlib.decompress(plain[1:]) if plain[0] & CHUNK_ZLIB else plain[1:]
+                body = body[skip:skip + remaining]
+                out.write(body)
+                skip = 0
+                remaining -= len(body)
+        except OSError as e:
+            self.close()
+            return {"ok": False, "error": f"connection_error: {e}"}
+        return resp
+
+
+def device_id() -> str:
+    try:
+        with open(DEVICE_FILE, "r") as f:
+            return f.read().strip()
+    except OSError:
+        pass
+    device = secrets.token_hex(8)
+    try:
+        with open(DEVICE_FILE, "w") as f:
+            f.write(device)
+    except OSError:
+        pass
+    return device
+
+
+connection = ServerConnection(HOST, PORT)
+read_connection = ServerConnection(*random.choice(READ_REPLICAS)) if READ_REPLICAS else None
+on_session_expired = None  # set by the app; called when the server stops accepting our token
+
+
+# "invalid_session": the token expired or was revoked (logout_all from
+# another device). Forget it once and let the app ask for a new login.
+def check_session(resp: dict) -> dict:
+    if resp.get("error") == "invalid_session" and connection.token:
+        connection.token = None
+        if on_session_expired is not None:
+            on_session_expired()
+    return resp
 
 
 def send_request(action: str, username: str | None, data: dict | None = None) -> dict:
@@ -18,17 +208,91 @@ def send_request(action: str, username: str | None, data: dict | None = None) ->
         "username": username,
         "data": data or {},
     }
-    try:
-        with socket.create_connection((HOST, PORT)) as sock:
-            sock.sendall(json.dumps(payload).encode("utf-8"))
-            resp_bytes = sock.recv(65536)
-            if not resp_bytes:
-                return {"ok": False, "error": "no_response"}
-            return json.loads(resp_bytes.decode("utf-8"))
-    except OSError as e:
-        return {"ok": False, "error": f"connection_error: {e}"}
-    except json.JSONDecodeError:
-        return {"ok": False, "error": "invalid_json_response"}
+    if read_connection is not None and action in READ_ACTIONS and connection.token:
+        read_connection.token = connection.token
+        resp = read_connection.request(dict(payload))
+        if resp.get("ok"):
+            return resp
+    return check_session(connection.request(payload))
+
+
+# Saves a file from a chat to `path`. It is written to path + ".part"
+# first, and an interrupted download resumes from what that holds.
+def download_file(data: dict, path: str) -> dict:
+    part = path + ".part"
+    offset = os.path.getsize(part) if os.path.exists(part) else 0
+    with open(part, "ab") as out:
+        while True:
+            resp = connection.download(dict(data, offset=offset), out)
+            if not resp.get("ok"):
+                return check_session(resp)
+            offset += resp["length"]
+            if offset >= resp["size"] or not resp["length"]:
+                break
+    os.replace(part, path)
+    return resp
+
+
+# One "poll" request for all open chat windows. The interval starts at
+# POLL_MIN_MS and grows by half each quiet round up to POLL_MAX_MS; new
+# messages, typing, or poke() (the user sent something) reset it. It keeps
+# polling with no window open: that keeps us online for the server, and
+# the replies carry our contacts' presence changes.
+class ChatPoller:
+    def __init__(self, master):
+        self.master = master
+        self.chats = {}  # peer or "#group" -> {"after": cseq, "on_update": callback(chat)}
+        self.username = None
+        self.interval = POLL_MIN_MS
+        self.pending = None
+        self.presence = {}  # peer -> {"online", "last_seen"}
+
+    def add(self, peer, after, on_update):
+        self.chats[peer] = {"after": after, "on_update": on_update}
+        self.poke()
+
+    def remove(self, peer, on_update):
+        # a second window for the same peer replaced this one; keep it
+        if peer in self.chats and self.chats[peer]["on_update"] is on_update:
+            del self.chats[peer]
+
+    def refresh_presence(self):
+        resp = send_request("presence", self.username)
+        if resp.get("ok"):
+            self.presence = resp.get("presence", {})
+
+    def poke(self):
+        self.interval = POLL_MIN_MS
+        self.schedule(0)
+
+    def schedule(self, delay):
+        if self.pending is not None:
+            self.master.after_cancel(self.pending)
+        self.pending = self.master.after(delay, self.poll)
+
+    def poll(self):
+        self.pending = None
+        if not self.username:
+            return
+
+        chats = [{"group" if peer.startswith("#") else "peer": peer, "after": c["after"]}
+                 for peer, c in self.chats.items()]
+        resp = send_request("poll", self.username, {"chats": chats})
+        active = False
+        if resp.get("ok"):
+            self.presence.update(resp.get("presence", {}))
+            for chat in resp.get("chats", []):
+                entry = self.chats.get(chat.get("peer") or chat.get("group"))
+                if entry is None:
+                    continue
+                entry["after"] = chat.get("cursor", entry["after"])
+                active = active or bool(chat.get("messages")) or bool(chat.get("typing"))
+                entry["on_update"](chat)
+
+        self.interval = POLL_MIN_MS if active else min(int(self.interval * 1.5), POLL_MAX_MS)
+        if resp.get("retry_after"):
+            self.interval = max(self.interval, int(resp["retry_after"] * 1000))
+        self.schedule(self.interval)
 
 
 class SecureDMApp:
@@ -37,6 +301,11 @@ class SecureDMApp:
         self.master.title("🥧PYchat🥧")
 
         self.username: str | None = None
+        self.inbox_cursor: str | None = None
+        self.inbox_shown = 0
+        self.poller = ChatPoller(master)
+        global on_session_expired
+        on_session_expired = self.session_expired
 
         # ========== SETTINGS / THEME ==========
         self.settings = self.load_settings()
@@ -200,6 +469,12 @@ class SecureDMApp:
         self.search_btn = ttk.Button(self.inbox_box, text="Search", command=self.open_search_window, style="Accent.TButton")
         self.search_btn.grid(row=0, column=3, padx=5, pady=6)
 
+        self.groups_btn = ttk.Button(self.inbox_box, text="Groups", command=self.load_groups, style="Accent.TButton")
+        self.groups_btn.grid(row=0, column=4, padx=5, pady=6)
+
+        self.new_group_btn = ttk.Button(self.inbox_box, text="New Group", command=self.create_group, style="Accent.TButton")
+        self.new_group_btn.grid(row=0, column=5, padx=5, pady=6)
+
         self.output = scrolledtext.ScrolledText(
             self.inbox_box,
             width=95,
@@ -565,6 +840,11 @@ class SecureDMApp:
         resp = send_request("login", None, {"user": user, "pw": pw})
         if resp.get("ok"):
             self.username = user
+            self.poller.username = user
+            connection.token = resp.get("token")
+            self.poller.refresh_presence()
+            self.poller.poke()
+            self.catch_up()
             self.append_output(f"✔ Logged in as {user}")
             self.set_status("Logged in")
 
@@ -599,12 +879,61 @@ class SecureDMApp:
                 self.append_output("✘ " + str(err))
             self.set_status("Login failed")
 
+    # what arrived since this device last synced, however long ago
+    def catch_up(self):
+        device = device_id()
+        received = {}
+        sent_elsewhere = 0
+        cursor = None
+        while True:
+            data = {"device": device}
+            if cursor:
+                data["cursor"] = cursor
+            resp = send_request("sync", self.username, data)
+            if not resp.get("ok"):
+                return
+            for msg in resp.get("messages", []):
+                if msg.get("from") == self.username:
+                    sent_elsewhere += 1
+                else:
+                    received[msg.get("peer")] = received.get(msg.get("peer"), 0) + 1
+            cursor = resp.get("cursor")
+            if not resp.get("more"):
+                break
+        if received:
+            who = ", ".join(f"{peer} {n}" for peer, n in received.items())
+            self.append_output(f"• While you were away: {sum(received.values())} new messages ({who})")
+        if sent_elsewhere:
+            self.append_output(f"• {sent_elsewhere} messages sent from your other devices")
+
     def logout_user(self):
         if not self.username:
             return
+        send_request("logout", self.username)
+        self.end_session("Logged out", "• Logged out. Please log in again.")
+
+    # the server rejected our token; the reply is handled first, then this
+    def session_expired(self):
+        self.master.after(0, self.show_session_expired)
+
+    def show_session_expired(self):
+        if not self.username:
+            return
+        self.end_session("Session expired", "• Your session ended. Please log in again.")
+        messagebox.showinfo(
+            "Session expired",
+            "Your session has expired or was logged out from another device.\nPlease log in again."
+        )
+
+    def end_session(self, status, note):
+        connection.token = None
         self.username = None
-        self.set_status("Logged out")
-        self.append_output("• Logged out. Please log in again.")
+        self.poller.username = None
+        self.poller.presence = {}
+        self.inbox_cursor = None
+        self.inbox_shown = 0
+        self.set_status(status)
+        self.append_output(note)
         self.username_entry.delete(0, "end")
         self.password_entry.delete(0, "end")
         self.user_label.pack_forget()
@@ -637,21 +966,31 @@ class SecureDMApp:
         if not self.username:
             messagebox.showwarning("Not logged in", "Please log in first.")
             return
-        resp = send_request("inbox", self.username, {})
+        data = {"limit": INBOX_PAGE_SIZE}
+        if self.inbox_cursor:
+            data["cursor"] = self.inbox_cursor
+        resp = send_request("inbox", self.username, data)
         if not resp.get("ok"):
             self.append_output("✘ " + str(resp.get("error")))
             return
+        first = self.inbox_shown + 1
+        self.inbox_cursor = resp.get("next_cursor")
         messages = resp.get("messages", [])
-        if not messages:
+        if not messages and first == 1:
             self.append_output("• Inbox: (empty)")
             return
-        self.append_output("• Inbox:")
-        for i, msg in enumerate(messages, start=1):
+        self.append_output("• Inbox:" if first == 1 else "• Inbox (continued):")
+        for i, msg in enumerate(messages, start=first):
             sender = msg.get("from", "?")
             text = msg.get("msg", "")
             ts = msg.get("timestamp", "")
             friendly = self.format_friendly_time(ts)
             self.append_output(f"  {i}. [{friendly}] from {sender}: {text}")
+        if self.inbox_cursor:
+            self.inbox_shown += len(messages)
+            self.append_output("  … more messages, press Inbox again for the next page")
+        else:
+            self.inbox_shown = 0
 
     def load_conversations(self):
         if not self.username:
@@ -661,6 +1000,7 @@ class SecureDMApp:
         if not resp.get("ok"):
             self.append_output("✘ " + str(resp.get("error")))
             return
+        self.poller.refresh_presence()
         conversations = resp.get("conversations", [])
         if not conversations:
             self.append_output("• No conversations yet")
@@ -673,12 +1013,54 @@ class SecureDMApp:
             last_ts = conv.get("last_ts", "")
             preview = conv.get("last_preview", "")
             friendly = self.format_friendly_time(last_ts) if last_ts else ""
+            online = " ●" if self.poller.presence.get(peer, {}).get("online") else ""
             self.append_output(
-                f"  {i}. {peer} | total: {total}, unread: {unread}, last: {friendly}"
+                f"  {i}. {peer}{online} | total: {total}, unread: {unread}, last: {friendly}"
             )
             if preview:
                 self.append_output(f"       last msg: {preview}")
 
+    # ========== GROUPS ==========
+    def load_groups(self):
+        if not self.username:
+            messagebox.showwarning("Not logged in", "Please log in first.")
+            return
+        resp = send_request("groups", self.username, {})
+        if not resp.get("ok"):
+            self.append_output("✘ " + str(resp.get("error")))
+            return
+        groups = resp.get("groups", [])
+        if not groups:
+            self.append_output("• No groups yet")
+            return
+        self.append_output("• Groups (type the #id in 'To:' and press Open Chat):")
+        for i, group in enumerate(groups, start=1):
+            last_ts = group.get("last_ts") or ""
+            friendly = self.format_friendly_time(last_ts) if last_ts else ""
+            self.append_output(
+                f"  {i}. {group.get('name')} ({group.get('group')}) | "
+                f"{len(group.get('members', []))} members, unread: {group.get('unread', 0)}, last: {friendly}"
+            )
+            if group.get("last_preview"):
+                self.append_output(f"       {group.get('last_from')}: {group.get('last_preview')}")
+
+    def create_group(self):
+        if not self.username:
+            messagebox.showwarning("Not logged in", "Please log in first.")
+            return
+        name = simpledialog.askstring("New group", "Group name:", parent=self.master)
+        if not name:
+            return
+        members = simpledialog.askstring("New group", "Members (comma separated):", parent=self.master) or ""
+        members = [m.strip() for m in members.split(",") if m.strip()]
+        resp = send_request("create_group", self.username, {"name": name, "members": members})
+        if resp.get("ok"):
+            self.append_output(f"✔ Group {name} created: {resp.get('group')}")
+            self.to_entry.delete(0, "end")
+            self.to_entry.insert(0, resp.get("group"))
+        else:
+            self.append_output("✘ " + str(resp.get("error")))
+
     # ========== SEARCH ==========
     def open_search_window(self):
         if not self.username:
@@ -745,7 +1127,12 @@ class SecureDMApp:
             messagebox.showwarning("Missing info", "Type a username in 'To:' first.")
             return
 
-        resp = send_request("conversation_detail", self.username, {"peer": peer})
+        # "#..." names a group: one shared log, no typing or clearing
+        is_group = peer.startswith("#")
+        if is_group:
+            resp = send_request("group_detail", self.username, {"group": peer})
+        else:
+            resp = send_request("conversation_detail", self.username, {"peer": peer})
         if not resp.get("ok"):
             messagebox.showerror("Chat error", str(resp.get("error")))
             return
@@ -753,7 +1140,7 @@ class SecureDMApp:
         history = resp.get("history", [])
 
         win = tk.Toplevel(self.master)
-        win.title(f"Chat with {peer}")
+        win.title(f"Group {resp.get('name')}" if is_group else f"Chat with {peer}")
         win.configure(bg=self.bg_color)
         self.center_window_over_parent(win, width=900, height=600)
 
@@ -780,7 +1167,8 @@ class SecureDMApp:
                 ts = msg.get("timestamp", "")
                 friendly = self.format_friendly_time(ts)
                 label = "You" if sender == self.username else sender
-                chat_text.insert("end", f"[{friendly}] {label}: {text}\n")
+                seen = " ✓" if sender == self.username and msg.get("read") else ""
+                chat_text.insert("end", f"[{friendly}] {label}: {text}{seen}\n")
             chat_text.config(state="disabled")
 
         render_history()
@@ -798,24 +1186,40 @@ class SecureDMApp:
             fg=self.text_fg,
             font=("Helvetica", self.font_size - 1),
         )
-        typing_label.grid(row=1, column=0, columnspan=4, sticky="w", padx=4, pady=(2, 0))
-
-        def refresh_history():
-            resp_r = send_request("conversation_detail", self.username, {"peer": peer})
-            if not resp_r.get("ok"):
-                return
-            history_holder["history"] = resp_r.get("history", [])
+        typing_label.grid(row=1, column=0, columnspan=5, sticky="w", padx=4, pady=(2, 0))
+
+        def on_poll(chat):
+            rows = history_holder["history"]
+            deleted_upto = chat.get("deleted_upto", 0)
+            if deleted_upto:
+                rows = [m for m in rows if m.get("cseq", 0) > deleted_upto]
+            read_upto = chat.get("peer_read_upto", 0)
+            for m in rows:
+                if m.get("seq") is not None:  # outbound; columnar rows carry None elsewhere
+                    m["read"] = m["seq"] <= read_upto
+            rows.extend(chat.get("messages", []))
+            history_holder["history"] = rows
+            typing_label.config(text=f"{peer} is typing..." if chat.get("typing") else "")
+            state = self.poller.presence.get(peer)
+            if state and state.get("online"):
+                win.title(f"Chat with {peer} (online)")
+            elif state and state.get("last_seen"):
+                win.title(f"Chat with {peer} (last seen {self.format_friendly_time(state['last_seen'])})")
             render_history()
 
         def send_from_chat(event=None):
             msg = entry.get().strip()
             if not msg:
                 return
-            resp2 = send_request("send", self.username, {"to": peer, "msg": msg})
+            if is_group:
+                resp2 = send_request("send_group", self.username, {"group": peer, "msg": msg})
+            else:
+                resp2 = send_request("send", self.username, {"to": peer, "msg": msg})
             if resp2.get("ok"):
                 entry.delete(0, "end")
-                send_request("typing", self.username, {"peer": peer, "is_typing": False})
-                refresh_history()
+                if not is_group:
+                    send_request("typing", self.username, {"peer": peer, "is_typing": False})
+                self.poller.poke()
             else:
                 messagebox.showerror("Send failed", str(resp2.get("error")))
 
@@ -835,7 +1239,16 @@ class SecureDMApp:
                 else:
                     messagebox.showerror("Delete failed", str(respd.get("error")))
 
-        clear_btn = ttk.Button(bottom_frame, text="Clear Chat", command=clear_conversation)
+        def leave_group():
+            if messagebox.askyesno("Leave group", f"Leave {resp.get('name')}?"):
+                respl = send_request("leave_group", self.username, {"group": peer})
+                if respl.get("ok"):
+                    win.destroy()
+                else:
+                    messagebox.showerror("Leave failed", str(respl.get("error")))
+
+        clear_btn = ttk.Button(bottom_frame, text="Leave Group" if is_group else "Clear Chat",
+                               command=leave_group if is_group else clear_conversation)
         clear_btn.grid(row=0, column=2, padx=4)
 
         def export_chat():
@@ -865,31 +1278,69 @@ class SecureDMApp:
         export_btn = ttk.Button(bottom_frame, text="Export to TXT", command=export_chat)
         export_btn.grid(row=0, column=3, padx=4)
 
-        def poll_typing_and_refresh():
-            refresh_history()
-            resp_t = send_request("typing_status", self.username, {"peer": peer})
-            if resp_t.get("ok") and resp_t.get("typing"):
-                typing_label.config(text=f"{peer} is typing...")
+        def save_file():
+            files = [m for m in history_holder["history"] if m.get("file") is not None]
+            if not files:
+                messagebox.showinfo("Download", "No files in this chat.", parent=win)
+                return
+            choice = len(files)
+            if len(files) > 1:
+                listing = "\n".join(f"{i}. {m.get('filename')} ({m.get('from')})"
+                                     for i, m in enumerate(files, start=1))
+                choice = simpledialog.askinteger("Download", f"{listing}\n\nFile number:", parent=win,
+                                                 minvalue=1, maxvalue=len(files), initialvalue=len(files))
+                if not choice:
+                    return
+            msg = files[choice - 1]
+            path = filedialog.asksaveasfilename(parent=win, title="Save file",
+                                                initialfile=msg.get("filename") or "download")
+            if not path:
+                return
+            data = {"file": msg["file"], "group" if is_group else "peer": peer}
+            respf = download_file(data, path)
+            if respf.get("ok"):
+                messagebox.showinfo("Download", f"Saved to:\n{path}", parent=win)
             else:
-                typing_label.config(text="")
-            if win.winfo_exists():
-                win.after(3000, poll_typing_and_refresh)
+                messagebox.showerror("Download failed", str(respf.get("error")), parent=win)
+
+        download_btn = ttk.Button(bottom_frame, text="Download File", command=save_file)
+        download_btn.grid(row=0, column=4, padx=4)
+
+        typing_sent = {"at": 0.0}
 
         def on_keypress(event):
+            if is_group:
+                return
+            now = time.monotonic()
+            if now - typing_sent["at"] < TYPING_RESEND_SECONDS:
+                return
             if entry.get().strip() or event.char.strip():
+                typing_sent["at"] = now
                 send_request("typing", self.username, {"peer": peer, "is_typing": True})
 
         def on_focus_out(event):
+            if is_group:
+                return
+            typing_sent["at"] = 0.0
             send_request("typing", self.username, {"peer": peer, "is_typing": False})
 
         entry.bind("<Return>", send_from_chat)
         entry.bind("<KeyPress>", on_keypress)
         entry.bind("<FocusOut>", on_focus_out)
 
-        poll_typing_and_refresh()
+        def on_destroy(event):
+            if event.widget is win:
+                self.poller.remove(peer, on_poll)
+
+        win.bind("<Destroy>", on_destroy)
+        cursor = max((m.get("cseq", 0) for m in history), default=0)
+        self.poller.add(peer, cursor, on_poll)
 
     # ========== CLOSE ==========
     def on_close(self):
+        connection.close()
+        if read_connection is not None:
+            read_connection.close()
         self.master.destroy()
 
 
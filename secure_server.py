@@ -1,20 +1,110 @@
 import socket
 import threading
 import json
-from cryptography.fernet import Fernet
+import time
+import traceback
+import argparse
+import base64
+import binascii
+import bisect
+import hashlib
+import heapq
+import hmac
+import itertools
+import multiprocessing
+import secrets
+import struct
+import zlib
+from collections import OrderedDict
+from operator import attrgetter, itemgetter
+from concurrent.futures import ThreadPoolExecutor
+from cryptography.fernet import Fernet, MultiFernet, InvalidToken
 import os
+import queue
+import resource
+import sys
 from datetime import datetime, timedelta
 
+import db_format
+import profiling
+import traffic
+from db_format import Message, FLAG_RAW_FILE, FLAG_ZLIB, FLAG_ATTACHMENT, ts_from_ns, ts_to_ns
+
 HOST = "127.0.0.1"
 PORT = 7777
 
-DB_FILE = "secure_db.json"
+DB_FILE = "secure_db.bin"
+LEGACY_DB_FILE = "secure_db.json"  # read once if there is no secure_db.bin yet
 KEY_FILE = "secret.key"
+ATTACH_DIR = "attachments"        # one file per sent file, see store_attachment
 LOG_FILE = "server_log.txt"
 
 LOCKOUT_MINUTES = 10
 MIN_PASSWORD_LENGTH = 6
 
+# background re-encryption after a key rotation
+REKEY_BATCH_SIZE = 200            # messages re-encrypted per batch
+REKEY_IO_BUDGET = 2_000_000       # max bytes/sec of DB writes spent on re-encryption
+REKEY_CHECK_SECONDS = 30          # how often secret.key is checked for a new key
+
+COMPACT_IO_BUDGET = 2_000_000     # max bytes/sec of DB writes spent on compaction
+COMPACT_CHECK_SECONDS = 60        # compactor wake-up when no delete nudges it
+
+# password hashing (PBKDF2-HMAC-SHA256); `python benchmarks.py hash` shows the cost
+PBKDF2_ITERATIONS = 200_000       # work factor; older hashes are upgraded on next login
+HASH_WORKERS = 4                  # threads verifying/creating password hashes
+LOGIN_CACHE_SIZE = 1024           # remembered successful logins
+LOGIN_CACHE_SECONDS = 600
+
+SESSION_TTL_SECONDS = 12 * 3600   # idle time before a session token expires
+SESSION_SWEEP_SECONDS = 60        # how often expired sessions are purged
+
+MAX_FRAME_SIZE = 16 * 1024 * 1024
+
+COMPRESS_THRESHOLD = 1024         # responses smaller than this are sent as-is
+COMPRESS_LEVEL = 6
+
+STORE_COMPRESS_THRESHOLD = 256    # message/file plaintexts this long are compressed before encryption
+STORE_COMPRESS_LEVEL = 6
+STORE_COMPRESS_SAMPLE = 4096      # bytes test-compressed before compressing a large input
+
+ATTACH_CHUNK_SIZE = 64 * 1024     # plaintext bytes per encrypted attachment chunk
+DOWNLOAD_MAX_BYTES = 16 * 1024 * 1024  # plaintext bytes one download_file reply may cover
+
+INBOX_PAGE_SIZE = 50              # default inbox page when the client sends no limit
+INBOX_MAX_PAGE = 200
+POLL_MAX_CHATS = 50               # open chats one poll request may cover
+GROUP_MAX_MEMBERS = 256
+SYNC_PAGE_SIZE = 200              # messages per sync reply
+MAX_DEVICES = 20                  # sync cursors kept per user, least recently used dropped
+
+INBOX_MEMORY_BUDGET = 256 * 1024 * 1024  # decoded inboxes kept in memory (estimate, bytes)
+
+# per-user token buckets: action -> (requests/sec refill, burst size)
+RATE_LIMITS = {
+    "default": (10.0, 40),
+    "send": (2.0, 10),
+    "send_file": (0.5, 3),
+    "send_group": (2.0, 10),
+    "create_group": (0.2, 3),
+    "typing": (1.0, 5),
+    "search": (1.0, 5),
+    "delete_conversation": (0.2, 3),
+    "login": (0.5, 5),                # keyed by client address, not user
+    "register": (0.1, 3),
+}
+MAX_IN_FLIGHT = 32                # requests executing at once, across all users
+QUEUE_TIMEOUT = 2.0               # wait for a free slot before answering "busy"
+
+ADMIN_USERS = set()               # may run the profiling actions; see --admin
+
+PRESENCE_TTL_SECONDS = 30        # a connection idle this long no longer counts as online
+PRESENCE_FLUSH_SECONDS = 1.0      # presence changes are batched over this interval
+
+REPLICA_HEARTBEAT_SECONDS = 1.0   # the primary stamps its op stream this often
+REPLICA_MAX_LAG_SECONDS = 5.0     # a replica further behind than this refuses reads
+REPLICA_QUEUE_MAX = 10_000        # ops buffered per replica before it is dropped
+
 
 def log(msg: str):
     ts = datetime.now().isoformat(timespec="seconds")
@@ -22,43 +112,532 @@ def log(msg: str):
         f.write(f"[{ts}] {msg}\n")
 
 
-def load_key():
-    if not os.path.exists(KEY_FILE):
-        key = Fernet.generate_key()
-        with open(KEY_FILE, "wb") as f:
-            f.write(key)
-        log("Generated new secret.key")
-    else:
-        with open(KEY_FILE, "rb") as f:
-            key = f.read()
-    return Fernet(key)
+# secret.key holds one "<kid>:<key>" line per key. The last line is the
+# active key used for new writes; older keys stay so existing messages
+# remain readable until the re-encryption job has migrated them.
+# A legacy single-key file is read as key id "0".
 
+def read_key_file():
+    keys = []
+    with open(KEY_FILE, "rb") as f:
+        for line in f.read().decode().splitlines():
+            line = line.strip()
+            if not line:
+                continue
+            if ":" in line:
+                kid, key = line.split(":", 1)
+            else:
+                kid, key = str(len(keys)), line
+            keys.append((kid, key.encode()))
+    return keys
 
-fernet = load_key()
 
+def load_keyring():
+    if not os.path.exists(KEY_FILE):
+        with open(KEY_FILE, "wb") as f:
+            f.write(b"0:" + Fernet.generate_key() + b"\n")
+        log("Generated new secret.key")
 
-def load_db():
-    if not os.path.exists(DB_FILE):
-        return {"users": {}, "messages": {}, "typing": {}}
+    keys = read_key_file()
+    fernets = {kid: Fernet(key) for kid, key in keys}
+    return {
+        "active": keys[-1][0],
+        "keys": fernets,
+        # newest first, for records that carry no key id
+        "multi": MultiFernet([fernets[kid] for kid, _ in reversed(keys)]),
+        "mtime": os.path.getmtime(KEY_FILE),
+    }
+
+
+def rotate_key():
+    load_keyring()  # creates the file on first use
+    with open(KEY_FILE, "rb") as f:
+        ends_with_newline = f.read().endswith(b"\n")
+    keys = read_key_file()
+    kid = str(max((int(k) for k, _ in keys if k.isdigit()), default=-1) + 1)
+    with open(KEY_FILE, "ab") as f:
+        if not ends_with_newline:
+            f.write(b"\n")
+        f.write(kid.encode() + b":" + Fernet.generate_key() + b"\n")
+    log(f"Rotated secret.key, new active key id {kid}")
+    return kid
+
+
+keyring = None  # loaded by main(), so importing this module touches no files
+
+
+# messages keep the raw token bytes; Fernet wants the base64 form
+# Ciphertext does not compress, so long plaintexts are compressed before
+# encryption, and only when that saves at least an eighth (FLAG_ZLIB).
+# Large inputs are tried on a sample first, so images and archives cost
+# one small compress call, not a full one.
+def pack_plaintext(data: bytes):
+    if len(data) >= STORE_COMPRESS_THRESHOLD:
+        if len(data) > 4 * STORE_COMPRESS_SAMPLE:
+            sample = data[:STORE_COMPRESS_SAMPLE]
+            if len(zlib.compress(sample, 1)) > len(sample) - len(sample) // 8:
+                return data, 0
+        packed = zlib.compress(data, STORE_COMPRESS_LEVEL)
+        if len(packed) <= len(data) - len(data) // 8:
+            return packed, FLAG_ZLIB
+    return data, 0
+
+
+# returns (kid, ciphertext, flags)
+def encrypt_message(data: bytes):
+    data, flags = pack_plaintext(data)
+    kid = keyring["active"]
+    return kid, base64.urlsafe_b64decode(keyring["keys"][kid].encrypt(data)), flags
+
+
+# A record under a key this replica does not have, typically because its
+# secret.key was not updated after --rotate-key. Requests answer
+# "key_missing" instead of showing "[decrypt error]", so clients go to
+# the primary. The primary has no one to defer to: there such a record
+# is unreadable like any other and shows as "[decrypt error]".
+class KeyMissing(Exception):
+    pass
+
+
+# a damaged record; reads show it as "[decrypt error]"
+DECRYPT_ERRORS = (InvalidToken, ValueError, zlib.error)
+
+
+# the plaintext as stored, still compressed if FLAG_ZLIB is set
+def decrypt_stored(msg: Message) -> bytes:
+    f = keyring["keys"].get(msg.kid)
+    if f is None:
+        try:
+            return keyring["multi"].decrypt(msg.token)
+        except InvalidToken:
+            if role != "replica":
+                raise
+            raise KeyMissing(msg.kid) from None
+    return f.decrypt(msg.token)
+
+
+def decrypt_message(msg: Message) -> bytes:
+    data = decrypt_stored(msg)
+    if msg.flags & FLAG_ZLIB:
+        return zlib.decompress(data)
+    return data
+
+
+# Sent files go to ATTACH_DIR in ATTACH_CHUNK_SIZE chunks, encrypted with a
+# key of that file's own (the data key). The message holds only the
+# descriptor {"id", "size", "key"}, encrypted with the server key like any
+# message, so key rotation re-wraps the data key and never rewrites the
+# file. A chunk's plaintext is one flags byte (FLAG_ZLIB or 0) + its data.
+def attachment_path(att_id):
+    return os.path.join(ATTACH_DIR, att_id + ".bin")
+
+
+# returns the descriptor, to be stored as the message's plaintext
+def store_attachment(content: bytes) -> bytes:
+    key = Fernet.generate_key()
+    f = Fernet(key)
+    tokens = []
+    for i in range(0, len(content), ATTACH_CHUNK_SIZE):
+        packed, flags = pack_plaintext(content[i:i + ATTACH_CHUNK_SIZE])
+        tokens.append(base64.urlsafe_b64decode(f.encrypt(bytes([flags]) + packed)))
+    att_id = secrets.token_hex(16)
+    os.makedirs(ATTACH_DIR, exist_ok=True)
+    db_format.write_attachment(attachment_path(att_id), ATTACH_CHUNK_SIZE, len(content), tokens)
+    return json.dumps({"id": att_id, "size": len(content), "key": key.decode()}).encode()
+
+
+def delete_attachment(msg: Message):
+    try:
+        os.remove(attachment_path(json.loads(decrypt_message(msg))["id"]))
+    except (OSError, KeyError, KeyMissing, *DECRYPT_ERRORS):
+        pass
 
-    with open(DB_FILE, "r") as f:
-        db = json.load(f)
 
+def prepare_meta(db):
     db.setdefault("users", {})
     db.setdefault("messages", {})
-    db.setdefault("typing", {})
+    db["typing"] = {}  # in memory only; older files may still hold some
+    db.setdefault("delivered", {})
+    db.setdefault("read_upto", {})
+    db.setdefault("gseq", 0)
+    db.setdefault("cseq", {})
+    db.setdefault("tombstones", {})
+    db.setdefault("cleared", {})
+    for lo, peers in db["tombstones"].items():
+        for hi, upto in peers.items():
+            cleared = db["cleared"].setdefault(lo, {})
+            cleared[hi] = max(cleared.get(hi, 0), upto)
+    db.setdefault("groups", {})
+    db.setdefault("feed", {})
+    db.setdefault("change_seq", 0)
+    db.setdefault("devices", {})
 
     # migrate old user structure
     for u, rec in list(db["users"].items()):
         if isinstance(rec, str):
             db["users"][u] = {"pw": rec, "strikes": 0, "locked_until": None}
 
+
+# lazy: read users and read state only, and page inboxes in from the
+# file on first access (see db_format.LazyInboxes)
+def load_db(lazy=False):
+    if lazy and os.path.exists(DB_FILE):
+        db = db_format.load_lazy(DB_FILE, INBOX_MEMORY_BUDGET)
+        if db is not None:
+            prepare_meta(db)
+            return db
+
+    if os.path.exists(DB_FILE):
+        db = db_format.load(DB_FILE)
+    elif os.path.exists(LEGACY_DB_FILE):
+        # written back as secure_db.bin on the first save
+        with open(LEGACY_DB_FILE, "r") as f:
+            db = json.load(f)
+        log(f"Loaded legacy {LEGACY_DB_FILE}, converting to {DB_FILE}")
+    else:
+        return {"users": {}, "messages": {}, "typing": {}, "delivered": {}, "read_upto": {},
+                "gseq": 0, "cseq": {}, "tombstones": {}, "cleared": {}, "groups": {},
+                "feed": {}, "change_seq": 0, "devices": {}}
+
+    migrate_db(db)
     return db
 
 
+# Upgrades a DB from any earlier layout, in place; db_format's converter
+# runs it too. Legacy JSON messages: per-message read flags become
+# watermarks, then the dicts become Message objects. Records from before
+# cseq/gseq (legacy JSON, binary version 1) are numbered.
+def migrate_db(db):
+    prepare_meta(db)
+    for receiver, inbox in db["messages"].items():
+        for i, msg in enumerate(inbox):
+            # not isinstance(msg, Message): run as a script, db_format has
+            # its own copy of the class
+            if not isinstance(msg, dict):
+                continue
+            if "seq" not in msg:
+                msg["seq"] = next_seq(db, receiver, msg.get("from"))
+                if msg.pop("read", False):
+                    mark_read(db, receiver, msg.get("from"), msg["seq"])
+            inbox[i] = db_format.message_from_dict(msg)
+
+    number_messages(db)
+
+
+# ---------------------------------------------------------------------- #
+#  Every change to the shared state is also described as an "op" tuple  #
+#  and passed to publish(). With --workers the owner process sends the   #
+#  ops to each worker, which replays them with apply_op (see WORKER      #
+#  PROCESSES). A single process has no subscribers and publish is free.  #
+# ---------------------------------------------------------------------- #
+subscribers = []  # callables taking an op
+publish_lock = threading.Lock()
+role = "single"   # "single", "owner", "worker" or "replica"
+upstream = None   # worker/replica: sends an op to the owner instead of applying it
+
+
+def publish(op):
+    with publish_lock:
+        for send in list(subscribers):  # a lagging replica removes itself
+            send(op)
+
+
+# Read state is a watermark per (reader, peer): every message gets the next
+# sequence number of its peer -> receiver direction, delivered[user][peer]
+# is the last one handed out and read_upto[user][peer] the last one read.
+
+def next_seq(db, receiver, sender):
+    delivered = db["delivered"].setdefault(receiver, {})
+    delivered[sender] = delivered.get(sender, 0) + 1
+    return delivered[sender]
+
+
+# gseq orders all messages server-wide, cseq the messages of one
+# conversation (both directions); neither needs a timestamp comparison
+def next_gseq(db):
+    db["gseq"] += 1
+    return db["gseq"]
+
+
+def next_cseq(db, a, b):
+    lo, hi = sorted((a, b))
+    counters = db["cseq"].setdefault(lo, {})
+    counters[hi] = counters.get(hi, 0) + 1
+    return counters[hi]
+
+
+def new_message(db, sender, receiver, kind, kid, ct, filename=None, flags=0):
+    msg = Message(sender, time.time_ns(), next_seq(db, receiver, sender), kind, kid, ct,
+                  filename, flags, next_cseq(db, sender, receiver), next_gseq(db))
+    db["messages"].setdefault(receiver, []).append(msg)
+    add_watcher(receiver, sender)
+    publish(("msg", receiver, msg.sender, msg.ts, msg.seq, msg.cseq, msg.gseq,
+             msg.kind, msg.kid, msg.ct, msg.filename, msg.flags))
+    return msg
+
+
+# delete_conversation records a tombstone, "cseq <= N of this conversation
+# is gone", instead of rewriting both inboxes. Reads skip covered
+# messages; the compactor removes them in the background. "cleared"
+# keeps the same N after compaction drops the tombstone, for devices
+# that sync later (see feed_value).
+def tombstone(db, a, b):
+    lo, hi = sorted((a, b))
+    return db["tombstones"].get(lo, {}).get(hi, 0)
+
+
+def cleared_upto(db, a, b):
+    lo, hi = sorted((a, b))
+    return db["cleared"].get(lo, {}).get(hi, 0)
+
+
+def add_tombstone(db, a, b):
+    lo, hi = sorted((a, b))
+    upto = db["tombstones"].setdefault(lo, {})[hi] = db["cseq"].get(lo, {}).get(hi, 0)
+    db["cleared"].setdefault(lo, {})[hi] = upto
+    compact_pending.update((a, b))
+    publish(("tombstone", lo, hi, upto))
+    note_change(db, (a, "clear:" + b), (b, "clear:" + a))
+
+
+# returns msg -> bool for one receiver's inbox, False when tombstoned
+def visible(db, receiver):
+    if not db["tombstones"]:
+        return lambda msg: True
+    upto = {}
+
+    def check(msg):
+        n = upto.get(msg.sender)
+        if n is None:
+            n = upto[msg.sender] = tombstone(db, msg.sender, receiver)
+        return msg.cseq > n
+
+    return check
+
+
+# Group chats are one shared log, db["messages"][gid] with gid "#<hex>",
+# in cseq order. A message is encrypted and stored once whatever the group
+# size; members only hold a read cursor, read_upto[member][gid].
+# db["groups"][gid] has the name, the owner, "last" (the newest cseq) and
+# the members, each mapped to "last" as it was when they joined: older
+# messages are not shown to them.
+def is_group(name):
+    return isinstance(name, str) and name.startswith("#")
+
+
+def new_group_id(db):
+    while True:
+        gid = "#" + secrets.token_hex(4)
+        if gid not in db["groups"]:
+            return gid
+
+
+def publish_group(db, gid, former=()):
+    rec = db["groups"][gid]
+    publish(("group", gid, dict(rec, members=dict(rec["members"]))))
+    bump_version(group_key(gid))
+    note_change(db, *((user, "group:" + gid) for user in (*rec["members"], *former)))
+
+
+def new_group_message(db, gid, sender, kind, kid, ct, filename=None, flags=0):
+    group = db["groups"][gid]
+    group["last"] += 1
+    # seq and cseq are both the position in the group log
+    msg = Message(sender, time.time_ns(), group["last"], kind, kid, ct,
+                  filename, flags, group["last"], next_gseq(db))
+    db["messages"].setdefault(gid, []).append(msg)
+    publish(("msg", gid, msg.sender, msg.ts, msg.seq, msg.cseq, msg.gseq,
+             msg.kind, msg.kid, msg.ct, msg.filename, msg.flags))
+    return msg
+
+
+# the member's start in the log: what they have read, or where they joined
+def group_cursor(db, user, gid):
+    since = db["groups"][gid]["members"][user]
+    return max(since, db["read_upto"].get(user, {}).get(gid, 0))
+
+
+def log_after(log, after):
+    return log[bisect.bisect_right(log, after, key=attrgetter("cseq")):]
+
+
+# messages from before sequence numbers: number them in timestamp order
+def number_messages(db):
+    unnumbered = sorted(
+        ((msg.ts, i, receiver, msg)
+         for receiver, inbox in db["messages"].items()
+         for i, msg in enumerate(inbox) if not msg.gseq),
+        key=lambda t: (t[0], t[1]),
+    )
+    for _, _, receiver, msg in unnumbered:
+        msg.cseq = next_cseq(db, msg.sender, receiver)
+        msg.gseq = next_gseq(db)
+    if unnumbered:
+        # inboxes stay sorted by gseq; inbox cursors bisect on it
+        for inbox in db["messages"].values():
+            inbox.sort(key=attrgetter("gseq"))
+        log(f"Numbered {len(unnumbered)} messages")
+
+
+def unread_count(db, user, peer):
+    delivered = db["delivered"].get(user, {}).get(peer, 0)
+    return delivered - db["read_upto"].get(user, {}).get(peer, 0)
+
+
+def mark_read(db, user, peer, upto=None):
+    if upto is None:
+        upto = db["delivered"].get(user, {}).get(peer, 0)
+    read_upto = db["read_upto"].setdefault(user, {})
+    if upto <= read_upto.get(peer, 0):
+        return False
+    if upstream is not None:
+        upstream(("read", user, peer, upto))
+        return True
+    read_upto[peer] = upto
+    publish(("read", user, peer, upto))
+    bump_version(inbox_key(user), conv_key(user, peer))
+    if is_group(peer):
+        note_change(db, (user, "read:" + peer))
+    else:
+        note_change(db, (user, "read:" + peer), (peer, "receipt:" + user))
+    return True
+
+
+# ---------------------------------------------------------------------- #
+#  Multi-device sync. A device's cursor is "G.C": G the newest gseq and  #
+#  C the newest change_seq it has. New messages are found by bisecting   #
+#  the gseq-ordered inboxes and group logs. Everything else goes to a    #
+#  per-user feed, db["feed"][user]["<kind>:<peer>"] = change_seq, that    #
+#  keeps only the last change of each kind per peer: a device back after #
+#  days offline gets one entry per peer with the current value, not the  #
+#  whole history of changes.                                             #
+#                                                                        #
+#  kinds: read (how far this user read peer), receipt (how far peer      #
+#  read this user), clear (the conversation's tombstone) and group       #
+#  (membership of a group changed).                                      #
+# ---------------------------------------------------------------------- #
+
+def note_change(db, *entries):
+    if not entries:
+        return
+    db["change_seq"] += 1
+    for user, key in entries:
+        db["feed"].setdefault(user, {})[key] = db["change_seq"]
+    publish(("change", entries, db["change_seq"]))
+
+
+def parse_sync_cursor(cursor):
+    gseq, _, change = str(cursor).partition(".")
+    return int(gseq), int(change or 0)
+
+
+def feed_value(db, user, kind, peer):
+    if kind == "read":
+        return db["read_upto"].get(user, {}).get(peer, 0)
+    if kind == "receipt":
+        return db["read_upto"].get(peer, {}).get(user, 0)
+    if kind == "clear":
+        return cleared_upto(db, user, peer)
+    group = db["groups"].get(peer)
+    if group is None or user not in group["members"]:
+        return None  # left or removed
+    return {"name": group["name"], "members": list(group["members"])}
+
+
+# (gseq, msg, peer, outbound) per source for everything of the user's with
+# gseq > after; each source is in gseq order, so they merge without a sort
+def sync_sources(db, user, after):
+    def tail(log):
+        return log[bisect.bisect_right(log, after, key=attrgetter("gseq")):]
+
+    live = visible(db, user)
+    sources = [((m.gseq, m, m.sender, False)
+                for m in tail(db["messages"].get(user, [])) if live(m))]
+    # watchers_of(user) are exactly the people the user sent messages to
+    for peer in watchers_of(db, user):
+        deleted_upto = tombstone(db, user, peer)
+        sources.append((m.gseq, m, peer, True)
+                       for m in tail(db["messages"].get(peer, []))
+                       if m.sender == user and m.cseq > deleted_upto)
+    for gid, group in db["groups"].items():
+        if user in group["members"]:
+            since = group["members"][user]
+            sources.append((m.gseq, m, gid, m.sender == user)
+                           for m in tail(db["messages"].get(gid, [])) if m.cseq > since)
+    return sources
+
+
+def store_device(db, user, device, rec):
+    devices = db["devices"].setdefault(user, {})
+    devices[device] = rec
+    if len(devices) > MAX_DEVICES:
+        del devices[min(devices, key=lambda d: devices[d]["seen"])]
+
+
+# the cursor a device will resume from when it sends none
+def set_device_cursor(db, user, device, cursor):
+    op = ("device", user, device,
+          {"cursor": cursor, "seen": datetime.now().isoformat(timespec="seconds")})
+    if upstream is not None:
+        upstream(op)
+        return
+    store_device(db, *op[1:])
+    publish(op)
+
+
+# In-memory versions of each inbox and conversation, bumped on every change.
+# Read actions take "if_version" and answer not_modified when it still
+# matches. The clock starts at the boot time in ns, so versions keep
+# increasing across restarts.
+versions = {}
+version_clock = itertools.count(time.time_ns())
+BOOT_VERSION = next(version_clock)
+
+
+def inbox_key(user):
+    return ("inbox", user)
+
+
+def conv_key(a, b):
+    return ("conv",) + tuple(sorted((a, b)))
+
+
+def group_key(gid):
+    return ("group", gid)
+
+
+def bump_version(*keys):
+    v = next(version_clock)
+    for key in keys:
+        versions[key] = v
+    publish(("version", keys, v))
+
+
+def current_version(key):
+    return versions.get(key, BOOT_VERSION)
+
+
+def not_modified(payload, version):
+    return payload.get("if_version") == version
+
+
+# an inbox version vouches for one page only: the inbox version tagged
+# with the cursor, limit and filters it was returned for
+def inbox_version(username, payload):
+    params = {k: v for k, v in payload.items() if k != "if_version"}
+    tag = hashlib.blake2b(json.dumps(params, sort_keys=True).encode(), digest_size=6).hexdigest()
+    return f"{current_version(inbox_key(username))}:{tag}"
+
+
 def save_db(db):
-    with open(DB_FILE, "w") as f:
-        json.dump(db, f, indent=2)
+    if role in ("worker", "replica"):
+        return 0  # the owner process writes the file
+    return db_format.save(db, DB_FILE)
+
+
+# the shared in-memory DB; requests and background jobs hold db_lock
+DB = None
+db_lock = threading.RLock()
 
 
 def password_valid(pw: str) -> bool:
@@ -89,432 +668,2248 @@ def record_failed_attempt(rec: dict):
 
 
 # ====================================================================== #
-#                           FIXED CLIENT HANDLER                         #
+#                           PASSWORD HASHING                             #
 # ====================================================================== #
 
-def handle_client(conn, addr):
-    log(f"New connection from {addr}")
-    db = load_db()
+def hash_password(pw: str, iterations: int = PBKDF2_ITERATIONS) -> str:
+    salt = os.urandom(16)
+    dk = hashlib.pbkdf2_hmac("sha256", pw.encode(), salt, iterations)
+    return "pbkdf2_sha256${}${}${}".format(
+        iterations, base64.b64encode(salt).decode(), base64.b64encode(dk).decode()
+    )
 
-    try:
-        while True:
-            data = conn.recv(65536)
-            if not data:
-                break
 
-            # ignore whitespace packets
-            if len(data.strip()) == 0:
-                continue
+def verify_password(stored: str, pw: str) -> bool:
+    if not stored.startswith("pbkdf2_sha256$"):
+        # plaintext record from before hashing; rehashed on successful login
+        return hmac.compare_digest(stored.encode(), pw.encode())
+    _, iterations, salt, dk = stored.split("$")
+    candidate = hashlib.pbkdf2_hmac("sha256", pw.encode(), base64.b64decode(salt), int(iterations))
+    return hmac.compare_digest(candidate, base64.b64decode(dk))
 
-            try:
-                decoded = data.decode()
-            except UnicodeDecodeError:
-                log("Non-text binary data ignored")
-                continue
-
-            try:
-                req = json.loads(decoded)
-            except json.JSONDecodeError:
-                log(f"Invalid JSON from client: {decoded!r}")
-                continue  # do NOT send error back
 
-            action = req.get("action")
-            username = req.get("username")
-            payload = req.get("data", {})
+def needs_rehash(stored: str) -> bool:
+    return not stored.startswith(f"pbkdf2_sha256${PBKDF2_ITERATIONS}$")
 
-            # -------- REGISTER --------
-            if action == "register":
-                user = payload.get("user")
-                pw = payload.get("pw")
 
-                if not user or not pw:
-                    conn.send(b'{"ok": false, "error": "missing_fields"}')
-                    continue
+# hashlib releases the GIL while hashing, so these threads run in parallel
+hash_pool = ThreadPoolExecutor(max_workers=HASH_WORKERS, thread_name_prefix="pwhash")
 
-                if not password_valid(pw):
-                    conn.send(b'{"ok": false, "error": "pw_too_short"}')
-                    continue
+# Successful verifications, so a reconnect storm does not redo PBKDF2 for
+# every client. Keys are HMACs under a per-process secret and include the
+# stored hash, so a password change invalidates them.
+login_cache = OrderedDict()
+login_cache_lock = threading.Lock()
+login_cache_secret = os.urandom(32)
 
-                if user in db["users"]:
-                    conn.send(b'{"ok": false, "error": "user_exists"}')
-                    continue
 
-                db["users"][user] = {"pw": pw, "strikes": 0, "locked_until": None}
-                db["messages"].setdefault(user, [])
+def login_cache_key(user: str, pw: str, stored: str) -> bytes:
+    material = "\0".join((user, pw, stored)).encode()
+    return hmac.new(login_cache_secret, material, hashlib.sha256).digest()
 
-                save_db(db)
-                log(f"User registered: {user}")
-                conn.send(b'{"ok": true}')
 
-            # -------- LOGIN --------
-            elif action == "login":
-                user = payload.get("user")
-                pw = payload.get("pw")
+def check_password(user: str, pw: str, stored: str) -> bool:
+    key = login_cache_key(user, pw, stored)
+    now = time.monotonic()
+    with login_cache_lock:
+        expires = login_cache.get(key)
+        if expires is not None and expires > now:
+            login_cache.move_to_end(key)
+            return True
 
-                rec = db["users"].get(user)
-                if not rec:
-                    conn.send(b'{"ok": false, "error": "no_such_user"}')
-                    continue
+    if not hash_pool.submit(verify_password, stored, pw).result():
+        return False
 
-                if not can_attempt_login(rec):
-                    conn.send(b'{"ok": false, "error": "locked_out"}')
-                    continue
+    with login_cache_lock:
+        login_cache[key] = now + LOGIN_CACHE_SECONDS
+        login_cache.move_to_end(key)
+        while len(login_cache) > LOGIN_CACHE_SIZE:
+            login_cache.popitem(last=False)
+    return True
 
-                if rec["pw"] == pw:
-                    rec["strikes"] = 0
-                    rec["locked_until"] = None
-                    save_db(db)
-                    log(f"User logged in: {user}")
-                    conn.send(b'{"ok": true}')
-                else:
-                    locked, strikes = record_failed_attempt(rec)
-                    save_db(db)
-                    if locked:
-                        log(f"User locked out: {user}")
-                        resp = {"ok": False, "error": "locked_after_3"}
-                    else:
-                        resp = {"ok": False, "error": "bad_credentials", "strike": strikes}
-                    conn.send(json.dumps(resp).encode())
-
-            # -------- SEND TEXT --------
-            elif action == "send":
-                sender = username
-                receiver = payload.get("to")
-                message = payload.get("msg")
-
-                if not sender or not receiver or not message:
-                    conn.send(b'{"ok": false, "error": "missing_fields"}')
-                    continue
 
-                if receiver not in db["users"]:
-                    conn.send(b'{"ok": false, "error": "no_such_user"}')
-                    continue
+# ====================================================================== #
+#                               SESSIONS                                 #
+# ====================================================================== #
 
-                encrypted = fernet.encrypt(message.encode()).decode()
-                ts = datetime.now().isoformat(timespec="seconds")
+# token -> {"user", "expires"}; validating a request is one dict lookup
+sessions = {}
+user_sessions = {}  # user -> set of tokens, for revoking all of a user's sessions
+sessions_lock = threading.Lock()
+last_session_sweep = 0.0
+
+
+def create_session(user: str) -> str:
+    global last_session_sweep
+
+    token = secrets.token_urlsafe(32)
+    now = time.monotonic()
+    with sessions_lock:
+        add_session(token, user)
+
+        if now - last_session_sweep > SESSION_SWEEP_SECONDS:
+            last_session_sweep = now
+            for t, sess in list(sessions.items()):
+                if sess["expires"] <= now:
+                    drop_session(t)
+    publish(("session", token, user))
+    return token
+
+
+def add_session(token: str, user: str):
+    sessions[token] = {"user": user, "expires": time.monotonic() + SESSION_TTL_SECONDS}
+    user_sessions.setdefault(user, set()).add(token)
+
+
+def drop_session(token: str):
+    sess = sessions.pop(token, None)
+    if sess is None:
+        return
+    tokens = user_sessions.get(sess["user"])
+    if tokens is not None:
+        tokens.discard(token)
+        if not tokens:
+            del user_sessions[sess["user"]]
+
+
+def validate_session(token):
+    if not token:
+        return None
+    now = time.monotonic()
+    with sessions_lock:
+        sess = sessions.get(token)
+        if sess is None:
+            return None
+        if sess["expires"] <= now:
+            drop_session(token)
+            return None
+        # sliding expiry: an active client never has to log in again
+        sess["expires"] = now + SESSION_TTL_SECONDS
+        return sess["user"]
+
+
+def revoke_session(token: str):
+    with sessions_lock:
+        drop_session(token)
+    publish(("drop_session", token))
+
+
+def revoke_user_sessions(user: str) -> int:
+    with sessions_lock:
+        tokens = user_sessions.pop(user, set())
+        for token in tokens:
+            sessions.pop(token, None)
+    publish(("revoke_user", user))
+    if tokens:
+        log(f"Revoked {len(tokens)} session(s) for {user}")
+    return len(tokens)
 
-                db["messages"].setdefault(receiver, []).append({
-                    "from": sender,
-                    "msg": encrypted,
-                    "ts": ts,
-                    "read": False,
-                    "kind": "text"
-                })
 
-                save_db(db)
-                log(f"Message sent: {sender} -> {receiver}")
-                conn.send(b'{"ok": true}')
-
-            # -------- SEND FILE --------
-            elif action == "send_file":
-                sender = username
-                receiver = payload.get("to")
-                filename = payload.get("filename")
-                content_b64 = payload.get("content_b64")
-
-                if not sender or not receiver or not filename or not content_b64:
-                    conn.send(b'{"ok": false, "error": "missing_fields"}')
-                    continue
+# ====================================================================== #
+#                           ADMISSION CONTROL                            #
+# ====================================================================== #
 
-                if receiver not in db["users"]:
-                    conn.send(b'{"ok": false, "error": "no_such_user"}')
-                    continue
+# (who, action) -> [tokens, last refill]; who is a user, or an address for auth
+buckets = {}
+buckets_lock = threading.Lock()
+last_bucket_sweep = 0.0
+
+in_flight = threading.BoundedSemaphore(MAX_IN_FLIGHT)
+metrics = {"requests": 0, "rate_limited": {}, "busy": 0, "in_flight": 0, "queued": 0, "coalesced": 0}
+metrics_lock = threading.Lock()
+
+
+# takes one token; returns 0 if allowed, else seconds until one is available
+def take_token(who, action) -> float:
+    global last_bucket_sweep
+
+    rate, burst = RATE_LIMITS.get(action, RATE_LIMITS["default"])
+    now = time.monotonic()
+    with buckets_lock:
+        bucket = buckets.get((who, action))
+        if bucket is None:
+            bucket = buckets[(who, action)] = [burst, now]
+        else:
+            bucket[0] = min(burst, bucket[0] + (now - bucket[1]) * rate)
+            bucket[1] = now
+
+        if now - last_bucket_sweep > SESSION_SWEEP_SECONDS:
+            last_bucket_sweep = now
+            for key, (tokens, last) in list(buckets.items()):
+                limit = RATE_LIMITS.get(key[1], RATE_LIMITS["default"])
+                if tokens + (now - last) * limit[0] >= limit[1]:
+                    del buckets[key]
+            buckets[(who, action)] = bucket
+
+        if bucket[0] >= 1:
+            bucket[0] -= 1
+            return 0
+        return (1 - bucket[0]) / rate
+
+
+def count_metric(name, key=None):
+    with metrics_lock:
+        if key is None:
+            metrics[name] += 1
+        else:
+            metrics[name][key] = metrics[name].get(key, 0) + 1
+
+
+def retry_response(error, retry_after):
+    return json.dumps({"ok": False, "error": error, "retry_after": round(retry_after, 3)}).encode()
+
+
+# runs handler() in one of the MAX_IN_FLIGHT slots; waits up to QUEUE_TIMEOUT for one
+def admit(handler):
+    with metrics_lock:
+        metrics["queued"] += 1
+    acquired = in_flight.acquire(timeout=QUEUE_TIMEOUT)
+    with metrics_lock:
+        metrics["queued"] -= 1
+        if acquired:
+            metrics["in_flight"] += 1
+            metrics["requests"] += 1
+        else:
+            metrics["busy"] += 1
+    if not acquired:
+        return retry_response("busy", QUEUE_TIMEOUT)
 
-                encrypted = fernet.encrypt(content_b64.encode()).decode()
-                ts = datetime.now().isoformat(timespec="seconds")
+    try:
+        return handler()
+    finally:
+        with metrics_lock:
+            metrics["in_flight"] -= 1
+        in_flight.release()
+
+
+def metrics_snapshot():
+    with metrics_lock:
+        snap = json.loads(json.dumps(metrics))
+    with sessions_lock:
+        snap["sessions"] = len(sessions)
+    snap["max_in_flight"] = MAX_IN_FLIGHT
+    snap["first_request_ms"] = startup["first_request_ms"]
+    with db_lock:
+        if isinstance(DB["messages"], db_format.LazyInboxes):
+            snap["inbox_cache"] = DB["messages"].stats()
+    snap["rate_limits"] = RATE_LIMITS
+    return json.dumps({"ok": True, "metrics": snap}).encode()
+
+
+# Profiling a live server (see profiling.py). These run in the process
+# that holds the connection, outside db_lock and the in-flight limit; with
+# --workers that is the worker the admin is connected to.
+ADMIN_ACTIONS = {"profile_start", "profile_stop", "trace_memory", "dump_stacks"}
+
+
+def admin_request(user, req):
+    if user not in ADMIN_USERS:
+        return b'{"ok": false, "error": "forbidden"}'
+
+    action = req.get("action")
+    payload = req.get("data", {})
+    if action == "profile_start":
+        result = profiling.start(payload.get("mode", "sample"), payload.get("seconds", 30))
+    elif action == "profile_stop":
+        result = profiling.stop()
+    elif action == "trace_memory":
+        top = payload.get("top")
+        result = profiling.memory(payload.get("op", "snapshot"),
+                                  top if isinstance(top, int) and top > 0 else profiling.TOP)
+    else:
+        result = profiling.dump_stacks()
+    log(f"Admin {user}: {action} -> {result.get('report') or result.get('error') or 'ok'}")
+    return json.dumps(result).encode()
 
-                db["messages"].setdefault(receiver, []).append({
-                    "from": sender,
-                    "msg": encrypted,
-                    "ts": ts,
-                    "read": False,
-                    "kind": "file",
-                    "filename": filename
-                })
 
-                save_db(db)
-                log(f"File sent: {sender} -> {receiver} ({filename})")
-                conn.send(b'{"ok": true}')
-
-            # -------- INBOX --------
-            elif action == "inbox":
-                inbox_data = db["messages"].get(username, [])
-                out = []
-
-                for msg in inbox_data:
-                    kind = msg.get("kind", "text")
-                    ts = msg.get("ts")
-                    from_user = msg.get("from")
-
-                    if kind == "file":
-                        decrypted = f"[file] {msg.get('filename')}"
-                    else:
-                        try:
-                            decrypted = fernet.decrypt(msg["msg"].encode()).decode()
-                        except Exception:
-                            decrypted = "[decrypt error]"
-
-                    out.append({
-                        "from": from_user,
-                        "msg": decrypted,
-                        "timestamp": ts,
-                        "kind": kind
-                    })
+# ====================================================================== #
+#                           FIXED CLIENT HANDLER                         #
+# ====================================================================== #
 
-                for msg in inbox_data:
-                    msg["read"] = True
+# inbox filters: unread_only, from, kind, since/until (ISO timestamps);
+# None if a timestamp does not parse
+def inbox_filters(payload):
+    filters = dict(payload)
+    for key in ("since", "until"):
+        if filters.get(key):
+            try:
+                datetime.fromisoformat(filters[key])
+            except (TypeError, ValueError):
+                return None
+            filters[key] = ts_to_ns(filters[key])
+    return filters
+
+
+def inbox_matches(msg, filters, read_upto):
+    if filters.get("unread_only") and msg.seq <= read_upto.get(msg.sender, 0):
+        return False
+    if filters.get("from") and msg.sender != filters["from"]:
+        return False
+    if filters.get("kind") and msg.kind != filters["kind"]:
+        return False
+    if filters.get("since") and msg.ts < filters["since"]:
+        return False
+    if filters.get("until") and msg.ts > filters["until"]:
+        return False
+    return True
+
+
+# send_file encrypts and writes the attachment without holding db_lock;
+# only the message carrying its descriptor is added under it
+def handle_send_file(db, req):
+    sender = req.get("username")
+    payload = req.get("data", {})
+    receiver = payload.get("to")
+    filename = payload.get("filename")
+    content_b64 = payload.get("content_b64")
+
+    if not sender or not receiver or not filename or not content_b64:
+        return b'{"ok": false, "error": "missing_fields"}'
+
+    with db_lock:
+        if receiver not in db["users"]:
+            return b'{"ok": false, "error": "no_such_user"}'
 
+    try:
+        content = base64.b64decode(content_b64, validate=True)
+    except (binascii.Error, ValueError):
+        return b'{"ok": false, "error": "bad_content"}'
+
+    # the content goes to its own file; the message carries the descriptor
+    descriptor = store_attachment(content)
+
+    with db_lock:
+        # encrypted under the lock so a key rotation in between sees it
+        kid, encrypted, flags = encrypt_message(descriptor)
+        new_message(db, sender, receiver, "file", kid, encrypted, filename,
+                    flags | FLAG_RAW_FILE | FLAG_ATTACHMENT)
+
+        bump_version(inbox_key(receiver), conv_key(sender, receiver))
+        save_db(db)
+    log(f"File sent: {sender} -> {receiver} ({filename})")
+    return b'{"ok": true}'
+
+
+# register/login hash passwords in hash_pool without holding db_lock
+def handle_auth(db, req):
+    action = req.get("action")
+    payload = req.get("data", {})
+
+    # -------- REGISTER --------
+    if action == "register":
+        user = payload.get("user")
+        pw = payload.get("pw")
+
+        if not user or not pw:
+            return b'{"ok": false, "error": "missing_fields"}'
+
+        if not password_valid(pw):
+            return b'{"ok": false, "error": "pw_too_short"}'
+
+        if is_group(user):
+            return b'{"ok": false, "error": "bad_username"}'
+
+        with db_lock:
+            if user in db["users"]:
+                return b'{"ok": false, "error": "user_exists"}'
+
+        pw_hash = hash_pool.submit(hash_password, pw).result()
+
+        with db_lock:
+            if user in db["users"]:
+                return b'{"ok": false, "error": "user_exists"}'
+
+            db["users"][user] = {"pw": pw_hash, "strikes": 0, "locked_until": None}
+            db["messages"].setdefault(user, [])
+            publish(("user", user, dict(db["users"][user])))
+
+            save_db(db)
+        log(f"User registered: {user}")
+        return b'{"ok": true}'
+
+    # -------- LOGIN --------
+    elif action == "login":
+        user = payload.get("user")
+        pw = payload.get("pw")
+
+        if not user or not pw:
+            return b'{"ok": false, "error": "missing_fields"}'
+
+        with db_lock:
+            rec = db["users"].get(user)
+            if not rec:
+                return b'{"ok": false, "error": "no_such_user"}'
+
+            if not can_attempt_login(rec):
+                return b'{"ok": false, "error": "locked_out"}'
+
+            stored = rec["pw"]
+
+        if check_password(user, pw, stored):
+            new_hash = None
+            if needs_rehash(stored):
+                new_hash = hash_pool.submit(hash_password, pw).result()
+
+            with db_lock:
+                changed = rec["strikes"] or rec["locked_until"]
+                rec["strikes"] = 0
+                rec["locked_until"] = None
+                if new_hash and rec["pw"] == stored:
+                    rec["pw"] = new_hash
+                    changed = True
+                if changed:
+                    publish(("user", user, dict(rec)))
+                    save_db(db)
+            if new_hash:
+                log(f"Password rehashed for: {user}")
+            log(f"User logged in: {user}")
+            token = create_session(user)
+            return json.dumps({"ok": True, "token": token, "expires_in": SESSION_TTL_SECONDS}).encode()
+        else:
+            with db_lock:
+                locked, strikes = record_failed_attempt(rec)
+                publish(("user", user, dict(rec)))
                 save_db(db)
+            if locked:
+                revoke_user_sessions(user)
+                log(f"User locked out: {user}")
+                resp = {"ok": False, "error": "locked_after_3"}
+            else:
+                resp = {"ok": False, "error": "bad_credentials", "strike": strikes}
+            return json.dumps(resp).encode()
+
+
+def peer_is_typing(db, user, peer):
+    state = db["typing"].get(user, {}).get(peer)
+    if state and state.get("typing"):
+        try:
+            ts = datetime.fromisoformat(state["ts"])
+            return (datetime.now() - ts).total_seconds() < 8
+        except:
+            pass
+    return False
 
-                conn.send(json.dumps({"ok": True, "messages": out}).encode())
 
-            # -------- CONVERSATIONS SUMMARY --------
-            elif action == "conversations":
-                inbox_data = db["messages"].get(username, [])
-                conv = {}
+def chat_row(msg, sender, receiver, peer_read_upto=None):
+    if msg.kind == "file":
+        text = f"[file] {msg.filename}"
+    else:
+        try:
+            text = decrypt_message(msg).decode()
+        except DECRYPT_ERRORS:
+            text = "[decrypt error]"
+
+    row = {
+        "from": sender,
+        "to": receiver,
+        "msg": text,
+        "timestamp": ts_from_ns(msg.ts),
+        "kind": msg.kind,
+        "filename": msg.filename,
+        "cseq": msg.cseq
+    }
+    if msg.kind == "file":
+        row["file"] = msg.gseq  # the handle download_file takes
+    if peer_read_upto is not None:
+        # outbound: seq lets the client update receipts from peer_read_upto later
+        row["seq"] = msg.seq
+        row["read"] = msg.seq <= peer_read_upto
+    return row
+
+
+# both directions of user <-> peer after `after`, in cseq order. The
+# conversation's cseq counter says how many messages are newer than
+# `after`: a quiet chat returns without touching either inbox, and
+# otherwise both inboxes are walked back together, newest gseq first,
+# only until that many have been found.
+def chat_rows(db, user, peer, after, peer_read_upto):
+    lo, hi = sorted((user, peer))
+    wanted = db["cseq"].get(lo, {}).get(hi, 0) - after
+    if wanted <= 0:
+        return []
+
+    # [inbox, sender, position]; a chat with oneself has one side
+    mine = db["messages"].get(user, [])
+    sides = [[mine, peer, len(mine)]]
+    if peer != user:
+        theirs = db["messages"].get(peer, [])
+        sides.append([theirs, user, len(theirs)])
+
+    found = []
+    while len(found) < wanted:
+        live = [side for side in sides if side[2] > 0]
+        if not live:
+            break  # compacted away
+        side = max(live, key=lambda side: side[0][side[2] - 1].gseq)
+        inbox, sender, pos = side
+        side[2] = pos - 1
+        msg = inbox[pos - 1]
+        if msg.sender != sender:
+            continue
+        if msg.cseq <= after:
+            side[2] = 0  # everything older in this inbox is too
+            continue
+        if sender == peer:
+            found.append(chat_row(msg, peer, user))
+        else:
+            found.append(chat_row(msg, user, peer, peer_read_upto))
+    # within a conversation gseq and cseq grow together
+    found.reverse()
+    return found
+
+
+# the file message `gseq` in a chat of the user's, or None
+def find_file(db, user, payload):
+    try:
+        gseq = int(payload.get("file"))
+    except (TypeError, ValueError):
+        return None
+
+    gid = payload.get("group")
+    if gid is not None:
+        group = db["groups"].get(gid)
+        if group is None or user not in group["members"]:
+            return None
+        places = [(db["messages"].get(gid, []), None, group["members"][user])]
+    else:
+        peer = payload.get("peer")
+        if peer not in db["users"]:
+            return None
+        deleted_upto = tombstone(db, user, peer)
+        places = [(db["messages"].get(user, []), peer, deleted_upto),
+                  (db["messages"].get(peer, []), user, deleted_upto)]
+
+    for inbox, sender, after in places:
+        i = bisect.bisect_left(inbox, gseq, key=attrgetter("gseq"))
+        if i < len(inbox) and inbox[i].gseq == gseq:
+            msg = inbox[i]
+            if msg.kind == "file" and msg.cseq > after and sender in (None, msg.sender):
+                return msg
+    return None
+
+
+def handle_request(db, req):
+    action = req.get("action")
+    username = req.get("username")
+    payload = req.get("data", {})
+
+    # -------- SEND TEXT --------
+    if action == "send":
+        sender = username
+        receiver = payload.get("to")
+        message = payload.get("msg")
+
+        if not sender or not receiver or not message:
+            return b'{"ok": false, "error": "missing_fields"}'
+
+        if receiver not in db["users"]:
+            return b'{"ok": false, "error": "no_such_user"}'
+
+        kid, encrypted, flags = encrypt_message(message.encode())
+        new_message(db, sender, receiver, "text", kid, encrypted, None, flags)
+
+        bump_version(inbox_key(receiver), conv_key(sender, receiver))
+        save_db(db)
+        log(f"Message sent: {sender} -> {receiver}")
+        return b'{"ok": true}'
+
+    # -------- INBOX --------
+    elif action == "inbox":
+        version = inbox_version(username, payload)
+        if not_modified(payload, version):
+            return json.dumps({"ok": True, "not_modified": True, "version": version}).encode()
+
+        inbox_data = db["messages"].get(username, [])
+
+        try:
+            limit = min(max(int(payload.get("limit", INBOX_PAGE_SIZE)), 1), INBOX_MAX_PAGE)
+            after = int(payload.get("cursor") or 0)
+        except (TypeError, ValueError):
+            return b'{"ok": false, "error": "bad_cursor"}'
+
+        # the cursor is the gseq of the last message looked at
+        pos = bisect.bisect_right(inbox_data, after, key=attrgetter("gseq"))
+
+        filters = inbox_filters(payload)
+        if filters is None:
+            return b'{"ok": false, "error": "bad_filter"}'
+
+        # filter on the stored metadata first; only the page gets decrypted.
+        # Only what was returned counts as read: a sender's watermark stops
+        # at the first unread message of theirs the filters skipped.
+        read_upto = db["read_upto"].get(username, {})
+        live = visible(db, username)
+        page = []
+        newest = {}
+        skipped = set()
+        while pos < len(inbox_data) and len(page) < limit:
+            msg = inbox_data[pos]
+            pos += 1
+            if not live(msg):
+                continue
+            if inbox_matches(msg, filters, read_upto):
+                page.append(msg)
+                if msg.sender not in skipped:
+                    newest[msg.sender] = msg.seq
+            elif msg.seq > read_upto.get(msg.sender, 0):
+                skipped.add(msg.sender)
+        next_cursor = str(inbox_data[pos - 1].gseq) if pos < len(inbox_data) else None
+
+        out = []
+        for msg in page:
+            kind = msg.kind
+            ts = ts_from_ns(msg.ts)
+            from_user = msg.sender
+
+            if kind == "file":
+                decrypted = f"[file] {msg.filename}"
+            else:
+                try:
+                    decrypted = decrypt_message(msg).decode()
+                except DECRYPT_ERRORS:
+                    decrypted = "[decrypt error]"
+
+            out.append({
+                "from": from_user,
+                "msg": decrypted,
+                "timestamp": ts,
+                "kind": kind,
+                "gseq": msg.gseq
+            })
+
+        changed = False
+        for sender, seq in newest.items():
+            changed |= mark_read(db, username, sender, seq)
+        if changed:
+            save_db(db)
+
+        return json.dumps({
+            "ok": True,
+            "messages": pack_rows(out, req.get("columnar")),
+            "next_cursor": next_cursor,
+            "version": inbox_version(username, payload)
+        }).encode()
+
+    # -------- CONVERSATIONS SUMMARY --------
+    elif action == "conversations":
+        version = current_version(inbox_key(username))
+        if not_modified(payload, version):
+            return json.dumps({"ok": True, "not_modified": True, "version": version}).encode()
+
+        inbox_data = db["messages"].get(username, [])
+        conv = {}
+
+        live = visible(db, username)
+        for msg in inbox_data:
+            if not live(msg):
+                continue
+            conv.setdefault(msg.sender, {"total": 0, "last": None})
+            conv[msg.sender]["total"] += 1
+            # the inbox is in gseq order, so the last one seen is the newest
+            conv[msg.sender]["last"] = msg
+
+        convs = []
+        for sender, info in conv.items():
+            last = info["last"]
+            if last.kind == "file":
+                preview = f"[file] {last.filename}"
+            else:
+                try:
+                    preview = decrypt_message(last).decode()
+                except DECRYPT_ERRORS:
+                    preview = "[decrypt error]"
+
+            convs.append({
+                "peer": sender,
+                "total": info["total"],
+                "unread": unread_count(db, username, sender),
+                "last_ts": ts_from_ns(last.ts),
+                "last_preview": preview
+            })
+
+        return json.dumps({"ok": True, "conversations": convs, "version": version}).encode()
+
+    # -------- FULL CONVERSATION DETAIL --------
+    elif action == "conversation_detail":
+        peer = payload.get("peer")
+        if not peer:
+            return b'{"ok": false, "error": "missing_peer"}'
+
+        if peer not in db["users"]:
+            return b'{"ok": false, "error": "no_such_user"}'
+
+        version = current_version(conv_key(username, peer))
+        if not_modified(payload, version):
+            return json.dumps({"ok": True, "not_modified": True, "version": version}).encode()
+
+        # read receipts: how far the peer has read what we sent them
+        peer_read_upto = db["read_upto"].get(peer, {}).get(username, 0)
+        history = chat_rows(db, username, peer, tombstone(db, username, peer), peer_read_upto)
+
+        # mark inbound read
+        if mark_read(db, username, peer):
+            save_db(db)
+
+        return json.dumps({
+            "ok": True,
+            "history": pack_rows(history, req.get("columnar")),
+            "peer_read_upto": peer_read_upto,
+            "version": current_version(conv_key(username, peer))
+        }).encode()
+
+    # -------- POLL OPEN CHATS --------
+    # one request for every open chat window: {"chats": [{"peer", "after"}]}
+    # where "after" is the newest cseq the window already shows
+    elif action == "poll":
+        chats = payload.get("chats")
+        if not isinstance(chats, list) or len(chats) > POLL_MAX_CHATS:
+            return b'{"ok": false, "error": "bad_chats"}'
+        chats = [chat for chat in chats if isinstance(chat, dict)]
+        try:
+            # all cursors are checked before any chat is marked read
+            afters = [int(chat.get("after") or 0) for chat in chats]
+        except (TypeError, ValueError):
+            return b'{"ok": false, "error": "bad_cursor"}'
+
+        out = []
+        changed = False
+        for chat, after in zip(chats, afters):
+            gid = chat.get("group")
+            if gid is not None:
+                group = db["groups"].get(gid) if isinstance(gid, str) else None
+                if group is None or username not in group["members"]:
+                    continue
+                after = max(after, group["members"][username])
+                rows = [chat_row(msg, msg.sender, gid)
+                        for msg in log_after(db["messages"].get(gid, []), after)]
+                if mark_read(db, username, gid, group["last"]):
+                    changed = True
+                out.append({
+                    "group": gid,
+                    "messages": pack_rows(rows, req.get("columnar")),
+                    "cursor": rows[-1]["cseq"] if rows else after
+                })
+                continue
 
-                for msg in inbox_data:
-                    sender = msg.get("from")
-                    ts = msg.get("ts")
-                    read_flag = msg.get("read", False)
+            peer = chat.get("peer")
+            if not isinstance(peer, str) or peer not in db["users"]:
+                continue
+            deleted_upto = tombstone(db, username, peer)
+            after = max(after, deleted_upto)
+            peer_read_upto = db["read_upto"].get(peer, {}).get(username, 0)
+            rows = chat_rows(db, username, peer, after, peer_read_upto)
+
+            # the window is open, so whatever arrived has been seen
+            if mark_read(db, username, peer):
+                changed = True
+
+            out.append({
+                "peer": peer,
+                "messages": pack_rows(rows, req.get("columnar")),
+                "cursor": rows[-1]["cseq"] if rows else after,
+                "peer_read_upto": peer_read_upto,
+                "deleted_upto": deleted_upto,
+                "typing": peer_is_typing(db, username, peer)
+            })
+
+        if changed:
+            save_db(db)
+        resp = {"ok": True, "chats": out}
+        # presence changes of the people in this user's conversation list
+        if username in presence_queues:
+            resp["presence"] = presence_queues.pop(username)
+        return json.dumps(resp).encode()
+
+    # -------- DELETE CONVERSATION --------
+    elif action == "delete_conversation":
+        peer = payload.get("peer")
+        if not peer:
+            return b'{"ok": false, "error": "missing_peer"}'
+
+        if is_group(peer):
+            return b'{"ok": false, "error": "is_group"}'
+
+        # everything sent so far is hidden now; the compactor drops it later
+        add_tombstone(db, username, peer)
+
+        # nothing left unread on either side
+        mark_read(db, username, peer)
+        mark_read(db, peer, username)
+        bump_version(inbox_key(username), inbox_key(peer), conv_key(username, peer))
+
+        # the compactor saves right away, outside this request
+        compact_wakeup.set()
+        log(f"Conversation cleared between {username} and {peer}")
+
+        return b'{"ok": true}'
+
+    # -------- SEARCH --------
+    elif action == "search":
+        query = (payload.get("query") or "").lower()
+        if not query:
+            return b'{"ok": false, "error": "empty_query"}'
+
+        results = []
+
+        # inbound
+        live = visible(db, username)
+        for msg in db["messages"].get(username, []):
+            if msg.kind != "text" or not live(msg):
+                continue
+            try:
+                text = decrypt_message(msg).decode()
+            except DECRYPT_ERRORS:
+                continue
 
-                    conv.setdefault(sender, {
-                        "total": 0,
-                        "unread": 0,
-                        "last_ts": "",
-                        "last_preview": ""
-                    })
+            if query in text.lower():
+                results.append({
+                    "from": msg.sender,
+                    "to": username,
+                    "msg": text,
+                    "timestamp": ts_from_ns(msg.ts),
+                    "gseq": msg.gseq
+                })
 
-                    conv[sender]["total"] += 1
-                    if not read_flag:
-                        conv[sender]["unread"] += 1
-
-                    if not conv[sender]["last_ts"] or ts > conv[sender]["last_ts"]:
-                        kind = msg.get("kind", "text")
-                        if kind == "file":
-                            preview = f"[file] {msg.get('filename')}"
-                        else:
-                            try:
-                                preview = fernet.decrypt(msg["msg"].encode()).decode()
-                            except:
-                                preview = "[decrypt error]"
-
-                        conv[sender]["last_ts"] = ts
-                        conv[sender]["last_preview"] = preview
-
-                convs = []
-                for sender, info in conv.items():
-                    convs.append({
-                        "peer": sender,
-                        "total": info["total"],
-                        "unread": info["unread"],
-                        "last_ts": info["last_ts"],
-                        "last_preview": info["last_preview"]
-                    })
+        # outbound
+        for other, inbox in db["messages"].items():
+            if other == username or is_group(other):
+                continue
+            deleted_upto = tombstone(db, username, other)
+            for msg in inbox:
+                if msg.sender != username or msg.cseq <= deleted_upto:
+                    continue
+                if msg.kind != "text":
+                    continue
+                try:
+                    text = decrypt_message(msg).decode()
+                except DECRYPT_ERRORS:
+                    continue
 
-                conn.send(json.dumps({"ok": True, "conversations": convs}).encode())
+                if query in text.lower():
+                    results.append({
+                        "from": username,
+                        "to": other,
+                        "msg": text,
+                        "timestamp": ts_from_ns(msg.ts),
+                        "gseq": msg.gseq
+                    })
 
-            # -------- FULL CONVERSATION DETAIL --------
-            elif action == "conversation_detail":
-                peer = payload.get("peer")
-                if not peer:
-                    conn.send(b'{"ok": false, "error": "missing_peer"}')
+        # groups: each shared log once
+        for gid, group in db["groups"].items():
+            if username not in group["members"]:
+                continue
+            for msg in log_after(db["messages"].get(gid, []), group["members"][username]):
+                if msg.kind != "text":
                     continue
-
-                if peer not in db["users"]:
-                    conn.send(b'{"ok": false, "error": "no_such_user"}')
+                try:
+                    text = decrypt_message(msg).decode()
+                except DECRYPT_ERRORS:
                     continue
 
-                history = []
-
-                # inbound (peer → username)
-                for msg in db["messages"].get(username, []):
-                    if msg.get("from") == peer:
-                        ts = msg.get("ts")
-                        kind = msg.get("kind", "text")
-
-                        if kind == "file":
-                            text = f"[file] {msg.get('filename')}"
-                        else:
-                            try:
-                                text = fernet.decrypt(msg["msg"].encode()).decode()
-                            except:
-                                text = "[decrypt error]"
-
-                        history.append({
-                            "from": peer,
-                            "to": username,
-                            "msg": text,
-                            "timestamp": ts,
-                            "kind": kind,
-                            "filename": msg.get("filename")
-                        })
-
-                # outbound (username → peer)
-                for msg in db["messages"].get(peer, []):
-                    if msg.get("from") == username:
-                        ts = msg.get("ts")
-                        kind = msg.get("kind", "text")
-
-                        if kind == "file":
-                            text = f"[file] {msg.get('filename')}"
-                        else:
-                            try:
-                                text = fernet.decrypt(msg["msg"].encode()).decode()
-                            except:
-                                text = "[decrypt error]"
-
-                        history.append({
-                            "from": username,
-                            "to": peer,
-                            "msg": text,
-                            "timestamp": ts,
-                            "kind": kind,
-                            "filename": msg.get("filename")
-                        })
-
-                # sort by timestamp
+                if query in text.lower():
+                    results.append({
+                        "from": msg.sender,
+                        "to": gid,
+                        "msg": text,
+                        "timestamp": ts_from_ns(msg.ts),
+                        "gseq": msg.gseq
+                    })
+
+        results.sort(key=itemgetter("gseq"), reverse=True)
+
+        return json.dumps({"ok": True, "results": pack_rows(results, req.get("columnar"))}).encode()
+
+    # -------- CREATE GROUP --------
+    elif action == "create_group":
+        name = payload.get("name")
+        name = name.strip() if isinstance(name, str) else ""
+        members = payload.get("members") or []
+        if not name:
+            return b'{"ok": false, "error": "missing_fields"}'
+        if not isinstance(members, list) or not all(isinstance(m, str) and m for m in members):
+            return b'{"ok": false, "error": "bad_members"}'
+
+        members = set(members) | {username}
+        if len(members) > GROUP_MAX_MEMBERS:
+            return b'{"ok": false, "error": "group_too_large"}'
+        if any(m not in db["users"] for m in members):
+            return b'{"ok": false, "error": "no_such_user"}'
+
+        gid = new_group_id(db)
+        db["groups"][gid] = {"name": name, "owner": username, "last": 0,
+                             "members": dict.fromkeys(sorted(members), 0)}
+        db["messages"].setdefault(gid, [])
+        publish_group(db, gid)
+
+        save_db(db)
+        log(f"Group created: {gid} ({name}) by {username}, {len(members)} members")
+        return json.dumps({"ok": True, "group": gid}).encode()
+
+    # -------- ADD GROUP MEMBER --------
+    elif action == "add_group_member":
+        gid = payload.get("group")
+        user = payload.get("user")
+        group = db["groups"].get(gid)
+        if group is None or username not in group["members"]:
+            return b'{"ok": false, "error": "not_member"}'
+        if user not in db["users"]:
+            return b'{"ok": false, "error": "no_such_user"}'
+        if user in group["members"]:
+            return b'{"ok": true}'
+        if len(group["members"]) >= GROUP_MAX_MEMBERS:
+            return b'{"ok": false, "error": "group_too_large"}'
+
+        # history starts at the join
+        group["members"][user] = group["last"]
+        publish_group(db, gid)
+
+        save_db(db)
+        log(f"Group {gid}: {username} added {user}")
+        return b'{"ok": true}'
+
+    # -------- LEAVE GROUP --------
+    elif action == "leave_group":
+        gid = payload.get("group")
+        group = db["groups"].get(gid)
+        if group is None or username not in group["members"]:
+            return b'{"ok": false, "error": "not_member"}'
+
+        del group["members"][username]
+        if group["owner"] == username and group["members"]:
+            group["owner"] = next(iter(group["members"]))
+        publish_group(db, gid, former=(username,))
+
+        save_db(db)
+        log(f"Group {gid}: {username} left")
+        return b'{"ok": true}'
+
+    # -------- SEND TO GROUP --------
+    elif action == "send_group":
+        gid = payload.get("group")
+        message = payload.get("msg")
+        if not gid or not message:
+            return b'{"ok": false, "error": "missing_fields"}'
+
+        group = db["groups"].get(gid)
+        if group is None or username not in group["members"]:
+            return b'{"ok": false, "error": "not_member"}'
+
+        # encrypted and appended once, whatever the number of members
+        kid, encrypted, flags = encrypt_message(message.encode())
+        msg = new_group_message(db, gid, username, "text", kid, encrypted, None, flags)
+        mark_read(db, username, gid, msg.cseq)
+
+        bump_version(group_key(gid))
+        save_db(db)
+        log(f"Group message sent: {username} -> {gid}")
+        return b'{"ok": true}'
+
+    # -------- GROUP LIST --------
+    elif action == "groups":
+        out = []
+        for gid, group in db["groups"].items():
+            if username not in group["members"]:
+                continue
+            log_data = db["messages"].get(gid, [])
+            last = log_data[-1] if log_data else None
+            if last is not None and last.cseq <= group["members"][username]:
+                last = None
+
+            preview = ""
+            if last is not None and last.kind == "file":
+                preview = f"[file] {last.filename}"
+            elif last is not None:
                 try:
-                    history.sort(key=lambda m: m["timestamp"])
-                except:
-                    pass
+                    preview = decrypt_message(last).decode()
+                except DECRYPT_ERRORS:
+                    preview = "[decrypt error]"
+
+            out.append({
+                "group": gid,
+                "name": group["name"],
+                "members": list(group["members"]),
+                "unread": group["last"] - group_cursor(db, username, gid),
+                "last_ts": ts_from_ns(last.ts) if last else None,
+                "last_from": last.sender if last else None,
+                "last_preview": preview
+            })
+
+        return json.dumps({"ok": True, "groups": out}).encode()
+
+    # -------- GROUP HISTORY --------
+    elif action == "group_detail":
+        gid = payload.get("group")
+        group = db["groups"].get(gid)
+        if group is None or username not in group["members"]:
+            return b'{"ok": false, "error": "not_member"}'
+
+        version = current_version(group_key(gid))
+        if not_modified(payload, version):
+            return json.dumps({"ok": True, "not_modified": True, "version": version}).encode()
+
+        since = group["members"][username]
+        history = [chat_row(msg, msg.sender, gid)
+                   for msg in log_after(db["messages"].get(gid, []), since)]
+
+        if mark_read(db, username, gid, group["last"]):
+            save_db(db)
+
+        return json.dumps({
+            "ok": True,
+            "group": gid,
+            "name": group["name"],
+            "owner": group["owner"],
+            "members": list(group["members"]),
+            "history": pack_rows(history, req.get("columnar")),
+            "version": version
+        }).encode()
+
+    # -------- DOWNLOAD FILE --------
+    # {"file": the row's handle, "peer" or "group", "offset", "length"}, in
+    # plaintext bytes. The reply lists the chunks covering the range and
+    # the data key; handle_client then sends each chunk as a raw frame
+    # (stream_chunks). A client resumes by asking again from its offset.
+    elif action == "download_file":
+        msg = find_file(db, username, payload)
+        if msg is None:
+            return b'{"ok": false, "error": "no_such_file"}'
+
+        try:
+            offset = max(int(payload.get("offset") or 0), 0)
+            length = min(max(int(payload.get("length") or DOWNLOAD_MAX_BYTES), 0), DOWNLOAD_MAX_BYTES)
+        except (TypeError, ValueError):
+            return b'{"ok": false, "error": "bad_range"}'
+
+        try:
+            stored = decrypt_message(msg)
+        except DECRYPT_ERRORS:
+            return b'{"ok": false, "error": "decrypt_error"}'
+
+        if not msg.flags & FLAG_ATTACHMENT:
+            # stored inside the message by older versions
+            content = stored
+            if not msg.flags & FLAG_RAW_FILE:
+                content = base64.b64decode(content)
+            part = content[offset:offset + length]
+            return json.dumps({
+                "ok": True,
+                "filename": msg.filename,
+                "size": len(content),
+                "offset": offset,
+                "length": len(part),
+                "inline": base64.b64encode(part).decode()
+            }).encode()
+
+        descriptor = json.loads(stored)
+        try:
+            chunk_size, size, chunks = db_format.read_attachment_index(attachment_path(descriptor["id"]))
+        except (OSError, ValueError):
+            return b'{"ok": false, "error": "file_missing"}'
+
+        length = max(min(length, size - offset), 0)
+        first = offset // chunk_size
+        count = (offset + length - 1) // chunk_size - first + 1 if length else 0
+        return json.dumps({
+            "ok": True,
+            "filename": msg.filename,
+            "size": size,
+            "offset": offset,
+            "length": length,
+            "skip": offset - first * chunk_size,
+            "key": descriptor["key"],
+            "attachment": descriptor["id"],
+            "chunks": chunks[first:first + count]
+        }).encode()
+
+    # -------- SET TYPING --------
+    elif action == "typing":
+        peer = payload.get("peer")
+        is_typing = bool(payload.get("is_typing"))
+
+        db["typing"].setdefault(peer, {})
+        db["typing"][peer][username] = {
+            "typing": is_typing,
+            "ts": datetime.now().isoformat(timespec="seconds")
+        }
+        publish(("typing", peer, username, db["typing"][peer][username]))
+        return b'{"ok": true}'
+
+    # -------- SYNC (per device) --------
+    # {"device": id, "cursor": optional "G.C"}; without a cursor the device
+    # resumes where its last sync ended
+    elif action == "sync":
+        device = payload.get("device")
+        if not isinstance(device, str) or not device or len(device) > 64:
+            return b'{"ok": false, "error": "missing_device"}'
+
+        stored = db["devices"].get(username, {}).get(device, {}).get("cursor", "0.0")
+        try:
+            after, after_change = parse_sync_cursor(payload.get("cursor") or stored)
+            limit = min(max(int(payload.get("limit", SYNC_PAGE_SIZE)), 1), SYNC_PAGE_SIZE)
+        except (TypeError, ValueError):
+            return b'{"ok": false, "error": "bad_cursor"}'
+
+        found = list(itertools.islice(
+            heapq.merge(*sync_sources(db, username, after), key=itemgetter(0)), limit + 1))
+        more = len(found) > limit
+        del found[limit:]
+
+        rows = []
+        for gseq, msg, peer, outbound in found:
+            if is_group(peer):
+                row = chat_row(msg, msg.sender, peer)
+            elif outbound:
+                row = chat_row(msg, username, peer, db["read_upto"].get(peer, {}).get(username, 0))
+            else:
+                row = chat_row(msg, peer, username)
+            row["peer"] = peer
+            row["gseq"] = gseq
+            rows.append(row)
+
+        changes = {}
+        for key, seq in db["feed"].get(username, {}).items():
+            if seq > after_change:
+                kind, _, peer = key.partition(":")
+                changes.setdefault(kind, {})[peer] = feed_value(db, username, kind, peer)
+
+        # a full catch-up moves to the newest gseq, even past other users' messages
+        cursor = f"{found[-1][0] if more else max(after, db['gseq'])}.{db['change_seq']}"
+        set_device_cursor(db, username, device, cursor)
+
+        return json.dumps({
+            "ok": True,
+            "messages": pack_rows(rows, req.get("columnar")),
+            "changes": changes,
+            "cursor": cursor,
+            "more": more
+        }).encode()
+
+    # -------- PRESENCE --------
+    # everyone in the conversation list; later changes come with poll
+    elif action == "presence":
+        presence_queues.pop(username, None)
+        states = {peer: presence_state(peer) for peer in db["delivered"].get(username, {})}
+        return json.dumps({"ok": True, "presence": states}).encode()
+
+    # -------- GET TYPING STATUS --------
+    elif action == "typing_status":
+        peer = payload.get("peer")
+        return json.dumps({"ok": True, "typing": peer_is_typing(db, username, peer)}).encode()
+
+    # -------- LOGOUT --------
+    elif action == "logout":
+        revoke_session(req.get("token"))
+        return b'{"ok": true}'
+
+    # -------- LOGOUT EVERYWHERE --------
+    elif action == "logout_all":
+        revoked = revoke_user_sessions(username)
+        return json.dumps({"ok": True, "revoked": revoked}).encode()
+
+    # -------- UNKNOWN ACTION --------
+    else:
+        return b'{"ok": false, "error": "unknown_action"}'
+
+
+def recv_exact(conn, n):
+    buf = bytearray()
+    while len(buf) < n:
+        chunk = conn.recv(n - len(buf))
+        if not chunk:
+            return None
+        buf += chunk
+    return bytes(buf)
+
+
+# every request/response is one frame: 4-byte big-endian length + body
+def recv_frame(conn, max_size=MAX_FRAME_SIZE):
+    header = recv_exact(conn, 4)
+    if header is None:
+        return None
+    (length,) = struct.unpack(">I", header)
+    if length > max_size:
+        raise ValueError(f"frame too large: {length}")
+    return recv_exact(conn, length)
+
+
+def send_frame(conn, body: bytes):
+    conn.sendall(struct.pack(">I", len(body)) + body)
+
+
+# ---------------------------------------------------------------------- #
+#  Per-connection options, negotiated with an optional first "hello":    #
+#    {"action": "hello", "data": {"compression": ["zlib"], "columnar": true}}
+#  Once a codec is agreed, every later response body starts with a 1-byte #
+#  marker: b"J" for plain JSON, or the codec's marker for a compressed    #
+#  body. Only bodies of COMPRESS_THRESHOLD bytes or more are compressed.  #
+# ---------------------------------------------------------------------- #
+
+# name -> (marker, compress); add entries here to offer other codecs
+CODECS = {
+    "zlib": (b"Z", lambda body: zlib.compress(body, COMPRESS_LEVEL)),
+}
+
+
+def handle_hello(conn_state, req):
+    payload = req.get("data", {})
+    offered = payload.get("compression") or []
+    codec = next((name for name in offered if name in CODECS), None)
+    conn_state["codec"] = codec
+    conn_state["columnar"] = bool(payload.get("columnar"))
+    return json.dumps({
+        "ok": True,
+        "compression": codec,
+        "columnar": conn_state["columnar"],
+        "threshold": COMPRESS_THRESHOLD
+    }).encode()
+
+
+# recently compressed bodies; coalesced requests hand the same bytes
+# object to every waiter, so only the first of them compresses it
+encoded_cache = OrderedDict()  # (id(resp), codec) -> (resp, encoded)
+encoded_cache_lock = threading.Lock()
+ENCODED_CACHE_SIZE = 16
+
+
+def encode_response(conn_state, resp: bytes) -> bytes:
+    codec = conn_state["codec"]
+    if codec is None:
+        return resp
+    if len(resp) < COMPRESS_THRESHOLD:
+        return b"J" + resp
+
+    key = (id(resp), codec)
+    with encoded_cache_lock:
+        hit = encoded_cache.get(key)
+        if hit is not None and hit[0] is resp:
+            return hit[1]
+
+    marker, compress = CODECS[codec]
+    encoded = marker + compress(resp)
+    with encoded_cache_lock:
+        # holding resp keeps its id from being reused while cached
+        encoded_cache[key] = (resp, encoded)
+        while len(encoded_cache) > ENCODED_CACHE_SIZE:
+            encoded_cache.popitem(last=False)
+    return encoded
+
+
+# list of dicts -> dict of lists, so keys are sent once instead of per row
+def pack_rows(rows, columnar):
+    if not columnar:
+        return rows
+    keys = dict.fromkeys(k for r in rows for k in r)
+    return {k: [r.get(k) for r in rows] for k in keys}
+
+
+def run_request(req):
+    if role == "replica":
+        if req.get("action") not in REPLICA_ACTIONS:
+            return b'{"ok": false, "error": "read_only"}'
+        lag = replica_lag()
+        if lag > REPLICA_MAX_LAG_SECONDS:
+            return retry_response("replica_stale", REPLICA_HEARTBEAT_SECONDS)
+    if role == "worker" and req.get("action") in OWNER_ACTIONS:
+        return owner_call(req)
+    if req.get("action") in ("register", "login"):
+        return handle_auth(DB, req)
+    if req.get("action") == "send_file":
+        return handle_send_file(DB, req)
+    if req.get("action") in COALESCE_ACTIONS:
+        return coalesced(flight_key(req), lambda: locked_request(req))
+    return locked_request(req)
+
+
+def locked_request(req):
+    with db_lock:
+        try:
+            return handle_request(DB, req)
+        except KeyMissing as e:
+            return json.dumps({"ok": False, "error": "key_missing", "kid": str(e)}).encode()
+
+
+# ---------------------------------------------------------------------- #
+#  Single flight: identical reads (same action, user, parameters, data   #
+#  version and list shape) that arrive while one is being computed wait  #
+#  for it and share its response bytes instead of decrypting and         #
+#  encoding everything again.                                            #
+# ---------------------------------------------------------------------- #
+
+COALESCE_ACTIONS = {"conversations", "conversation_detail"}
+
+flights = {}  # key -> {"done": Event, "resp": bytes}
+flights_lock = threading.Lock()
+
+
+def flight_key(req):
+    user = req.get("username")
+    payload = req.get("data", {})
+    if req.get("action") == "conversation_detail":
+        version = current_version(conv_key(user, payload.get("peer") or ""))
+    else:
+        version = current_version(inbox_key(user))
+    params = json.dumps(payload, sort_keys=True)
+    return req.get("action"), user, params, version, req.get("columnar")
 
-                # mark inbound read
-                for msg in db["messages"].get(username, []):
-                    if msg.get("from") == peer:
-                        msg["read"] = True
 
-                save_db(db)
+def coalesced(key, compute):
+    with flights_lock:
+        flight = flights.get(key)
+        leader = flight is None
+        if leader:
+            flight = flights[key] = {"done": threading.Event(), "resp": None}
 
-                conn.send(json.dumps({"ok": True, "history": history}).encode())
+    if not leader:
+        flight["done"].wait()
+        count_metric("coalesced")
+        if flight["resp"] is not None:
+            return flight["resp"]
+        return compute()  # the leader failed; do not share its error
 
-            # -------- DELETE CONVERSATION --------
-            elif action == "delete_conversation":
-                peer = payload.get("peer")
-                if not peer:
-                    conn.send(b'{"ok": false, "error": "missing_peer"}')
-                    continue
+    try:
+        flight["resp"] = compute()
+        return flight["resp"]
+    finally:
+        with flights_lock:
+            del flights[key]
+        flight["done"].set()
 
-                # remove inbound
-                msgs_u = db["messages"].get(username, [])
-                msgs_u = [m for m in msgs_u if m.get("from") != peer]
-                db["messages"][username] = msgs_u
 
-                # remove outbound
-                msgs_p = db["messages"].get(peer, [])
-                msgs_p = [m for m in msgs_p if m.get("from") != username]
-                db["messages"][peer] = msgs_p
+def handle_client(conn, addr):
+    log(f"New connection from {addr}")
+    conn_state = {"codec": None, "columnar": False, "user": None, "id": secrets.randbits(32)}
 
-                save_db(db)
-                log(f"Conversation cleared between {username} and {peer}")
+    try:
+        while True:
+            try:
+                data = recv_frame(conn)
+            except ValueError as e:
+                log(f"Dropping {addr}: {e}")
+                break
+            if data is None:
+                break
+            arrived = time.monotonic()
 
-                conn.send(b'{"ok": true}')
+            # ignore whitespace packets
+            if len(data.strip()) == 0:
+                continue
 
-            # -------- SEARCH --------
-            elif action == "search":
-                query = (payload.get("query") or "").lower()
-                if not query:
-                    conn.send(b'{"ok": false, "error": "empty_query"}')
-                    continue
+            try:
+                decoded = data.decode()
+            except UnicodeDecodeError:
+                log("Non-text binary data ignored")
+                continue
 
-                results = []
-
-                # inbound
-                for msg in db["messages"].get(username, []):
-                    if msg.get("kind") != "text":
-                        continue
-                    try:
-                        text = fernet.decrypt(msg["msg"].encode()).decode()
-                    except:
-                        continue
-
-                    if query in text.lower():
-                        results.append({
-                            "from": msg.get("from"),
-                            "to": username,
-                            "msg": text,
-                            "timestamp": msg.get("ts")
-                        })
-
-                # outbound
-                for other, inbox in db["messages"].items():
-                    if other == username:
-                        continue
-                    for msg in inbox:
-                        if msg.get("from") != username:
-                            continue
-                        if msg.get("kind") != "text":
-                            continue
+            try:
+                req = json.loads(decoded)
+            except json.JSONDecodeError:
+                req = None
+            if not isinstance(req, dict):
+                log(f"Invalid JSON from client: {decoded!r}")
+                continue  # do NOT send error back
+
+            if req.get("action") == "hello":
+                # answered before compression is switched on
+                send_frame(conn, handle_hello(conn_state, req))
+                continue
+
+            req["columnar"] = conn_state["columnar"]
+            action = req.get("action")
+            user = None
+            stream = None
+            try:
+                if action in ("register", "login"):
+                    who = addr[0]
+                else:
+                    # identity comes from the session, not the client-supplied username
+                    user = who = validate_session(req.get("token"))
+                    presence_seen(conn_state, user)
+
+                if action not in ("register", "login") and user is None:
+                    resp = b'{"ok": false, "error": "invalid_session"}'
+                elif (wait := take_token(who, action)) > 0:
+                    count_metric("rate_limited", action)
+                    resp = retry_response("rate_limited", wait)
+                elif action == "metrics":
+                    resp = metrics_snapshot()
+                elif action in ADMIN_ACTIONS:
+                    resp = admin_request(user, req)
+                else:
+                    if user is not None:
+                        req["username"] = user
+                    resp = profiling.profiled(admit, lambda: run_request(req))
+
+                if action == "download_file" and resp.startswith(b'{"ok": true'):
+                    # opened before the reply goes out: a file compacted away in
+                    # between gets an error, not a stream cut short
+                    header = json.loads(resp)
+                    if header.get("chunks"):
                         try:
-                            text = fernet.decrypt(msg["msg"].encode()).decode()
-                        except:
-                            continue
-
-                        if query in text.lower():
-                            results.append({
-                                "from": username,
-                                "to": other,
-                                "msg": text,
-                                "timestamp": msg.get("ts")
-                            })
+                            stream = open(attachment_path(header["attachment"]), "rb")
+                        except OSError:
+                            resp = b'{"ok": false, "error": "file_missing"}'
+            except Exception:
+                # a handler bug answers this request only; the connection stays
+                log(f"Internal error on {action!r} from {addr}:\n{traceback.format_exc()}")
+                resp = b'{"ok": false, "error": "internal"}'
+
+            wire = encode_response(conn_state, resp)
+            send_frame(conn, wire)
+            if traffic.capturing():
+                traffic.record(conn_state["id"], arrived, action, user, req.get("data"),
+                               len(data), len(wire), resp)
+            if stream is not None:
+                with stream:
+                    stream_chunks(conn, stream, header["chunks"])
+            note_first_request()
+
+    except OSError as e:
+        log(f"Connection error from {addr}: {e}")
+    except Exception:
+        log(f"Internal error, dropping {addr}:\n{traceback.format_exc()}")
+    finally:
+        presence_seen(conn_state, None)
+        conn.close()
+        log(f"Disconnected: {addr}")
 
-                try:
-                    results.sort(key=lambda m: m["timestamp"], reverse=True)
-                except:
-                    pass
 
-                conn.send(json.dumps({"ok": True, "results": results}).encode())
+# The chunk frames after a download_file reply. socket.sendfile hands
+# them to os.sendfile where the platform has it, so the file content goes
+# from the page cache to the socket without passing through Python, and
+# no lock is held while a slow client drains it. The file is already
+# open, so deleting it meanwhile does not cut the stream.
+def stream_chunks(conn, f, chunks):
+    for pos, n in chunks:
+        conn.sendall(struct.pack(">I", n))
+        conn.sendfile(f, pos, n)
+
 
-            # -------- SET TYPING --------
-            elif action == "typing":
-                peer = payload.get("peer")
-                is_typing = bool(payload.get("is_typing"))
+# ====================================================================== #
+#                                PRESENCE                                #
+# ====================================================================== #
+#
+#  Online status comes from traffic on the persistent connections and is
+#  never saved. A user is online while one of their connections carried a
+#  request within PRESENCE_TTL_SECONDS; the client's poll keeps an open
+#  app online.
+#
+#  Each process serving clients tracks its own connections and, every
+#  PRESENCE_FLUSH_SECONDS, reports the users whose local state flipped in
+#  one batch to the storage owner (itself, a worker's owner or a replica's
+#  primary). The owner combines the reports of all its sources and
+#  publishes the users whose overall state flipped as one "presence" op.
+#  Every process then queues each change for the online watchers of that
+#  user - the people who have them in their conversation list - and the
+#  next poll picks the queue up. A reconnect storm of N users costs one op
+#  per flush and one queue entry per (watcher, subject) pair, not N^2
+#  notifications.
+
+presence_local = {}     # user -> {"conns", "active": monotonic time, "reported": bool}
+presence_lock = threading.Lock()
+presence_sources = {}   # owner: user -> sources that report them online
+presence = {}           # user -> {"online": bool, "last_seen": iso time}
+presence_queues = {}    # online watcher -> {subject: state} not polled yet
+watchers = None         # subject -> users they sent a message to, built on first use
+
+
+# called for every request on a connection, with the session's user
+def presence_seen(conn_state, user):
+    with presence_lock:
+        prev = conn_state["user"]
+        if prev != user:
+            if prev is not None:
+                presence_local[prev]["conns"] -= 1
+            if user is not None:
+                entry = presence_local.setdefault(user, {"conns": 0, "active": 0.0, "reported": False})
+                entry["conns"] += 1
+            conn_state["user"] = user
+        if user is not None:
+            presence_local[user]["active"] = time.monotonic()
+
+
+# users whose local state differs from what was last reported
+def presence_report():
+    now = time.monotonic()
+    report = {}
+    with presence_lock:
+        for user, entry in list(presence_local.items()):
+            online = entry["conns"] > 0 and now - entry["active"] < PRESENCE_TTL_SECONDS
+            if online != entry["reported"]:
+                entry["reported"] = online
+                report[user] = online
+            if not entry["conns"]:
+                del presence_local[user]
+    return report
+
+
+def presence_worker():
+    while True:
+        time.sleep(PRESENCE_FLUSH_SECONDS)
+        report = presence_report()
+        if not report:
+            continue
+        if upstream is not None:
+            upstream(("presence", report))
+        else:
+            with db_lock:
+                merge_presence(DB, report, "local")
+
+
+# owner: fold one source's report into the overall state
+def merge_presence(db, report, source):
+    now = datetime.now().isoformat(timespec="seconds")
+    changes = {}
+    for user, online in report.items():
+        online_at = presence_sources.setdefault(user, set())
+        was_online = bool(online_at)
+        if online:
+            online_at.add(source)
+        else:
+            online_at.discard(source)
+        if bool(online_at) != was_online:
+            changes[user] = {"online": bool(online_at), "last_seen": now}
+        if not online_at:
+            del presence_sources[user]
+    if changes:
+        publish(("presence", changes))
+        apply_presence(db, changes)
+
+
+# owner: a worker or replica went away, and its users with it
+def drop_presence_source(db, source):
+    gone = {user: False for user, online_at in presence_sources.items() if source in online_at}
+    merge_presence(db, gone, source)
+
+
+def apply_presence(db, changes):
+    presence.update(changes)
+    for subject, state in changes.items():
+        for watcher in watchers_of(db, subject):
+            # connected here counts too: the watcher's own report may be
+            # waiting for the next flush
+            if watcher in presence_local or presence.get(watcher, {}).get("online"):
+                presence_queues.setdefault(watcher, {})[subject] = state
+        if not state["online"]:
+            presence_queues.pop(subject, None)
+
+
+# a conversation list shows everyone who sent the user a message, which
+# is exactly db["delivered"][user]; this is the reverse of that
+def watchers_of(db, subject):
+    global watchers
+    if watchers is None:
+        watchers = {}
+        for watcher, senders in db["delivered"].items():
+            for sender in senders:
+                watchers.setdefault(sender, set()).add(watcher)
+    return watchers.get(subject, ())
+
+
+def add_watcher(watcher, subject):
+    if watchers is not None:
+        watchers.setdefault(subject, set()).add(watcher)
+
+
+def presence_state(user):
+    return presence.get(user, {"online": False, "last_seen": None})
 
-                db["typing"].setdefault(peer, {})
-                db["typing"][peer][username] = {
-                    "typing": is_typing,
-                    "ts": datetime.now().isoformat(timespec="seconds")
-                }
 
+# ====================================================================== #
+#                       BACKGROUND RE-ENCRYPTION                         #
+# ====================================================================== #
+
+rekey_progress = {"active": None, "total": 0, "done": 0}
+
+
+# (receiver, gseq) pairs, so a batch finds its messages even if the
+# inbox was evicted and reloaded in between
+def stale_messages(db):
+    active = keyring["active"]
+    return [(receiver, msg.gseq) for receiver, inbox in db["messages"].items() for msg in inbox
+            if msg.kid != active]
+
+
+def reencrypt_batch(db, batch):
+    active = keyring["active"]
+    f = keyring["keys"][active]
+    changed = []
+    for receiver, gseq in batch:
+        inbox = db["messages"].get(receiver, [])
+        i = bisect.bisect_left(inbox, gseq, key=attrgetter("gseq"))
+        if i == len(inbox) or inbox[i].gseq != gseq or inbox[i].kid == active:
+            continue
+        msg = inbox[i]
+        try:
+            plain = decrypt_stored(msg)  # stays compressed; the flags do not change
+        except Exception:
+            continue  # not readable with any key we hold, leave it alone
+        if hasattr(db["messages"], "touch"):
+            db["messages"].touch(receiver)  # keep it in memory until saved
+        msg.ct = base64.urlsafe_b64decode(f.encrypt(plain))
+        msg.kid = active
+        changed.append((receiver, msg.gseq, msg.kid, msg.ct))
+    if changed:
+        publish(("rekey", changed))
+    return len(changed)
+
+
+# re-reads secret.key if it changed since it was loaded; True if it did
+def reload_keyring():
+    global keyring
+    try:
+        if os.path.getmtime(KEY_FILE) == keyring["mtime"]:
+            return False
+        with db_lock:
+            keyring = load_keyring()
+            publish(("keyring",))
+    except (OSError, ValueError) as e:
+        log(f"Key reload failed: {e}")
+        return False
+    log(f"Reloaded secret.key, active key id {keyring['active']}")
+    return True
+
+
+# replicas have their own copy of secret.key and no re-encryption to do
+def keyring_worker():
+    while True:
+        reload_keyring()
+        time.sleep(REKEY_CHECK_SECONDS)
+
+
+def rekey_worker(db):
+    while True:
+        reload_keyring()
+
+        # "rekeyed_to" records a finished pass, so an unchanged keyring costs
+        # no scan (which would page in every lazy inbox)
+        target = keyring["active"]
+        with db_lock:
+            stale = [] if db.get("rekeyed_to") == target else stale_messages(db)
+
+        if stale:
+            rekey_progress.update(active=keyring["active"], total=len(stale), done=0)
+            log(f"Re-encryption started: {len(stale)} messages -> key {keyring['active']}")
+
+            for i in range(0, len(stale), REKEY_BATCH_SIZE):
+                with db_lock:
+                    rekey_progress["done"] += reencrypt_batch(db, stale[i:i + REKEY_BATCH_SIZE])
+                    written = save_db(db)
+                log(f"Re-encryption progress: {rekey_progress['done']}/{rekey_progress['total']}")
+                # spread the rewrites out so live traffic keeps the disk
+                time.sleep(written / REKEY_IO_BUDGET)
+
+            log(f"Re-encryption finished: {rekey_progress['done']} messages on key {keyring['active']}")
+
+        with db_lock:
+            if db.get("rekeyed_to") != target:
+                db["rekeyed_to"] = target
                 save_db(db)
-                conn.send(b'{"ok": true}')
 
-            # -------- GET TYPING STATUS --------
-            elif action == "typing_status":
-                peer = payload.get("peer")
-                state = db["typing"].get(username, {}).get(peer)
+        time.sleep(REKEY_CHECK_SECONDS)
 
-                typing_now = False
-                if state and state.get("typing"):
-                    try:
-                        ts = datetime.fromisoformat(state["ts"])
-                        if (datetime.now() - ts).total_seconds() < 8:
-                            typing_now = True
-                    except:
-                        pass
 
-                conn.send(json.dumps({"ok": True, "typing": typing_now}).encode())
+# ====================================================================== #
+#                         BACKGROUND COMPACTION                          #
+# ====================================================================== #
 
-            # -------- UNKNOWN ACTION --------
-            else:
-                conn.send(b'{"ok": false, "error": "unknown_action"}')
+compact_pending = set()  # users whose inbox still holds tombstoned messages
+compact_wakeup = threading.Event()
+
+
+# drops tombstoned messages from one inbox, then forgets every tombstone
+# that no longer covers anything on either side
+def compact_inbox(db, user):
+    live = visible(db, user)
+    inbox = db["messages"].get(user, [])
+    kept = [msg for msg in inbox if live(msg)]
+    db["messages"][user] = kept
+    if role in ("single", "owner"):
+        for msg in inbox:
+            if msg.flags & FLAG_ATTACHMENT and not live(msg):
+                delete_attachment(msg)
+    compact_pending.discard(user)
+    publish(("compact", user))
+
+    for lo in list(db["tombstones"]):
+        for hi in list(db["tombstones"][lo]):
+            if user in (lo, hi) and lo not in compact_pending and hi not in compact_pending:
+                del db["tombstones"][lo][hi]
+        if not db["tombstones"][lo]:
+            del db["tombstones"][lo]
+
+    return len(inbox) - len(kept)
+
+
+def compactor_worker(db):
+    with db_lock:
+        for lo, peers in db["tombstones"].items():
+            compact_pending.add(lo)
+            compact_pending.update(peers)
+
+    while True:
+        compact_wakeup.wait(COMPACT_CHECK_SECONDS)
+        compact_wakeup.clear()
+
+        # one inbox per lock hold, then a single save for the whole pass
+        removed = {}
+        while True:
+            with db_lock:
+                if not compact_pending:
+                    break
+                user = next(iter(compact_pending))
+                removed[user] = compact_inbox(db, user)
+        if not removed:
+            continue
+        with db_lock:
+            written = save_db(db)
+        for user, n in removed.items():
+            if n:
+                log(f"Compacted inbox of {user}: {n} deleted messages removed")
+        # paced like re-encryption
+        time.sleep(written / COMPACT_IO_BUDGET)
+
+
+# ====================================================================== #
+#                            WORKER PROCESSES                            #
+# ====================================================================== #
+#
+#  --workers N forks N processes after the DB is loaded. Each one accepts
+#  on PORT itself (SO_REUSEPORT lets the kernel spread connections) and
+#  answers reads from its own copy of the DB, so decryption, search and
+#  JSON encoding run on every core. The parent is the storage owner: it
+#  runs the requests in OWNER_ACTIONS, saves the file, runs the background
+#  jobs, and publishes every resulting op to all workers over a pipe.
+#  A worker's reply is sent on that same pipe after the ops the request
+#  produced, so the client always reads its own writes. Read marks made
+#  by inbox/conversation_detail go to the owner asynchronously and show
+#  up a moment later. Rate limits and metrics are per worker process.
+
+# everything that writes, plus logout/login because sessions live in the owner
+OWNER_ACTIONS = {"register", "login", "send", "send_file", "delete_conversation",
+                 "typing", "logout", "logout_all", "create_group", "add_group_member",
+                 "leave_group", "send_group"}
+
+owner_pipe = None
+owner_pipe_lock = threading.Lock()
+pending_calls = {}  # call id -> {"done": Event, "resp": bytes}
+call_ids = itertools.count(1)
+
+
+def apply_op(db, op):
+    global keyring
+
+    kind = op[0]
+    if kind == "msg":
+        _, receiver, sender, ts, seq, cseq, gseq, mkind, kid, ct, filename, flags = op
+        msg = Message(sender, ts, seq, mkind, kid, ct, filename, flags, cseq, gseq)
+        db["messages"].setdefault(receiver, []).append(msg)
+        if is_group(receiver):
+            group = db["groups"][receiver]
+            group["last"] = max(group["last"], cseq)
+        else:
+            delivered = db["delivered"].setdefault(receiver, {})
+            delivered[sender] = max(delivered.get(sender, 0), seq)
+            lo, hi = sorted((sender, receiver))
+            counters = db["cseq"].setdefault(lo, {})
+            counters[hi] = max(counters.get(hi, 0), cseq)
+            add_watcher(receiver, sender)
+        db["gseq"] = max(db["gseq"], gseq)
+    elif kind == "read":
+        _, user, peer, upto = op
+        read_upto = db["read_upto"].setdefault(user, {})
+        read_upto[peer] = max(read_upto.get(peer, 0), upto)
+    elif kind == "version":
+        for key in op[1]:
+            versions[key] = op[2]
+    elif kind == "tombstone":
+        _, lo, hi, upto = op
+        db["tombstones"].setdefault(lo, {})[hi] = upto
+        db["cleared"].setdefault(lo, {})[hi] = upto
+        compact_pending.update((lo, hi))
+    elif kind == "compact":
+        compact_inbox(db, op[1])
+    elif kind == "typing":
+        _, peer, user, entry = op
+        db["typing"].setdefault(peer, {})[user] = entry
+    elif kind == "user":
+        _, user, rec = op
+        db["users"][user] = rec
+        db["messages"].setdefault(user, [])
+    elif kind == "group":
+        _, gid, rec = op
+        db["groups"][gid] = rec
+        db["messages"].setdefault(gid, [])
+    elif kind == "rekey":
+        for receiver, gseq, kid, ct in op[1]:
+            inbox = db["messages"].get(receiver, [])
+            i = bisect.bisect_left(inbox, gseq, key=attrgetter("gseq"))
+            if i < len(inbox) and inbox[i].gseq == gseq:
+                inbox[i].kid = kid
+                inbox[i].ct = ct
+    elif kind == "keyring":
+        keyring = load_keyring()
+    elif kind == "session":
+        with sessions_lock:
+            add_session(op[1], op[2])
+    elif kind == "drop_session":
+        revoke_session(op[1])
+    elif kind == "revoke_user":
+        revoke_user_sessions(op[1])
+    elif kind == "presence":
+        apply_presence(db, op[1])
+    elif kind == "change":
+        _, entries, seq = op
+        for user, key in entries:
+            db["feed"].setdefault(user, {})[key] = seq
+        db["change_seq"] = max(db["change_seq"], seq)
+    elif kind == "device":
+        store_device(db, *op[1:])
+    elif kind == "tick":
+        replica_state["synced_at"] = op[1]
+
+
+def send_to_owner(item):
+    with owner_pipe_lock:
+        owner_pipe.send(item)
+
+
+# worker: run an OWNER_ACTIONS request in the owner and wait for the reply
+def owner_call(req):
+    call_id = next(call_ids)
+    waiter = pending_calls[call_id] = {"done": threading.Event(), "resp": None}
+    send_to_owner(("call", call_id, req))
+    waiter["done"].wait()
+    return waiter["resp"]
+
+
+# worker: applies the owner's ops in order and hands out replies
+def follow_owner():
+    while True:
+        try:
+            item = owner_pipe.recv()
+        except (EOFError, OSError):
+            log("Storage owner went away, worker exiting")
+            os._exit(1)
+        if item[0] == "op":
+            with db_lock:
+                apply_op(DB, item[1])
+        else:
+            _, call_id, resp = item
+            waiter = pending_calls.pop(call_id)
+            waiter["resp"] = resp
+            waiter["done"].set()
+
+
+def forward_ops(forward):
+    while True:
+        send_to_owner(("op", forward.get()))
+
+
+def listen_socket(reuse_port=False):
+    s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    s.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    if reuse_port:
+        s.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+    s.bind((HOST, PORT))
+    s.listen()
+    return s
+
+
+def accept_loop(s):
+    with s:
+        while True:
+            conn, addr = s.accept()
+            threading.Thread(target=handle_client, args=(conn, addr), daemon=True).start()
 
+
+def worker_main(pipe, index, owner_ends):
+    global role, owner_pipe, upstream
+
+    # without this the worker holds the owner's ends open itself and
+    # would never see EOF when the owner dies
+    for end in owner_ends:
+        end.close()
+    role = "worker"
+    owner_pipe = pipe
+    # mark_read runs under db_lock; never block on the pipe there
+    forward = queue.SimpleQueue()
+    upstream = forward.put
+    threading.Thread(target=follow_owner, daemon=True).start()
+    threading.Thread(target=forward_ops, args=(forward,), daemon=True).start()
+    threading.Thread(target=presence_worker, daemon=True).start()
+    log(f"Worker {index} started (pid {os.getpid()})")
+    accept_loop(listen_socket(reuse_port=True))
+
+
+# owner: one thread per worker pipe
+def serve_worker(pipe, send, pool):
+    def run_call(call_id, req):
+        try:
+            resp = run_request(req)
+        except Exception as e:
+            log(f"Owner failed on {req.get('action')}: {e!r}")
+            resp = b'{"ok": false, "error": "server_error"}'
+        send(("resp", call_id, resp))
+
+    while True:
+        try:
+            item = pipe.recv()
+        except (EOFError, OSError):
+            log("Worker pipe closed")
+            break
+        if item[0] == "call":
+            pool.submit(run_call, item[1], item[2])
+        else:
+            apply_upstream(item[1], pipe)
+    with db_lock:
+        drop_presence_source(DB, pipe)
+
+
+# owner/primary: an op a worker or replica sends up instead of applying it
+def apply_upstream(op, source):
+    with db_lock:
+        if op[0] == "presence":
+            merge_presence(DB, op[1], source)
+        elif op[0] == "device":
+            set_device_cursor(DB, *op[1:3], op[3]["cursor"])
+        else:
+            # a read marked messages read over there
+            _, user, peer, upto = op
+            if mark_read(DB, user, peer, upto):
+                save_db(DB)
+
+
+def start_workers(n):
+    global role
+
+    ctx = multiprocessing.get_context("fork")
+    procs = []
+    pipes = []
+    # fork before any thread starts, so the children get a quiet copy of the DB
+    for i in range(n):
+        parent_end, child_end = ctx.Pipe()
+        pipes.append(parent_end)
+        p = ctx.Process(target=worker_main, args=(child_end, i, pipes), daemon=True)
+        p.start()
+        child_end.close()
+        procs.append(p)
+
+    role = "owner"
+    pool = ThreadPoolExecutor(max_workers=MAX_IN_FLIGHT, thread_name_prefix="owner")
+    for pipe in pipes:
+        lock = threading.Lock()
+
+        def send(item, pipe=pipe, lock=lock):
+            with lock:
+                pipe.send(item)
+
+        subscribers.append(lambda op, send=send: send(("op", op)))
+        threading.Thread(target=serve_worker, args=(pipe, send, pool), daemon=True).start()
+    return procs
+
+
+# ====================================================================== #
+#                              READ REPLICAS                             #
+# ====================================================================== #
+#
+#  --replication-port P makes this server a primary: replicas connect to
+#  P, prove they hold the same secret.key, receive a snapshot (the
+#  secure_db.bin encoding plus versions and sessions) and then the op
+#  stream. --replica-of HOST:P runs a replica that serves REPLICA_ACTIONS
+#  only; read marks go back to the primary.
+#
+#  Staleness bound: the primary publishes a "tick" with its clock every
+#  REPLICA_HEARTBEAT_SECONDS, behind every op published before it. A
+#  replica whose last tick is older than REPLICA_MAX_LAG_SECONDS answers
+#  "replica_stale" and clients fall back to the primary, so a successful
+#  replica read is at most REPLICA_MAX_LAG_SECONDS (plus clock skew
+#  between the two hosts) behind.
+
+REPLICA_ACTIONS = {"inbox", "conversations", "conversation_detail", "search",
+                   "typing_status", "poll", "metrics", "groups", "group_detail", "presence",
+                   "sync"}
+
+replica_state = {"synced_at": 0.0, "conn": None}
+replica_conn_lock = threading.Lock()
+
+
+def replica_lag():
+    return time.time() - replica_state["synced_at"]
+
+
+# ops are tuples of str/int/bytes/dicts; JSON gets them across with tags
+def op_to_wire(v):
+    if isinstance(v, bytes):
+        return {"b": base64.b64encode(v).decode()}
+    if isinstance(v, tuple):
+        return {"t": [op_to_wire(x) for x in v]}
+    if isinstance(v, list):
+        return [op_to_wire(x) for x in v]
+    if isinstance(v, dict):
+        return {"d": {k: op_to_wire(x) for k, x in v.items()}}
+    return v
+
+
+def op_from_wire(v):
+    if isinstance(v, list):
+        return [op_from_wire(x) for x in v]
+    if isinstance(v, dict):
+        (tag, inner), = v.items()
+        if tag == "b":
+            return base64.b64decode(inner)
+        if tag == "t":
+            return tuple(op_from_wire(x) for x in inner)
+        return {k: op_from_wire(x) for k, x in inner.items()}
+    return v
+
+
+def replication_proof(key: bytes, nonce: bytes) -> bytes:
+    return hmac.new(key, b"pychat-replica" + nonce, hashlib.sha256).digest()
+
+
+def heartbeat_worker():
+    while True:
+        publish(("tick", time.time()))
+        time.sleep(REPLICA_HEARTBEAT_SECONDS)
+
+
+# primary: one thread per connected replica
+def serve_replica(conn, addr):
+    nonce = os.urandom(16)
+    send_frame(conn, nonce)
+    proof = recv_frame(conn)
+    keys = [key for _, key in read_key_file()]
+    if proof is None or not any(hmac.compare_digest(proof, replication_proof(k, nonce)) for k in keys):
+        log(f"Replica {addr} rejected: secret.key does not match")
+        conn.close()
+        return
+
+    ops = queue.Queue(REPLICA_QUEUE_MAX)
+
+    def send(op):
+        try:
+            ops.put_nowait(op)
+        except queue.Full:
+            # too far behind; it reconnects and starts over from a snapshot
+            subscribers.remove(send)
+            conn.shutdown(socket.SHUT_RDWR)
+
+    with db_lock, publish_lock:
+        snapshot = db_format.encode_db(DB)
+        with sessions_lock:
+            session_users = {token: sess["user"] for token, sess in sessions.items()}
+        header = json.dumps({
+            "snapshot_bytes": len(snapshot),
+            "versions": op_to_wire(list(versions.items())),
+            "sessions": session_users,
+            "presence": presence,
+        }).encode()
+        subscribers.append(send)
+    log(f"Replica {addr} connected, snapshot {len(snapshot)} bytes")
+
+    threading.Thread(target=replica_read_marks, args=(conn, addr), daemon=True).start()
+    try:
+        send_frame(conn, header)
+        conn.sendall(snapshot)
+        while True:
+            send_frame(conn, json.dumps(op_to_wire(ops.get())).encode())
+    except OSError as e:
+        log(f"Replica {addr} disconnected: {e}")
     finally:
+        with publish_lock:
+            if send in subscribers:
+                subscribers.remove(send)
         conn.close()
-        log(f"Disconnected: {addr}")
 
 
-def main():
-    log("Server started")
-    print(f"[server] Listening on {HOST}:{PORT}")
+# primary: read marks and presence reports coming back from a replica
+def replica_read_marks(conn, addr):
+    try:
+        while (frame := recv_frame(conn)) is not None:
+            apply_upstream(op_from_wire(json.loads(frame)), addr)
+    except (OSError, ValueError):
+        pass
+    with db_lock:
+        drop_presence_source(DB, addr)
+
 
+def replication_server(port):
     with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
-        s.bind((HOST, PORT))
+        s.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        s.bind((HOST, port))
         s.listen()
-
         while True:
             conn, addr = s.accept()
-            threading.Thread(target=handle_client, args=(conn, addr), daemon=True).start()
+            threading.Thread(target=serve_replica, args=(conn, addr), daemon=True).start()
+
+
+def send_to_primary(op):
+    with replica_conn_lock:
+        conn = replica_state["conn"]
+        if conn is None:
+            return  # not connected; the mark is lost, the next read makes it again
+        try:
+            send_frame(conn, json.dumps(op_to_wire(op)).encode())
+        except OSError:
+            pass
+
+
+# replica: snapshot, then apply the op stream; reconnects forever
+def follow_primary(host, port):
+    global DB, watchers
+
+    while True:
+        conn = None
+        try:
+            conn = socket.create_connection((host, port))
+            nonce = recv_frame(conn)
+            send_frame(conn, replication_proof(read_key_file()[-1][1], nonce))
+            header = recv_frame(conn)
+            if header is None:
+                raise OSError("primary refused the replica (does secret.key match?)")
+            header = json.loads(header)
+            snapshot = recv_exact(conn, header["snapshot_bytes"])
+            if snapshot is None:
+                raise OSError("connection closed during snapshot")
+
+            with db_lock:
+                DB = db_format.decode_db(snapshot)
+                prepare_meta(DB)
+                watchers = None
+                versions.clear()
+                versions.update(op_from_wire(header["versions"]))
+                presence.clear()
+                presence.update(header["presence"])
+                presence_queues.clear()
+                with sessions_lock:
+                    sessions.clear()
+                    user_sessions.clear()
+                    for token, user in header["sessions"].items():
+                        add_session(token, user)
+            with replica_conn_lock:
+                replica_state["conn"] = conn
+            # the primary forgot this replica's users when it disconnected
+            with presence_lock:
+                for entry in presence_local.values():
+                    entry["reported"] = False
+            log(f"Replica synced from {host}:{port}, snapshot {len(snapshot)} bytes")
+
+            while (frame := recv_frame(conn, 4 * MAX_FRAME_SIZE)) is not None:
+                op = op_from_wire(json.loads(frame))
+                with db_lock:
+                    apply_op(DB, op)
+            log("Primary closed the replication stream")
+        except (OSError, ValueError) as e:
+            log(f"Replication from {host}:{port} failed: {e}")
+        finally:
+            with replica_conn_lock:
+                replica_state["conn"] = None
+            if conn is not None:
+                conn.close()
+        time.sleep(REPLICA_HEARTBEAT_SECONDS)
+
+
+startup = {"started": time.perf_counter(), "first_request_ms": None}
+
+
+def rss_mb():
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # kilobytes on Linux, bytes on macOS
+    return peak / (1024 * 1024 if sys.platform == "darwin" else 1024)
+
+
+def report_startup():
+    ready_ms = (time.perf_counter() - startup["started"]) * 1000
+    messages = DB["messages"]
+    if isinstance(messages, db_format.LazyInboxes):
+        inboxes = f"{len(messages)} inboxes indexed, loaded on demand"
+    else:
+        inboxes = f"{sum(map(len, messages.values()))} messages loaded"
+    line = (f"Ready in {ready_ms:.0f} ms: {len(DB['users'])} users, {inboxes}, "
+            f"peak RSS {rss_mb():.1f} MB")
+    log(line)
+    print(f"[server] {line}")
+
+
+def note_first_request():
+    if startup["first_request_ms"] is None:
+        startup["first_request_ms"] = round((time.perf_counter() - startup["started"]) * 1000)
+        log(f"First request answered {startup['first_request_ms']} ms after start, "
+            f"peak RSS {rss_mb():.1f} MB")
+
+
+def replica_main(primary):
+    global role, upstream
+
+    host, _, port = primary.rpartition(":")
+    role = "replica"
+    upstream = send_to_primary
+    threading.Thread(target=follow_primary, args=(host or HOST, int(port)), daemon=True).start()
+    threading.Thread(target=presence_worker, daemon=True).start()
+    threading.Thread(target=keyring_worker, daemon=True).start()
+    log(f"Replica of {primary} started")
+    print(f"[server] Read replica of {primary}, listening on {HOST}:{PORT}")
+    accept_loop(listen_socket())
+
+
+def main():
+    global DB, PORT, keyring
+
+    parser = argparse.ArgumentParser(description="PYchat server")
+    parser.add_argument("--rotate-key", action="store_true",
+                        help="add a new active key to secret.key and exit "
+                             "(a running server picks it up and re-encrypts in the background)")
+    parser.add_argument("--workers", type=int, default=0,
+                        help="serve from N worker processes on the same port, with this "
+                             "process owning storage (default: one process)")
+    parser.add_argument("--port", type=int, default=PORT, help=f"client port (default {PORT})")
+    parser.add_argument("--replication-port", type=int,
+                        help="accept read replicas on this port")
+    parser.add_argument("--replica-of", metavar="HOST:PORT",
+                        help="run as a read-only replica of the primary's replication port")
+    parser.add_argument("--admin", action="append", default=[], metavar="USER",
+                        help="let USER run the profiling actions (repeatable)")
+    parser.add_argument("--capture", metavar="FILE",
+                        help="record anonymized request metadata to FILE "
+                             "(replay it with: python benchmarks.py replay FILE)")
+    args = parser.parse_args()
+    PORT = args.port
+    ADMIN_USERS.update(args.admin)
+
+    if args.rotate_key:
+        print(f"[server] New active key id {rotate_key()}")
+        return
+
+    keyring = load_keyring()
+    if args.capture:
+        traffic.start(args.capture)
+
+    if args.replica_of:
+        replica_main(args.replica_of)
+        return
+
+    # workers get a copy of the DB when forked, so only a single process loads lazily
+    DB = load_db(lazy=args.workers == 0)
+    report_startup()
+    procs = start_workers(args.workers) if args.workers > 0 else []
+    threading.Thread(target=rekey_worker, args=(DB,), daemon=True).start()
+    threading.Thread(target=compactor_worker, args=(DB,), daemon=True).start()
+    threading.Thread(target=presence_worker, daemon=True).start()
+    if args.replication_port:
+        threading.Thread(target=replication_server, args=(args.replication_port,), daemon=True).start()
+        threading.Thread(target=heartbeat_worker, daemon=True).start()
+
+    log("Server started")
+    print(f"[server] Listening on {HOST}:{PORT}")
+
+    if not procs:
+        accept_loop(listen_socket())
+
+    print(f"[server] {len(procs)} worker processes")
+    while any(p.is_alive() for p in procs):
+        for p in procs:
+            p.join(1)
+    log("All workers exited")
 
 
 if __name__ == "__main__":
@@ -0,0 +1,163 @@
+import atexit
+import hashlib
+import os
+import secrets
+import struct
+import threading
+import time
+
+# ---------------------------------------------------------------------- #
+#  Traffic capture for load replay (secure_server.py --capture FILE).    #
+#  Every answered request becomes one fixed-size record: arrival time,   #
+#  service time, request/response sizes on the wire, the action, a       #
+#  coarse outcome and pseudonyms of the user and the peer or group.      #
+#                                                                        #
+#  Nothing readable is kept: no message text, file names, queries or     #
+#  tokens. Names are hashed with a key drawn when the capture starts     #
+#  and never written anywhere, so the same user maps to the same id     #
+#  within one file and to an unrelated one in the next.                  #
+#                                                                        #
+#  With --workers every process appends to the same file; records are    #
+#  flushed in whole-record writes to an O_APPEND descriptor, so they     #
+#  never interleave. Each process also flushes from its own thread, so   #
+#  a server that is killed loses at most FLUSH_SECONDS of records.       #
+#  benchmarks.py replay turns a capture back into load.                  #
+# ---------------------------------------------------------------------- #
+
+MAGIC = b"PYTRAF01"
+HEADER = struct.Struct(">8sd")    # magic, capture start (unix time)
+# arrival ms, connection id, service us, request bytes, response bytes,
+# user, peer, item count, action code, status, peer is a group
+RECORD = struct.Struct(">IIIIIQQHBBB")
+FLUSH_BYTES = 64 * 1024
+FLUSH_SECONDS = 1.0
+
+# record action codes; anything else is stored as OTHER
+ACTIONS = ("register", "login", "send", "send_file", "inbox", "conversations",
+           "conversation_detail", "poll", "delete_conversation", "search",
+           "create_group", "add_group_member", "leave_group", "send_group", "groups",
+           "group_detail", "download_file", "typing", "sync", "presence",
+           "typing_status", "logout", "logout_all", "metrics", "profile_start",
+           "profile_stop", "trace_memory", "dump_stacks")
+ACTION_CODES = {name: i for i, name in enumerate(ACTIONS)}
+OTHER = 255
+
+STATUS_OK, STATUS_ERROR, STATUS_REFUSED, STATUS_NOT_MODIFIED = range(4)
+
+state = {"fd": None, "key": None, "start": 0.0, "buf": bytearray(), "flusher": None}
+lock = threading.Lock()
+
+
+def start(path: str):
+    fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC | os.O_APPEND, 0o600)
+    os.write(fd, HEADER.pack(MAGIC, time.time()))
+    state.update(fd=fd, key=secrets.token_bytes(16), start=time.monotonic())
+    atexit.register(flush)
+
+
+def capturing() -> bool:
+    return state["fd"] is not None
+
+
+def pseudonym(name) -> int:
+    if not isinstance(name, str) or not name:
+        return 0
+    digest = hashlib.blake2b(name.encode(), key=state["key"], digest_size=8).digest()
+    return int.from_bytes(digest, "big") or 1
+
+
+def status_of(resp: bytes) -> int:
+    if resp.startswith(b'{"ok": true, "not_modified": true'):
+        return STATUS_NOT_MODIFIED
+    if resp.startswith(b'{"ok": true'):
+        return STATUS_OK
+    if b'"retry_after"' in resp:
+        return STATUS_REFUSED
+    return STATUS_ERROR
+
+
+# the server rejects other types, but the request is still recorded
+def length_of(value) -> int:
+    return len(value) if isinstance(value, (list, str)) else 0
+
+
+# how much work the request asks for, where the size alone does not say
+def item_count(action, payload) -> int:
+    if action == "poll":
+        n = length_of(payload.get("chats"))
+    elif action == "search":
+        n = length_of(payload.get("query"))
+    elif action == "create_group":
+        n = length_of(payload.get("members"))
+    else:
+        n = payload.get("limit") if isinstance(payload.get("limit"), int) else 0
+    return min(max(n, 0), 0xFFFF)
+
+
+def record(conn_id, arrived, action, user, payload, req_bytes, resp_bytes, resp):
+    if not isinstance(payload, dict):
+        payload = {}
+    if user is None:
+        user = payload.get("user")  # register / login
+    peer = payload.get("group") or payload.get("to") or payload.get("peer")
+    now = time.monotonic()
+    rec = RECORD.pack(
+        min(int((arrived - state["start"]) * 1000), 0xFFFFFFFF),
+        conn_id,
+        min(int((now - arrived) * 1_000_000), 0xFFFFFFFF),
+        req_bytes,
+        resp_bytes,
+        pseudonym(user),
+        pseudonym(peer),
+        item_count(action, payload),
+        ACTION_CODES.get(action, OTHER),
+        status_of(resp),
+        isinstance(peer, str) and peer.startswith("#"),
+    )
+    with lock:
+        # threads do not survive a fork, so each worker starts its own
+        if state["flusher"] != os.getpid():
+            state["flusher"] = os.getpid()
+            threading.Thread(target=flush_worker, daemon=True, name="capture-flush").start()
+        state["buf"] += rec
+        if len(state["buf"]) >= FLUSH_BYTES:
+            write_buffer()
+
+
+def write_buffer():
+    if state["buf"]:
+        os.write(state["fd"], bytes(state["buf"]))
+        state["buf"].clear()
+
+
+def flush():
+    with lock:
+        if state["fd"] is not None:
+            write_buffer()
+
+
+def flush_worker():
+    while True:
+        time.sleep(FLUSH_SECONDS)
+        flush()
+
+
+# (capture start, records sorted by arrival), each record a dict
+def read(path: str):
+    with open(path, "rb") as f:
+        data = f.read()
+    magic, started = HEADER.unpack_from(data)
+    if magic != MAGIC:
+        raise ValueError(f"{path} is not a traffic capture")
+    records = []
+    body = memoryview(data)[HEADER.size:]
+    usable = len(body) - len(body) % RECORD.size  # a capture cut off mid-write
+    for t, conn, dur, req, resp, user, peer, items, code, status, group in RECORD.iter_unpack(body[:usable]):
+        records.append({
+            "t": t / 1000, "conn": conn, "duration": dur / 1_000_000, "req_bytes": req,
+            "resp_bytes": resp, "user": user, "peer": peer, "items": items,
+            "action": ACTIONS[code] if code < len(ACTIONS) else "other",
+            "status": status, "group": bool(group),
+        })
+    records.sort(key=lambda r: r["t"])
+    return started, records